@@ -1,22 +1,113 @@
+import collections
+import concurrent.futures
 import datetime
+import functools
+import multiprocessing
 import json
+import re
+import struct
+import tempfile
+import threading
+import time
 
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+import numpy as np
 import pydicom
+import pydicom.datadict
 import pydicom.valuerep
 import pydicom.multival
 import pydicom.sequence
+import pydicom.tag
 
-from girder import events
+from girder import events, logger
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
-from girder.api.rest import Resource
-from girder.constants import AccessType, TokenScope
+from girder.api.rest import Resource, setRawResponse, setResponseHeader
+from girder.constants import AccessType, SortDir, TokenScope
 from girder.exceptions import RestException
 from girder.plugin import GirderPlugin
-from girder.models.item import Item
+from girder.models.collection import Collection
 from girder.models.file import File
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.models.setting import Setting
+from girder.models.upload import Upload
+from girder.models.user import User
 from girder.utility import search
-from girder.utility.progress import setResponseTimeLimit
+from girder.utility.model_importer import ModelImporter
+from girder.utility.progress import ProgressContext, setResponseTimeLimit
+from girder_plugin_utils.item_search import AccessibleFolders, FacetCache, searchItems
+from girder_plugin_utils.parse_queue import ParseQueue
+
+from .frames import frameDataset, frameMediaType, frameTable
+from .header_reader import HeaderReader, HeaderTruncated, PrefixBuffer, ReadCounters
+from .render import RENDER_FORMATS, renderSlice
+from .render_cache import RenderCache
+from .settings import PluginSettings
+from .tag_filter import TagFilter
+from .volume import (
+    VOLUME_FORMAT_VERSION, VOLUME_HEADER_TAGS, gzipChunks, volumeChunks, volumeHeader)
+
+#: The kinds of worker pool which may be used to parse the files of an item.
+PARSE_POOLS = ('thread', 'process')
+
+#: The MongoDB sort specification of ``item['dicom']['files']``, matching
+#: ``_getDicomFileSortKey``.
+DICOM_FILES_SORT = {
+    'dicom.SeriesNumber': 1,
+    'dicom.InstanceNumber': 1,
+    'dicom.SliceLocation': 1,
+    'name': 1
+}
+
+#: The relative difference between the gaps of consecutive slices and the
+#: slice spacing above which the spacing of a series is flagged as irregular.
+SLICE_SPACING_TOLERANCE = 0.01
+
+#: The MongoDB sort specification of ``item['dicom']['series']``, matching
+#: ``_getDicomSeriesSortKey``.
+DICOM_SERIES_SORT = {
+    'StudyInstanceUID': 1,
+    'SeriesNumber': 1,
+    'SeriesInstanceUID': 1
+}
+
+#: The length prefix of the JSON header of each slice in a slice stream.
+SLICE_STREAM_HEADER = struct.Struct('<I')
+
+#: The compressions of DICOM volumes, and the extension of their cached files.
+VOLUME_COMPRESSIONS = {
+    'none': '.volume',
+    'gzip': '.volume.gz'
+}
+
+#: The elements which the plugin needs to index the files of an item (their
+#: series, order, geometry and frames). They are parsed whatever the tag
+#: settings, which only decide whether they are also stored in the metadata.
+DICOM_STRUCTURE_KEYS = frozenset({
+    'SeriesInstanceUID', 'StudyInstanceUID', 'SeriesNumber', 'InstanceNumber',
+    'SliceLocation', 'ImagePositionPatient', 'ImageOrientationPatient', 'NumberOfFrames'
+})
+
+#: The common metadata which is copied into ``item['dicomSummary']``, when
+#: present, so that item listings need not include the whole DICOM metadata.
+DICOM_SUMMARY_KEYS = (
+    'Modality', 'StudyDescription', 'SeriesDescription', 'Rows', 'Columns'
+)
+
+#: Longer keys and values are only searched on their first characters, so
+#: that large values do not bloat the search index: a substring which ends
+#: past this length is not found.
+DICOM_SEARCH_MAX_TOKEN_LENGTH = 256
+
+#: The version of ``item['dicomSearch']``, ``item['dicomSummary']`` and of the
+#: series index; items are indexed again once when the plugin loads with a
+#: newer version.
+DICOM_SEARCH_VERSION = 2
+
+#: The common metadata counted by "GET /item/dicom/facets" by default.
+DICOM_FACET_FIELDS = ('Modality', 'Manufacturer')
 
 
 class DicomViewerPlugin(GirderPlugin):
@@ -24,59 +115,559 @@ class DicomViewerPlugin(GirderPlugin):
     CLIENT_SOURCE_PATH = 'web_client'
 
     def load(self, info):
-        Item().exposeFields(level=AccessType.READ, fields={'dicom'})
+        # The full metadata is fetched from "GET /item/:id/dicom" instead
+        Item().exposeFields(level=AccessType.READ, fields={'dicomSummary', 'dicomProcessing'})
+        for model in (Folder(), Collection()):
+            model.exposeFields(level=AccessType.READ, fields={'dicomParse'})
         events.bind('data.process', 'dicom_viewer', _uploadHandler)
+        events.bind('model.item.remove', 'dicom_viewer', _removeVolumes)
+        # Folder access lists and group memberships determine search results
+        for event in ('model.folder.save', 'model.folder.remove', 'model.user.save'):
+            events.bind(event, 'dicom_viewer', _clearSearchCaches)
+        events.bind('model.item.remove', 'dicom_viewer_facets', _FACET_CACHE.clear)
 
         # Add the DICOM search mode only once
         search.addSearchMode('dicom', dicomSubstringSearchHandler)
+        Item().ensureIndex('dicomSearch')
+        _migrateSearchTokens()
 
         dicomItem = DicomItem()
+        info['apiRoot'].item.route(
+            'GET', ('dicom', 'queue'), dicomItem.getParseQueueMetrics)
+        info['apiRoot'].item.route(
+            'GET', ('dicom', 'search'), dicomItem.searchDicomItems)
+        info['apiRoot'].item.route(
+            'GET', ('dicom', 'facets'), dicomItem.getDicomFacets)
+        info['apiRoot'].item.route(
+            'GET', (':id', 'dicom'), dicomItem.getDicomItem)
+        info['apiRoot'].item.route(
+            'GET', (':id', 'dicom', 'series'), dicomItem.getDicomSeriesList)
+        info['apiRoot'].item.route(
+            'GET', (':id', 'dicom', 'series', ':uid'), dicomItem.getDicomSeries)
+        info['apiRoot'].item.route(
+            'GET', (':id', 'dicom', 'series', ':uid', 'volume'), dicomItem.getDicomVolume)
+        info['apiRoot'].item.route(
+            'GET', (':id', 'dicom', 'slices'), dicomItem.getDicomSlices)
+        info['apiRoot'].file.route(
+            'GET', (':id', 'dicom', 'frames', ':frame'), dicomItem.getDicomFrame)
+        info['apiRoot'].file.route(
+            'GET', (':id', 'dicom', 'render'), dicomItem.renderDicomFile)
         info['apiRoot'].item.route(
             'POST', (':id', 'parseDicom'), dicomItem.makeDicomItem)
+        info['apiRoot'].folder.route(
+            'POST', (':id', 'parseDicom'), dicomItem.makeFolderDicomItems)
+        info['apiRoot'].collection.route(
+            'POST', (':id', 'parseDicom'), dicomItem.makeCollectionDicomItems)
+
+        _resumeDicomBatches()
+        _resumeQueuedItems()
 
 
 class DicomItem(Resource):
 
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Get the DICOM metadata and the sorted DICOM files of an item.')
+        .modelParam('id', 'The item ID',
+                    model='item', level=AccessType.READ, paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('The item is not a DICOM item.')
+        .errorResponse('Read permission denied on the item.', 403)
+    )
+    def getDicomItem(self, item):
+        if 'dicom' not in item:
+            raise RestException('The item is not a DICOM item.')
+        return item['dicom']
+
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('List the DICOM series of an item.')
+        .notes('Each series has its UIDs, its number, its number of files and the '
+               'metadata which is common to all its files.')
+        .modelParam('id', 'The item ID',
+                    model='item', level=AccessType.READ, paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('The item is not a DICOM item.')
+        .errorResponse('Read permission denied on the item.', 403)
+    )
+    def getDicomSeriesList(self, item):
+        return _getDicomSeriesIndex(item)
+
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Get the common metadata and the sorted files of a DICOM series.')
+        .modelParam('id', 'The item ID',
+                    model='item', level=AccessType.READ, paramType='path')
+        .param('uid', 'The SeriesInstanceUID of the series.', paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('The item is not a DICOM item.')
+        .errorResponse('Series not found.', 404)
+        .errorResponse('Read permission denied on the item.', 403)
+    )
+    def getDicomSeries(self, item, uid):
+        return _getDicomSeries(item, uid)
+
+    @access.public(scope=TokenScope.DATA_READ, cookie=True)
+    @autoDescribeRoute(
+        Description('Download the pixel data of a DICOM series as a 3D volume.')
+        .notes('The volume is a 4-byte little-endian length, followed by a JSON header of '
+               'that length, with the "dtype", "shape" (slices, rows, columns), "spacing", '
+               '"origin" and "orientation" of the volume, followed by its voxels as raw '
+               'little-endian values, with the rescale of the slices applied. '
+               'The volume is generated one slice at a time, and is kept as a file '
+               'attached to the item, so that it is generated only once.')
+        .modelParam('id', 'The item ID',
+                    model='item', level=AccessType.READ, paramType='path')
+        .param('uid', 'The SeriesInstanceUID of the series.', paramType='path')
+        .param('compression', 'Whether to compress the volume.', required=False,
+               default='none', enum=list(VOLUME_COMPRESSIONS))
+        .produces(['application/octet-stream', 'application/gzip'])
+        .errorResponse('ID was invalid.')
+        .errorResponse('The item is not a DICOM item.')
+        .errorResponse('The slices of the series cannot be stacked into a volume.')
+        .errorResponse('Series not found.', 404)
+        .errorResponse('Read permission denied on the item.', 403)
+    )
+    def getDicomVolume(self, item, uid, compression):
+        series = _getDicomSeries(item, uid)
+        setRawResponse()
+        return _volumeStream(item, series, compression)
+
+    @access.public(scope=TokenScope.DATA_READ, cookie=True)
+    @autoDescribeRoute(
+        Description('Download a range of DICOM slices in a single response.')
+        .notes('Slices are streamed in their sorted order. Each slice is a 4-byte '
+               'little-endian length, followed by a JSON header of that length, with '
+               'the "index", "_id", "name" and "size" of the file, followed by the '
+               '"size" bytes of the file.')
+        .modelParam('id', 'The item ID',
+                    model='item', level=AccessType.READ, paramType='path')
+        .param('start', 'The index of the first slice.',
+               dataType='integer', required=False, default=0)
+        .param('count', 'The maximum number of slices.',
+               dataType='integer', required=False, default=100)
+        .param('series', 'The SeriesInstanceUID of the series to download the slices of. '
+               'By default, the slices of the whole item are downloaded.', required=False)
+        .produces(['application/octet-stream'])
+        .errorResponse('ID was invalid.')
+        .errorResponse('The item is not a DICOM item.')
+        .errorResponse('Series not found.', 404)
+        .errorResponse('Read permission denied on the item.', 403)
+    )
+    def getDicomSlices(self, item, start, count, series):
+        if start < 0 or count < 1:
+            raise RestException('The start must be positive and the count at least 1.')
+        if series is not None:
+            files = _getDicomSeries(item, series)['files']
+        elif 'dicom' in item:
+            files = item['dicom']['files']
+        else:
+            raise RestException('The item is not a DICOM item.')
+        setResponseHeader('Content-Type', 'application/octet-stream')
+        setRawResponse()
+        return _sliceStream(item, files, start, count)
+
+    @access.public(scope=TokenScope.DATA_READ, cookie=True)
+    @autoDescribeRoute(
+        Description('Render a DICOM slice to an image.')
+        .notes('Rendered images are cached on the server, within the size set by the '
+               '"dicom_viewer.render_cache_size" setting.')
+        .modelParam('id', 'The file ID',
+                    model='file', level=AccessType.READ, paramType='path')
+        .param('frame', 'The frame to render, for multi-frame files.',
+               dataType='integer', required=False, default=0)
+        .param('window', 'The window width, in rescaled units. By default, the window '
+               'width of the file, or its range of values.',
+               dataType='number', required=False)
+        .param('level', 'The window center, in rescaled units. By default, the window '
+               'center of the file, or the middle of its range of values.',
+               dataType='number', required=False)
+        .param('size', 'The maximum width and height of the image. By default, the '
+               'image has the size of the slice.',
+               dataType='integer', required=False)
+        .param('encoding', 'The image format.', required=False, default='png',
+               enum=list(RENDER_FORMATS))
+        .produces(list(RENDER_FORMATS.values()))
+        .errorResponse('ID was invalid.')
+        .errorResponse('The file is not a DICOM image.')
+        .errorResponse('Read permission denied on the file.', 403)
+    )
+    def renderDicomFile(self, file, frame, window, level, size, encoding):
+        if size is not None and size < 1:
+            raise RestException('The size must be at least 1.')
+        if window is not None and window <= 0:
+            raise RestException('The window must be positive.')
+        data = _renderDicomFile(file, frame, window, level, size, encoding)
+        setResponseHeader('Content-Type', RENDER_FORMATS[encoding])
+        setRawResponse()
+        return data
+
+    @access.public(scope=TokenScope.DATA_READ, cookie=True)
+    @autoDescribeRoute(
+        Description('Download a single frame of a DICOM file.')
+        .notes('Only the bytes of the frame are read, using the offsets of the frames, '
+               'which are located when the file is parsed. The frame is sent as it is '
+               'stored: raw pixel data, or the compressed image of the frame, with its '
+               'transfer syntax in the Content-Type.')
+        .modelParam('id', 'The file ID',
+                    model='file', level=AccessType.READ, paramType='path')
+        .param('frame', 'The index of the frame.', dataType='integer', paramType='path')
+        .produces(['application/octet-stream', 'image/jpeg', 'image/jls', 'image/jp2'])
+        .errorResponse('ID was invalid.')
+        .errorResponse('The frames of the file cannot be located.')
+        .errorResponse('Read permission denied on the file.', 403)
+    )
+    def getDicomFrame(self, file, frame):
+        table = _getFrameTable(file)
+        if table is None:
+            raise RestException('The frames of the file cannot be located.')
+        ranges = _frameRanges(table, frame)
+        setResponseHeader('Content-Type', frameMediaType(table))
+        setResponseHeader('Content-Length', sum(length for offset, length in ranges))
+        setRawResponse()
+        return _frameStream(file, ranges)
+
+    @access.admin(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Get the metrics of the queue which parses uploaded DICOM files.')
+        .notes('Uploaded files are queued when the "dicom_viewer.upload_processing" '
+               'setting is "async". The status of each queued item is its '
+               '"dicomProcessing" field.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def getParseQueueMetrics(self):
+        return _getParseQueue().metrics()
+
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Search the DICOM items by a substring of their metadata keys and values.')
+        .notes('Items are returned in the order of their IDs. To get the next page, '
+               'pass the "next" value of a page as "after". Only the first %d characters '
+               'of each key and value are searched.' % DICOM_SEARCH_MAX_TOKEN_LENGTH)
+        .param('q', 'The substring to search for, case-insensitively.')
+        .param('limit', 'The maximum number of items to return.',
+               required=False, dataType='integer', default=50)
+        .param('after', 'The ID of the last item of the previous page.', required=False)
+        .param('count', 'Whether to count all the matching items.',
+               required=False, dataType='boolean', default=True)
+        .errorResponse('The limit or the ID of the previous item was invalid.')
+    )
+    def searchDicomItems(self, q, limit, after, count):
+        if limit < 1:
+            raise RestException('The limit must be positive.')
+        if after is not None:
+            try:
+                after = ObjectId(after)
+            except InvalidId:
+                raise RestException('Invalid ObjectId: %s' % after)
+        user = self.getCurrentUser()
+        items, total = searchItems(
+            _dicomSearchQuery(q), _ACCESSIBLE_FOLDERS, user, AccessType.READ,
+            limit=limit, after=after, count=count)
+        return {
+            'item': [Item().filter(item, user) for item in items],
+            'total': total,
+            'next': str(items[-1]['_id']) if len(items) == limit else None
+        }
+
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Count the DICOM items having each value of common metadata elements.')
+        .notes('Only the items which the user can read are counted. Counts are cached '
+               'until DICOM metadata is written, so they may lag behind for a few '
+               'minutes after other changes, e.g. moved items.')
+        .jsonParam('fields', 'The keywords of the DICOM elements, as a JSON list.',
+                   required=False, requireArray=True, default=list(DICOM_FACET_FIELDS))
+        .param('limit', 'The maximum number of values of each element, by decreasing count.',
+               required=False, dataType='integer', default=50)
+        .errorResponse('A keyword or the limit was invalid.')
+    )
+    def getDicomFacets(self, fields, limit):
+        if limit < 1:
+            raise RestException('The limit must be positive.')
+        for field in fields:
+            if not isinstance(field, str) or pydicom.datadict.tag_for_keyword(field) is None:
+                raise RestException('Invalid DICOM keyword: %s' % (field,))
+        return _FACET_CACHE.counts(
+            {'dicom': {'$exists': True}},
+            {field: '$dicom.meta.%s' % field for field in fields},
+            _ACCESSIBLE_FOLDERS, self.getCurrentUser(), AccessType.READ, limit=limit)
+
     @access.user(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
         Description('Get and store common DICOM metadata, if any, for all files in the item.')
         .modelParam('id', 'The item ID',
                     model='item', level=AccessType.WRITE, paramType='path')
+        .param('workers', 'The number of files to parse concurrently.',
+               dataType='integer', required=False, default=1)
+        .param('pool', 'Use a "thread" pool for I/O-bound assetstores or a "process" pool '
+               'for CPU-bound DICOM decoding.', required=False, default='thread',
+               enum=list(PARSE_POOLS))
         .errorResponse('ID was invalid.')
         .errorResponse('Read permission denied on the item.', 403)
     )
-    def makeDicomItem(self, item):
+    def makeDicomItem(self, item, workers, pool):
         """
         Try to convert an existing item into a "DICOM item", which contains a
         "dicomMeta" field with DICOM metadata that is common to all DICOM files.
         """
-        metadataReference = None
-        dicomFiles = []
+        if workers < 1:
+            raise RestException('The number of workers must be at least 1.')
+        _makeDicomItem(item, workers, pool)
+
+    @access.user(scope=TokenScope.DATA_WRITE)
+    @autoDescribeRoute(
+        Description('Parse DICOM metadata for all items in a folder and its subfolders, '
+                    'as a background task.')
+        .notes('The status of the task is stored in the "dicomParse" field of the folder. '
+               'A task interrupted by a server restart is resumed. Items which cannot '
+               'be parsed are listed in its "failedItemIds".')
+        .modelParam('id', 'The folder ID',
+                    model='folder', level=AccessType.WRITE, paramType='path')
+        .param('workers', 'The number of items to parse concurrently.',
+               dataType='integer', required=False, default=4)
+        .param('progress', 'Whether to record progress on this task.',
+               dataType='boolean', required=False, default=True)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write permission denied on the folder.', 403)
+    )
+    def makeFolderDicomItems(self, folder, workers, progress):
+        return _startDicomBatch(folder, 'folder', self.getCurrentUser(), workers, progress)
 
-        for file in Item().childFiles(item):
-            dicomMeta = _parseFile(file)
-            if dicomMeta is None:
+    @access.user(scope=TokenScope.DATA_WRITE)
+    @autoDescribeRoute(
+        Description('Parse DICOM metadata for all items in a collection, as a background task.')
+        .notes('The status of the task is stored in the "dicomParse" field of the collection. '
+               'A task interrupted by a server restart is resumed. Items which cannot '
+               'be parsed are listed in its "failedItemIds".')
+        .modelParam('id', 'The collection ID',
+                    model='collection', level=AccessType.WRITE, paramType='path')
+        .param('workers', 'The number of items to parse concurrently.',
+               dataType='integer', required=False, default=4)
+        .param('progress', 'Whether to record progress on this task.',
+               dataType='boolean', required=False, default=True)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write permission denied on the collection.', 403)
+    )
+    def makeCollectionDicomItems(self, collection, workers, progress):
+        return _startDicomBatch(
+            collection, 'collection', self.getCurrentUser(), workers, progress)
+
+
+def _makeDicomItem(item, workers=1, pool='thread', counters=None):
+    """
+    Parse all the files of an item, and store the common DICOM metadata and
+    the sorted list of DICOM files in the item, if there is any, along with
+    the same for each series of the item.
+    """
+    metadataReference = None
+    dicomFiles = []
+    seriesByUid = {}
+    imagePositions = []
+    imageOrientations = []
+    tagFilter = _getTagFilter()
+
+    for file, dicomMeta in _parseFiles(
+            Item().childFiles(item), workers, pool, counters, tagFilter):
+        if dicomMeta is None:
+            continue
+        fileData = _extractFileData(file, dicomMeta)
+        dicomFiles.append(fileData)
+        imagePositions.append(dicomMeta.get('ImagePositionPatient'))
+        imageOrientations.append(dicomMeta.get('ImageOrientationPatient'))
+        dicomMeta = _storedMetadata(dicomMeta, tagFilter)
+
+        metadataReference = (
+            dicomMeta
+            if metadataReference is None else
+            _removeUniqueMetadata(metadataReference, dicomMeta)
+        )
+
+        uid = fileData['dicom']['SeriesInstanceUID']
+        if uid not in seriesByUid:
+            seriesByUid[uid] = _newDicomSeries(fileData, dicomMeta)
+        else:
+            seriesByUid[uid]['meta'] = _removeUniqueMetadata(
+                seriesByUid[uid]['meta'], dicomMeta)
+        seriesByUid[uid]['fileCount'] += 1
+
+        setResponseTimeLimit()
+
+    if dicomFiles:
+        # Order the slices of each series spatially; the positions are in the
+        # order in which the files were parsed
+        slicePositions = _slicePositions(imagePositions, imageOrientations)
+        for fileData, slicePosition in zip(dicomFiles, slicePositions):
+            fileData['dicom']['SlicePosition'] = slicePosition
+        # Sort the dicom files
+        dicomFiles.sort(key=_getDicomFileSortKey)
+        for uid, series in seriesByUid.items():
+            series['geometry'] = _seriesGeometry([
+                f['dicom']['SlicePosition'] for f in dicomFiles
+                if f['dicom']['SeriesInstanceUID'] == uid])
+        # Store in the item
+        item['dicom'] = {
+            'meta': metadataReference,
+            'files': dicomFiles,
+            'series': sorted(seriesByUid.values(), key=_getDicomSeriesSortKey)
+        }
+        item['dicomSummary'] = _dicomSummary(
+            metadataReference, len(dicomFiles), len(seriesByUid))
+        item['dicomSearch'] = _searchTokens(metadataReference)
+        # Save the item
+        Item().save(item)
+        _FACET_CACHE.clear()
+
+
+def _batchFolderIds(doc, modelName, user):
+    """
+    Return the IDs of the folders within a folder or a collection, including
+    the folder itself, which the user is allowed to write to.
+    """
+    folderIds = []
+    if modelName == 'folder':
+        pending = [doc]
+    else:
+        pending = list(Folder().childFolders(doc, 'collection', user=user))
+    while pending:
+        folder = pending.pop()
+        if Folder().hasAccess(folder, user, AccessType.WRITE):
+            folderIds.append(folder['_id'])
+        pending.extend(Folder().childFolders(folder, 'folder', user=user))
+    return folderIds
+
+
+def _startDicomBatch(doc, modelName, user, workers, progress):
+    """
+    Start parsing all the items within a folder or a collection in a background
+    thread. The status of the batch is stored as ``doc['dicomParse']``.
+    """
+    if workers < 1:
+        raise RestException('The number of workers must be at least 1.')
+
+    batch = {
+        'state': 'running',
+        'userId': user['_id'],
+        'workers': workers,
+        'progress': progress,
+        'started': datetime.datetime.utcnow(),
+        # Items are processed in _id order, so the batch can be resumed after this item
+        'lastItemId': None,
+        'items': 0,
+        # The items which could not be parsed
+        'failedItemIds': [],
+        'files': 0,
+        'bytesRead': 0,
+        'seconds': 0.0
+    }
+    # Check and start the batch in a single update, so that concurrent requests
+    # cannot both start one
+    result = ModelImporter.model(modelName).update(
+        {'_id': doc['_id'], 'dicomParse.state': {'$ne': 'running'}},
+        {'$set': {'dicomParse': batch}}, multi=False)
+    if not result.matched_count:
+        raise RestException('DICOM items are already being parsed in this %s.' % modelName)
+    doc['dicomParse'] = batch
+    threading.Thread(
+        target=_runDicomBatch, args=(doc, modelName, user), daemon=True).start()
+    return batch
+
+
+def _resumeDicomBatches():
+    """
+    Restart the batches which were interrupted by a server restart.
+    """
+    for modelName in ('folder', 'collection'):
+        for doc in ModelImporter.model(modelName).find({'dicomParse.state': 'running'}):
+            user = User().load(doc['dicomParse']['userId'], force=True)
+            if user is None:
                 continue
-            dicomFiles.append(_extractFileData(file, dicomMeta))
+            logger.info('Resuming DICOM parsing in %s %s', modelName, doc['_id'])
+            threading.Thread(
+                target=_runDicomBatch, args=(doc, modelName, user), daemon=True).start()
 
-            metadataReference = (
-                dicomMeta
-                if metadataReference is None else
-                _removeUniqueMetadata(metadataReference, dicomMeta)
-            )
 
-            setResponseTimeLimit()
+def _batchItems(query, lastItemId=None, pageSize=100):
+    """
+    Yield the items matching a query in ``_id`` order, after ``lastItemId``.
 
-        if dicomFiles:
-            # Sort the dicom files
-            dicomFiles.sort(key=_getDicomFileSortKey)
-            # Store in the item
-            item['dicom'] = {
-                'meta': metadataReference,
-                'files': dicomFiles
-            }
-            # Save the item
-            Item().save(item)
+    Items are fetched one page at a time, rather than from a single cursor
+    which could time out while the items are parsed.
+    """
+    while True:
+        pageQuery = dict(query)
+        if lastItemId is not None:
+            pageQuery['_id'] = {'$gt': lastItemId}
+        page = list(Item().find(pageQuery, sort=[('_id', SortDir.ASCENDING)], limit=pageSize))
+        yield from page
+        if len(page) < pageSize:
+            return
+        lastItemId = page[-1]['_id']
+
+
+def _runDicomBatch(doc, modelName, user):
+    """
+    Parse the items of a batch after its ``lastItemId``, saving its progress
+    after each item, so that an interrupted batch resumes where it stopped.
+    An item which cannot be parsed is recorded in ``failedItemIds``, and the
+    batch goes on with the next items.
+    """
+    model = ModelImporter.model(modelName)
+    batch = doc['dicomParse']
+    batch.setdefault('failedItemIds', [])
+    counters = ReadCounters()
+    startTime = time.time()
+    # The totals of the previous runs of this batch
+    previous = {key: batch[key] for key in ('files', 'bytesRead', 'seconds')}
+
+    def updateTotals():
+        batch['files'] = previous['files'] + counters.files
+        batch['bytesRead'] = previous['bytesRead'] + counters.bytesRead
+        batch['seconds'] = previous['seconds'] + time.time() - startTime
+        batch['filesPerSecond'] = batch['files'] / batch['seconds'] if batch['seconds'] else 0.0
+        batch['bytesPerSecond'] = (
+            batch['bytesRead'] / batch['seconds'] if batch['seconds'] else 0.0)
+
+    def parseItem(item):
+        try:
+            _makeDicomItem(item, counters=counters)
+        except Exception:
+            logger.exception('Failed to parse DICOM item %s', item['_id'])
+            return item, False
+        return item, True
+
+    try:
+        query = {'folderId': {'$in': _batchFolderIds(doc, modelName, user)}}
+        countQuery = dict(query)
+        if batch['lastItemId'] is not None:
+            countQuery['_id'] = {'$gt': batch['lastItemId']}
+        with ProgressContext(
+                batch['progress'], user=user, resource=doc, resourceName=modelName,
+                title='Parsing DICOM items in %s' % doc['name'],
+                total=Item().collection.count_documents(countQuery)) as ctx, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=batch['workers']) as pool:
+            items = _batchItems(query, batch['lastItemId'])
+            for item, parsed in _boundedMap(pool, parseItem, items, batch['workers'] * 2):
+                batch['items'] += 1
+                batch['lastItemId'] = item['_id']
+                if not parsed:
+                    batch['failedItemIds'].append(item['_id'])
+                updateTotals()
+                model.update({'_id': doc['_id']}, {'$set': {'dicomParse': batch}}, multi=False)
+                ctx.update(increment=1, message='%s %s' % (
+                    'Parsed' if parsed else 'Failed to parse', item['name']))
+        batch['state'] = 'success'
+    except Exception:
+        logger.exception('Failed to parse DICOM items in %s %s', modelName, doc['_id'])
+        batch['state'] = 'error'
+
+    updateTotals()
+    model.update({'_id': doc['_id']}, {'$set': {'dicomParse': batch}}, multi=False)
+    logger.info(
+        'Parsed DICOM items in %s %s: %d items (%d failed), %d files (%.1f files/s), '
+        '%d bytes read (%.0f bytes/s)', modelName, doc['_id'], batch['items'],
+        len(batch['failedItemIds']), batch['files'], batch['filesPerSecond'],
+        batch['bytesRead'], batch['bytesPerSecond'])
 
 
 def _extractFileData(file, dicomMetadata):
@@ -88,7 +679,9 @@ def _extractFileData(file, dicomMetadata):
         'dicom': {
             'SeriesNumber': dicomMetadata.get('SeriesNumber'),
             'InstanceNumber': dicomMetadata.get('InstanceNumber'),
-            'SliceLocation': dicomMetadata.get('SliceLocation')
+            'SliceLocation': dicomMetadata.get('SliceLocation'),
+            'SeriesInstanceUID': dicomMetadata.get('SeriesInstanceUID'),
+            'StudyInstanceUID': dicomMetadata.get('StudyInstanceUID')
         },
         'name': file['name'],
         '_id': file['_id']
@@ -96,38 +689,313 @@ def _extractFileData(file, dicomMetadata):
 
 
 def _getDicomFileSortKey(f):
-    """These properties are used to sort the files into the item."""
+    """
+    These properties are used to sort the files into the item, like MongoDB
+    does with ``DICOM_FILES_SORT``.
+    """
     meta = f.get('dicom')
     return (
-        meta.get('SeriesNumber'),
-        meta.get('InstanceNumber'),
-        meta.get('SliceLocation'),
+        _nullsFirst(meta.get('SeriesNumber')),
+        _nullsFirst(meta.get('InstanceNumber')),
+        _nullsFirst(meta.get('SliceLocation')),
         f.get('name')
     )
 
 
+def _newDicomSeries(fileData, dicomMeta):
+    """
+    Create the entry of ``item['dicom']['series']`` for the series of a file,
+    from its ``_extractFileData`` and its stored metadata.
+    Files without a SeriesInstanceUID (e.g. when it is not stored, because of
+    the tag settings) are all grouped in one series. The files of a series are
+    only listed in ``item['dicom']['files']``, see ``_getDicomSeriesFiles``.
+    """
+    return {
+        'SeriesInstanceUID': fileData['dicom']['SeriesInstanceUID'],
+        'StudyInstanceUID': fileData['dicom']['StudyInstanceUID'],
+        'SeriesNumber': fileData['dicom']['SeriesNumber'],
+        'meta': dicomMeta,
+        'fileCount': 0,
+        'geometry': _seriesGeometry([])
+    }
+
+
+def _nullsFirst(value):
+    """Sort missing values first, like MongoDB does."""
+    return (value is not None, value if value is not None else 0)
+
+
+def _getDicomSeriesSortKey(series):
+    """Sort series like MongoDB sorts them with ``DICOM_SERIES_SORT``."""
+    return tuple(_nullsFirst(series[key]) for key in DICOM_SERIES_SORT)
+
+
+def _getDicomSeriesFileSortKey(f):
+    """
+    Sort the files of a series along the normal of their orientation, falling
+    back to the legacy keys when their geometry is unknown.
+    """
+    meta = f['dicom']
+    return (
+        _nullsFirst(meta.get('SlicePosition')),
+        _nullsFirst(meta.get('InstanceNumber')),
+        _nullsFirst(meta.get('SliceLocation')),
+        f['name']
+    )
+
+
+def _isNumberList(value, length):
+    return (
+        isinstance(value, list) and len(value) == length and
+        all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value)
+    )
+
+
+def _slicePositions(imagePositions, imageOrientations):
+    """
+    Compute the position of slices along the normal of their image plane, by
+    projecting their ImagePositionPatient onto the cross product of the row
+    and column directions of their ImageOrientationPatient.
+
+    :param imagePositions: The ImagePositionPatient of each slice.
+    :param imageOrientations: The ImageOrientationPatient of each slice.
+    :returns: The position of each slice, or None for the slices whose
+        geometry is missing or invalid.
+    """
+    valid = [
+        index for index, (position, orientation)
+        in enumerate(zip(imagePositions, imageOrientations))
+        if _isNumberList(position, 3) and _isNumberList(orientation, 6)
+    ]
+    slicePositions = [None] * len(imagePositions)
+    if not valid:
+        return slicePositions
+
+    positions = np.array([imagePositions[index] for index in valid], dtype=float)
+    orientations = np.array([imageOrientations[index] for index in valid], dtype=float)
+    normals = np.cross(orientations[:, :3], orientations[:, 3:])
+    # Element-wise, so that a slice has the same position whether it is
+    # projected alone or with the rest of its series
+    projections = (
+        positions[:, 0] * normals[:, 0] +
+        positions[:, 1] * normals[:, 1] +
+        positions[:, 2] * normals[:, 2])
+    usable = np.isfinite(projections) & normals.any(axis=1)
+    for index, projection, isUsable in zip(valid, projections.tolist(), usable.tolist()):
+        if isUsable:
+            slicePositions[index] = projection
+    return slicePositions
+
+
+def _seriesGeometry(slicePositions):
+    """
+    Describe the spacing of the slices of a series.
+
+    :param slicePositions: The position of each slice of the series, as
+        computed by ``_slicePositions``, in any order.
+    :returns: The median gap between consecutive slices (the slice spacing),
+        the smallest and largest gaps, and whether the spacing is irregular:
+        some gaps differ from the spacing, some slices share a position or
+        some slices have no position.
+    """
+    positions = np.sort(np.array(
+        [position for position in slicePositions if position is not None], dtype=float))
+    geometry = {
+        'sliceSpacing': None,
+        'minSliceGap': None,
+        'maxSliceGap': None,
+        'irregularSpacing': len(positions) != len(slicePositions)
+    }
+    if len(positions) < 2:
+        return geometry
+
+    gaps = np.diff(positions)
+    spacing = float(np.median(gaps))
+    geometry.update({
+        'sliceSpacing': spacing,
+        'minSliceGap': float(gaps.min()),
+        'maxSliceGap': float(gaps.max()),
+        'irregularSpacing': geometry['irregularSpacing'] or spacing == 0 or bool(
+            np.any(np.abs(gaps - spacing) > SLICE_SPACING_TOLERANCE * spacing))
+    })
+    return geometry
+
+
+def _getDicomSeries(item, uid):
+    """
+    :returns: The entry of a series in ``item['dicom']['series']``, with its
+        sorted ``files``.
+    """
+    for series in _getDicomSeriesIndex(item):
+        if series['SeriesInstanceUID'] == uid:
+            return dict(series, files=_getDicomSeriesFiles(item, uid))
+    raise RestException('Series not found.', 404)
+
+
+def _getDicomSeriesFiles(item, uid):
+    """
+    Get the files of a series from ``item['dicom']['files']``, in the order
+    of the series.
+    """
+    return sorted((
+        f for f in item['dicom']['files'] if f['dicom'].get('SeriesInstanceUID') == uid),
+        key=_getDicomSeriesFileSortKey)
+
+
+def _sliceStream(item, files, start, count):
+    """
+    Stream a range of the sorted files of a DICOM item, each one prefixed by
+    its header.
+
+    :param files: The sorted files of the item or of one of its series.
+    :returns: A function generating the response.
+    """
+    def stream():
+        for index, fileData in enumerate(files[start:start + count], start):
+            file = File().load(fileData['_id'], force=True)
+            if file is None or file['itemId'] != item['_id']:
+                # Removed since the item was parsed
+                continue
+            header = json.dumps({
+                'index': index,
+                '_id': str(file['_id']),
+                'name': file['name'],
+                'size': file['size']
+            }).encode('utf8')
+            yield SLICE_STREAM_HEADER.pack(len(header)) + header
+            yield from File().download(file, headers=False)()
+    return stream
+
+
+def _volumeKey(files, compression):
+    """
+    Build a value which changes whenever the volume of a series would differ.
+    """
+    return RenderCache.key(VOLUME_FORMAT_VERSION, compression, [
+        (f['_id'], f.get('sha512'), f.get('updated', f.get('created'))) for f in files])
+
+
+def _volumeStream(item, series, compression):
+    """
+    Download the volume of a series from its cached file, or generate it,
+    caching it as it is sent.
+
+    :returns: A function generating the response.
+    """
+    files = [File().load(f['_id'], force=True) for f in series['files']]
+    if None in files:
+        raise RestException('Some files of the series were removed; parse the item again.')
+    key = _volumeKey(files, compression)
+    cached = File().findOne({
+        'attachedToType': 'item',
+        'attachedToId': item['_id'],
+        'dicomVolume.key': key
+    })
+    if cached is not None:
+        return File().download(cached, headers=True)
+
+    headers = []
+    for file in files:
+        with HeaderReader(file) as fp:
+            headers.append(pydicom.dcmread(
+                fp, stop_before_pixels=True, specific_tags=VOLUME_HEADER_TAGS))
+    try:
+        header = volumeHeader(headers, (series.get('geometry') or {}).get('sliceSpacing'))
+    except ValueError as e:
+        raise RestException('The series cannot be stacked into a volume: %s' % e)
+    header['SeriesInstanceUID'] = series['SeriesInstanceUID']
+
+    def readDatasets():
+        for file in files:
+            with File().open(file) as fp:
+                yield pydicom.dcmread(fp)
+
+    chunks = volumeChunks(header, readDatasets())
+    if compression == 'gzip':
+        chunks = gzipChunks(chunks)
+        setResponseHeader('Content-Type', 'application/gzip')
+    else:
+        setResponseHeader('Content-Type', 'application/octet-stream')
+
+    def stream():
+        with tempfile.TemporaryFile() as cache:
+            for chunk in chunks:
+                cache.write(chunk)
+                yield chunk
+            # Only complete volumes are cached
+            size = cache.tell()
+            cache.seek(0)
+            _storeVolume(item, series, compression, key, cache, size)
+    return stream
+
+
+def _storeVolume(item, series, compression, key, fp, size):
+    """
+    Store the volume of a series as a file attached to its item, replacing the
+    previous volume of the series.
+    """
+    uid = series['SeriesInstanceUID']
+    volume = Upload().uploadFromFile(
+        fp, size, '%s%s' % (uid, VOLUME_COMPRESSIONS[compression]),
+        parentType='item', parent=item,
+        user=User().load(item['creatorId'], force=True),
+        mimeType='application/gzip' if compression == 'gzip' else 'application/octet-stream',
+        attachParent=True)
+    File().update({'_id': volume['_id']}, {'$set': {'dicomVolume': {
+        'key': key,
+        'SeriesInstanceUID': uid,
+        'compression': compression
+    }}})
+    for previous in File().find({
+        'attachedToType': 'item',
+        'attachedToId': item['_id'],
+        'dicomVolume.SeriesInstanceUID': uid,
+        'dicomVolume.compression': compression,
+        '_id': {'$ne': volume['_id']}
+    }):
+        File().remove(previous)
+
+
+def _removeVolumes(event):
+    """
+    Remove the cached volumes of an item with it, since attached files are not
+    removed by Girder.
+    """
+    for volume in File().find({
+        'attachedToType': 'item',
+        'attachedToId': event.info['_id'],
+        'dicomVolume': {'$exists': True}
+    }):
+        File().remove(volume)
+
+
+def _getDicomSeriesIndex(item):
+    if 'dicom' not in item:
+        raise RestException('The item is not a DICOM item.')
+    if 'series' not in item['dicom']:
+        raise RestException(
+            'The series of this item are not indexed yet, parse its DICOM files again.')
+    return item['dicom']['series']
+
+
+def _uniqueMetadataKeys(dicomMeta, additionalMeta):
+    """
+    Return the keys of ``dicomMeta`` whose value is missing or different in
+    ``additionalMeta``. Only the keys of ``dicomMeta`` are visited, so this is
+    cheap once the common metadata of an item has shrunk.
+    """
+    return [
+        k for k, v in dicomMeta.items()
+        if k not in additionalMeta or additionalMeta[k] != v
+    ]
+
+
 def _removeUniqueMetadata(dicomMeta, additionalMeta):
     """
     Return only the common data between the two inputs.
-    Only work if all the data element are hashable,
-    this means not have any dict or list as properties
-    """
-    return dict(
-        {
-            (
-                k,
-                tuple(v) if isinstance(v, list) else v
-            )
-            for k, v in dicomMeta.items()
-        }
-        & {
-            (
-                k,
-                tuple(v) if isinstance(v, list) else v
-            )
-            for k, v in additionalMeta.items()
-        }
-    )
+    """
+    uniqueKeys = set(_uniqueMetadataKeys(dicomMeta, additionalMeta))
+    return {k: v for k, v in dicomMeta.items() if k not in uniqueKeys}
 
 
 def _coerceValue(value):
@@ -169,7 +1037,89 @@ def _coerceValue(value):
     raise ValueError('Unknown type', type(value))
 
 
-def _coerceMetadata(dataset):
+def _coerceAs(baseType):
+    def coerce(value):
+        if isinstance(value, baseType):
+            return baseType(value)
+        return _coerceValue(value)
+    return coerce
+
+
+def _coercePersonName(value):
+    if isinstance(value, pydicom.valuerep.PersonName):
+        return value.encode('utf-8')
+    return _coerceValue(value)
+
+
+def _coerceSequence(value):
+    raise ValueError('Cannot coerce a Sequence')
+
+
+def _vrCoercers():
+    coercers = {}
+    for vr in ('AE', 'AS', 'CS', 'DA', 'DT', 'LO', 'LT', 'SH', 'ST', 'TM', 'UC', 'UI', 'UR', 'UT'):
+        coercers[vr] = _coerceAs(str)
+    for vr in ('AT', 'IS', 'SL', 'SS', 'SV', 'UL', 'US', 'UV'):
+        coercers[vr] = _coerceAs(int)
+    for vr in ('DS', 'FD', 'FL'):
+        coercers[vr] = _coerceAs(float)
+    coercers['PN'] = _coercePersonName
+    # A pydicom Sequence is a nested list of Datasets, which is too complicated to flatten now
+    coercers['SQ'] = _coerceSequence
+    return coercers
+
+
+#: The conversion of single values of each VR. The value types which pydicom
+#: may use besides the usual one (e.g. None for empty values) and other VRs
+#: (binary and ambiguous ones) fall back to ``_coerceValue``.
+_VR_COERCERS = _vrCoercers()
+
+#: The key used in the metadata for each tag which was seen, since looking up
+#: keywords in the DICOM dictionary is slow.
+_TAG_KEYS = {}
+_TAG_KEYS_MAX_SIZE = 100000
+
+
+def _coerceElementValue(value, vr):
+    """
+    Like ``_coerceValue``, but using a single lookup of the conversion for the
+    VR of the data element.
+    """
+    if isinstance(value, pydicom.sequence.Sequence):
+        # Even an empty Sequence is omitted, whatever its VR
+        return _coerceSequence(value)
+    coerce = _VR_COERCERS.get(vr, _coerceValue)
+    if isinstance(value, pydicom.multival.MultiValue):
+        return [coerce(v) for v in value]
+    return coerce(value)
+
+
+def _getTagKeys(tag):
+    """
+    Return the keyword of a tag, or an empty string, and the key used for the
+    tag in the metadata.
+    """
+    tagKeys = _TAG_KEYS.get(tag)
+    if tagKeys is None:
+        keyword = pydicom.datadict.keyword_for_tag(tag)
+        # Use "keyword" instead of "name", as the keyword is a simpler and more uniform string
+        # See: http://dicom.nema.org/medical/dicom/current/output/html/part06.html#table_6-1
+        # For unknown / private tags, allow pydicom to create a string representation like
+        # "(0013, 1010)"
+        tagKey = keyword if keyword and not tag.is_private else str(tag)
+        tagKeys = (keyword, tagKey)
+        if len(_TAG_KEYS) < _TAG_KEYS_MAX_SIZE:
+            _TAG_KEYS[tag] = tagKeys
+    return tagKeys
+
+
+def _coerceMetadata(dataset, tagFilter=None):
+    """
+    :param tagFilter: If given, a ``TagFilter`` deciding which elements are
+        kept. Elements are filtered by tag before their value is read. The
+        ``DICOM_STRUCTURE_KEYS`` are always kept; ``_storedMetadata`` applies
+        the filter to them.
+    """
     metadata = {}
 
     # Use simple iteration instead of "dataset.iterall", to prevent recursing into Sequences, which
@@ -179,74 +1129,651 @@ def _coerceMetadata(dataset):
     #       yield dataset[tag]
     # but we want to ignore certain exceptions of delayed data loading, so
     # we iterate through the dataset ourselves.
+    # Only format values as text when their length is limited
+    checkValueLength = tagFilter is not None and tagFilter.maxValueLength
     for tag in dataset.keys():
+        if tag.element == 0:
+            # Skip Group Length tags, which are always element 0x0000
+            continue
+        keyword, tagKey = _getTagKeys(tag)
+        structural = keyword in DICOM_STRUCTURE_KEYS
+        if tagFilter is not None and not structural and not tagFilter.allowsTag(tag, keyword):
+            continue
         try:
             dataElement = dataset[tag]
         except OSError:
             continue
-        if dataElement.tag.element == 0:
-            # Skip Group Length tags, which are always element 0x0000
-            continue
-
-        # Use "keyword" instead of "name", as the keyword is a simpler and more uniform string
-        # See: http://dicom.nema.org/medical/dicom/current/output/html/part06.html#table_6-1
-        # For unknown / private tags, allow pydicom to create a string representation like
-        # "(0013, 1010)"
-        tagKey = dataElement.keyword \
-            if dataElement.keyword and not dataElement.tag.is_private else \
-            str(dataElement.tag)
 
         try:
-            tagValue = _coerceValue(dataElement.value)
+            tagValue = _coerceElementValue(dataElement.value, dataElement.VR)
         except ValueError:
             # Omit tags where the value cannot be coerced to JSON-encodable types
             continue
+        if checkValueLength and not structural and \
+                not tagFilter.allowsValueText(_searchString(tagValue)):
+            continue
 
         metadata[tagKey] = tagValue
 
     return metadata
 
 
-def _parseFile(f):
+def _storedMetadata(dicomMeta, tagFilter=None):
+    """
+    Remove the ``DICOM_STRUCTURE_KEYS`` which the tag filter does not keep
+    from parsed metadata, once they were used to index the file.
+    """
+    if tagFilter is None:
+        return dicomMeta
+    dropped = {
+        key for key in DICOM_STRUCTURE_KEYS.intersection(dicomMeta)
+        if not tagFilter.allowsTag(pydicom.tag.Tag(key), key) or
+        not tagFilter.allowsValueText(_searchString(dicomMeta[key]))}
+    if not dropped:
+        return dicomMeta
+    return {key: value for key, value in dicomMeta.items() if key not in dropped}
+
+
+def _parseStream(fp, tagFilter=None):
     try:
-        # download file and try to parse dicom
-        with File().open(f) as fp:
-            dataset = pydicom.dcmread(
-                fp,
-                # don't read huge fields, esp. if this isn't even really dicom
-                defer_size=1024,
-                # don't read image data, just metadata
-                stop_before_pixels=True)
-            return _coerceMetadata(dataset)
+        dataset = pydicom.dcmread(
+            fp,
+            # don't read huge fields, esp. if this isn't even really dicom
+            defer_size=1024,
+            # don't read image data, just metadata
+            stop_before_pixels=True)
+        return _coerceMetadata(dataset, tagFilter)
     except pydicom.errors.InvalidDicomError:
         # if this error occurs, probably not a dicom file
         return None
 
 
+def _parseFile(f, counters=None, tagFilter=None):
+    """
+    Parse the DICOM metadata of a file, fetching only the byte ranges of its
+    header from the assetstore.
+
+    :param f: The file document.
+    :param counters: If given, a ``ReadCounters`` to which what was read from
+        the assetstore for this file is added.
+    :param tagFilter: If given, a ``TagFilter`` deciding which elements are kept.
+    :returns: The coerced metadata, or None if the file is not DICOM.
+    """
+    with HeaderReader(f) as fp:
+        dicomMeta = _parseStream(fp, tagFilter)
+    _recordRead(f, fp, counters)
+    return dicomMeta
+
+
+def _hasDicomPreamble(f):
+    """
+    Check whether a file starts with the DICOM preamble, without which
+    ``_parseStream`` does not parse it, reading only its first bytes.
+    """
+    if f.get('size', 0) < 132:
+        return False
+    with File().open(f) as fp:
+        fp.seek(128)
+        return fp.read(4) == b'DICM'
+
+
+def _recordRead(f, reader, counters):
+    logger.debug(
+        'Read %d of %d bytes in %d requests to parse DICOM file %s',
+        reader.bytesRead, f['size'], reader.requests, f['_id'])
+    if counters is not None:
+        counters.add(reader)
+
+
+def _parseContent(content, size, tagFilter=None):
+    """
+    Parse the DICOM metadata of a file from the first bytes of its content.
+    This is run by process pool workers, which have no database connection.
+
+    :raises HeaderTruncated: if the header extends beyond ``content``.
+    """
+    return _parseStream(PrefixBuffer(content, size), tagFilter)
+
+
+def _readAndParseFile(f, counters=None, tagFilter=None, processPool=None):
+    with HeaderReader(f) as reader:
+        length = reader.prefetchSize
+        while True:
+            reader.seek(0)
+            content = reader.read(length)
+            try:
+                dicomMeta = processPool.submit(
+                    _parseContent, content, f['size'], tagFilter).result()
+                break
+            except HeaderTruncated:
+                length *= 4
+    _recordRead(f, reader, counters)
+    return dicomMeta
+
+
+def _parseCacheKey(f, tagFilter=None):
+    """
+    Identify the content of a file and the elements which are kept from it:
+    if any of these change, the metadata stored in ``f['dicomCache']`` is out
+    of date.
+    """
+    return {
+        # Metadata cached before the DICOM_STRUCTURE_KEYS were always kept
+        # lacks them
+        'version': 2,
+        'sha512': f.get('sha512'),
+        'size': f['size'],
+        'updated': f.get('updated', f.get('created')),
+        'tagFilter': tagFilter.key if tagFilter is not None else None
+    }
+
+
+def _parseFileCached(f, counters=None, tagFilter=None, parse=_parseFile):
+    """
+    Return the DICOM metadata of a file, using ``parse`` only if the metadata
+    stored in the file document was computed from different content, then
+    storing the result in the file document.
+    """
+    key = _parseCacheKey(f, tagFilter)
+    cache = f.get('dicomCache')
+    if cache is not None and cache['key'] == key:
+        return cache['meta']
+
+    dicomMeta = parse(f, counters, tagFilter)
+    update = {'dicomCache': {
+        'key': key,
+        'meta': dicomMeta
+    }}
+    if dicomMeta is not None and _isMultiFrame(dicomMeta):
+        # Locate the frames now, so that they can be read one at a time
+        update['dicomFrames'] = {
+            'key': _parseCacheKey(f),
+            'table': _readFrameTable(f)
+        }
+    File().update({'_id': f['_id']}, {'$set': update}, multi=False)
+    return dicomMeta
+
+
+def _isMultiFrame(dicomMeta):
+    try:
+        return int(dicomMeta.get('NumberOfFrames') or 1) > 1
+    except (TypeError, ValueError):
+        return False
+
+
+def _readFrameTable(f):
+    """
+    Locate the frames of a file, reading only its header and the headers of
+    its fragments from the assetstore.
+
+    :returns: The frame table, or None if the frames cannot be located.
+    """
+    try:
+        with HeaderReader(f) as fp:
+            return frameTable(fp)
+    except (pydicom.errors.InvalidDicomError, struct.error, ValueError, EOFError):
+        return None
+
+
+def _getFrameTable(f, compute=True):
+    """
+    Get the frame table stored in a file document, if it is up to date.
+
+    :param compute: Whether to locate the frames and store them, if the file
+        has no up to date frame table, e.g. it was parsed before frame tables
+        were stored, or it is a single-frame file.
+    """
+    key = _parseCacheKey(f)
+    frames = f.get('dicomFrames')
+    if frames is not None and frames['key'] == key:
+        return frames['table']
+    if not compute:
+        return None
+    table = _readFrameTable(f)
+    File().update({'_id': f['_id']}, {'$set': {'dicomFrames': {
+        'key': key,
+        'table': table
+    }}}, multi=False)
+    return table
+
+
+def _frameRanges(table, frame):
+    frameCount = len(table['frames'])
+    if not 0 <= frame < frameCount:
+        raise RestException('The frame must be between 0 and %d.' % (frameCount - 1))
+    return table['frames'][frame]
+
+
+def _frameStream(f, ranges):
+    """
+    :returns: A function generating the bytes of a frame.
+    """
+    def stream():
+        for offset, length in ranges:
+            yield from File().download(
+                f, offset=offset, headers=False, endByte=offset + length)()
+    return stream
+
+
+_RENDER_CACHE = None
+_RENDER_CACHE_LOCK = threading.Lock()
+
+
+def _getRenderCache():
+    """
+    Get the ``RenderCache`` configured by the plugin settings, or None if it
+    is disabled.
+    """
+    global _RENDER_CACHE
+    path = Setting().get(PluginSettings.RENDER_CACHE_PATH)
+    maxSize = Setting().get(PluginSettings.RENDER_CACHE_SIZE)
+    if not maxSize:
+        return None
+    with _RENDER_CACHE_LOCK:
+        if _RENDER_CACHE is None or \
+                (_RENDER_CACHE.path, _RENDER_CACHE.maxSize) != (path, maxSize):
+            _RENDER_CACHE = RenderCache(path, maxSize)
+        return _RENDER_CACHE
+
+
+def _renderDicomFile(file, frame=0, window=None, level=None, size=None, encoding='png'):
+    """
+    Render a slice of a DICOM file, or get it from the render cache.
+
+    :returns: The encoded image.
+    """
+    cache = _getRenderCache()
+    if cache is not None:
+        key = RenderCache.key(
+            str(file['_id']), file.get('sha512'), file.get('updated', file.get('created')),
+            frame, window, level, size, encoding)
+        data = cache.get(key)
+        if data is not None:
+            return data
+
+    table = _getFrameTable(file, compute=False)
+    try:
+        if table is not None and len(table['frames']) > 1:
+            # Read the header and a single frame, rather than the whole file
+            ranges = _frameRanges(table, frame)
+            with HeaderReader(file) as fp:
+                header = pydicom.dcmread(fp, stop_before_pixels=True)
+            data = b''.join(_frameStream(file, ranges)())
+            dataset, frame = frameDataset(header, table, data), 0
+        else:
+            with File().open(file) as fp:
+                dataset = pydicom.dcmread(fp)
+        data = renderSlice(dataset, frame, window, level, size, encoding)
+    except pydicom.errors.InvalidDicomError:
+        raise RestException('The file is not a DICOM image.')
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError) as e:
+        # No pixel data, an unsupported transfer syntax or a missing frame
+        raise RestException('Could not render the file: %s' % e)
+
+    if cache is not None:
+        cache.put(key, data)
+    return data
+
+
+_PARSE_QUEUE = None
+_PARSE_QUEUE_LOCK = threading.Lock()
+
+
+def _getParseQueue():
+    """
+    Get the queue of items to parse, with as many workers as set by the
+    plugin settings.
+    """
+    global _PARSE_QUEUE
+    workers = Setting().get(PluginSettings.UPLOAD_WORKERS)
+    with _PARSE_QUEUE_LOCK:
+        if _PARSE_QUEUE is None:
+            _PARSE_QUEUE = ParseQueue(_parseQueuedItem, workers)
+        else:
+            _PARSE_QUEUE.setWorkers(workers)
+        return _PARSE_QUEUE
+
+
+def _queueItem(itemId):
+    """
+    Queue an item to be parsed in the background, unless it is already queued.
+    """
+    Item().update({'_id': itemId}, {'$set': {'dicomProcessing': {
+        'state': 'queued',
+        'queued': datetime.datetime.utcnow()
+    }}}, multi=False)
+    _getParseQueue().put(itemId)
+
+
+def _parseQueuedItem(itemId):
+    """
+    Parse all the files of a queued item, most of which were parsed already
+    if the item was parsed before, and record the outcome in its
+    ``dicomProcessing`` field, unless the item was queued again meanwhile.
+    """
+    item = Item().load(itemId, force=True)
+    if item is None:
+        # Removed since it was queued
+        return
+    processing = dict(item.get('dicomProcessing') or {}, state='running')
+    processing['started'] = datetime.datetime.utcnow()
+    processing.pop('error', None)
+    # The item is saved as a whole once parsed, so keep its status in it
+    item['dicomProcessing'] = processing
+    Item().update({'_id': itemId}, {'$set': {'dicomProcessing': processing}}, multi=False)
+    startTime = time.time()
+    try:
+        _makeDicomItem(item)
+    except Exception as e:
+        processing.update(state='error', error=str(e))
+        raise
+    else:
+        processing['state'] = 'success'
+    finally:
+        processing['finished'] = datetime.datetime.utcnow()
+        processing['seconds'] = time.time() - startTime
+        if _getParseQueue().isQueued(itemId):
+            # Saving the item may have overwritten the queued state
+            processing['state'] = 'queued'
+        # Otherwise, a queued state written since the item was saved is kept
+        Item().update({
+            '_id': itemId,
+            'dicomProcessing.state': 'running',
+            'dicomProcessing.started': processing['started']
+        }, {'$set': {'dicomProcessing': processing}}, multi=False)
+    events.trigger('dicom_viewer.upload.success')
+
+
+def _resumeQueuedItems():
+    """
+    Queue again the items which were queued or being parsed when the server
+    stopped.
+    """
+    for item in Item().find(
+            {'dicomProcessing.state': {'$in': ['queued', 'running']}}, fields=['_id']):
+        _getParseQueue().put(item['_id'])
+
+
+def _getTagFilter():
+    """
+    Build the ``TagFilter`` configured by the plugin settings.
+    """
+    return TagFilter(
+        allow=Setting().get(PluginSettings.TAG_ALLOW_LIST),
+        deny=Setting().get(PluginSettings.TAG_DENY_LIST),
+        includePrivate=Setting().get(PluginSettings.INCLUDE_PRIVATE_TAGS),
+        maxValueLength=Setting().get(PluginSettings.MAX_VALUE_LENGTH))
+
+
+def _boundedMap(executor, func, iterable, window):
+    """
+    Like ``executor.map``, but never have more than ``window`` calls in flight,
+    so that iterating over a large item does not queue every file at once.
+    Results are yielded in the order of the input.
+    """
+    pending = collections.deque()
+    for value in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, value))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _parseFiles(files, workers=1, pool='thread', counters=None, tagFilter=None):
+    """
+    Parse the DICOM metadata of several files, yielding ``(file, dicomMeta)``
+    pairs in the same order as ``files``. ``dicomMeta`` is None for files which
+    are not DICOM. Files whose content did not change since they were last
+    parsed are not parsed again.
+
+    :param files: An iterable of file documents.
+    :param workers: The number of files to parse concurrently. With a single
+        worker, the files are parsed sequentially in the calling thread.
+    :param pool: Either "thread", to read and parse each file in a worker
+        thread, or "process", to read each file in a worker thread and decode
+        it in a separate process.
+    :param counters: If given, a ``ReadCounters`` to which what was read from
+        the assetstore is added.
+    :param tagFilter: The ``TagFilter`` of the plugin settings, if it was
+        already built.
+    """
+    if tagFilter is None:
+        tagFilter = _getTagFilter()
+    if workers <= 1:
+        for file in files:
+            yield file, _parseFileCached(file, counters, tagFilter)
+        return
+
+    # Keep each worker busy with a spare task queued behind its current one
+    window = workers * 2
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as threadPool:
+        if pool == 'process':
+            # Forking a server process which holds database connections is unsafe
+            processPool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            with processPool:
+                parse = functools.partial(_readAndParseFile, processPool=processPool)
+                yield from _boundedMap(
+                    threadPool, lambda f: (f, _parseFileCached(f, counters, tagFilter, parse)),
+                    files, window)
+        else:
+            yield from _boundedMap(
+                threadPool, lambda f: (f, _parseFileCached(f, counters, tagFilter)),
+                files, window)
+
+
 def _uploadHandler(event):
     """
     Whenever an additional file is uploaded to a "DICOM item", remove any
-    DICOM metadata that is no longer common to all DICOM files in the item.
+    DICOM metadata that is no longer common to all DICOM files in the item or
+    in its series.
+
+    When uploads are processed asynchronously, the item is queued to be
+    parsed in the background instead.
     """
     file = event.info['file']
-    fileMetadata = _parseFile(file)
+    if not file.get('itemId'):
+        # e.g. a cached volume, which is attached to an item
+        return
+    if Setting().get(PluginSettings.UPLOAD_PROCESSING) == 'async':
+        if _hasDicomPreamble(file):
+            _queueItem(file['itemId'])
+        return
+    tagFilter = _getTagFilter()
+    fileMetadata = _parseFileCached(file, tagFilter=tagFilter)
     if fileMetadata is None:
         return
-    item = Item().load(file['itemId'], force=True)
-    if 'dicom' in item:
-        item['dicom']['meta'] = _removeUniqueMetadata(item['dicom']['meta'], fileMetadata)
-    else:
-        # In this case the uploaded file is the first of the item
-        item['dicom'] = {
+    fileData = _extractFileData(file, fileMetadata)
+    fileData['dicom']['SlicePosition'] = _slicePositions(
+        [fileMetadata.get('ImagePositionPatient')],
+        [fileMetadata.get('ImageOrientationPatient')])[0]
+    fileMetadata = _storedMetadata(fileMetadata, tagFilter)
+
+    # Several files of the same item may be processed at once (e.g. by several
+    # server processes), so the item is only changed with atomic operators.
+    # If this is the first DICOM file of the item, its metadata is the common
+    # metadata.
+    Item().update({'_id': file['itemId'], 'dicom': {'$exists': False}}, {'$set': {
+        'dicom': {
             'meta': fileMetadata,
-            'files': []
-        }
-    item['dicom']['files'].append(_extractFileData(file, fileMetadata))
-    item['dicom']['files'].sort(key=_getDicomFileSortKey)
-    Item().save(item)
+            'files': [],
+            'series': []
+        },
+        'dicomSummary': _dicomSummary(fileMetadata, 0, 0),
+        'dicomSearch': _searchTokens(fileMetadata)
+    }}, multi=False)
+    # Likewise, if this is the first file of its series. The series of items
+    # parsed before they were indexed are left alone.
+    uid = fileData['dicom']['SeriesInstanceUID']
+    Item().update({'_id': file['itemId'], 'dicom.series': {
+        '$exists': True,
+        '$not': {'$elemMatch': {'SeriesInstanceUID': uid}}
+    }}, {
+        '$push': {'dicom.series': {
+            '$each': [_newDicomSeries(fileData, fileMetadata)],
+            '$sort': DICOM_SERIES_SORT
+        }},
+        '$inc': {'dicomSummary.series': 1}
+    }, multi=False)
+
+    # The common metadata only ever loses keys, so keys which another upload
+    # removes after this read are simply unset again.
+    item = Item().load(file['itemId'], force=True, fields=[
+        'dicom.meta', 'dicom.series.SeriesInstanceUID', 'dicom.series.meta'])
+    uniqueKeys = _uniqueMetadataKeys(item['dicom']['meta'], fileMetadata)
+    update = {'$push': {'dicom.files': {
+        '$each': [fileData],
+        '$sort': DICOM_FILES_SORT
+    }}, '$inc': {'dicomSummary.files': 1}, '$unset': {}}
+    if uniqueKeys:
+        update['$unset'] = {'dicom.meta.%s' % key: '' for key in uniqueKeys}
+        update['$unset'].update({
+            'dicomSummary.%s' % key: '' for key in uniqueKeys if key in DICOM_SUMMARY_KEYS})
+    arrayFilters = None
+    if 'series' in item['dicom']:
+        seriesMeta = next(
+            series['meta'] for series in item['dicom']['series']
+            if series['SeriesInstanceUID'] == uid)
+        update['$inc']['dicom.series.$[series].fileCount'] = 1
+        update['$unset'].update({
+            'dicom.series.$[series].meta.%s' % key: ''
+            for key in _uniqueMetadataKeys(seriesMeta, fileMetadata)})
+        arrayFilters = [{'series.SeriesInstanceUID': uid}]
+    if not update['$unset']:
+        del update['$unset']
+    previous = Item().collection.find_one_and_update(
+        {'_id': item['_id']}, update, array_filters=arrayFilters, projection=[
+            'dicom.meta', 'dicom.files.dicom.SeriesInstanceUID',
+            'dicom.files.dicom.SlicePosition'])
+
+    if arrayFilters:
+        # Describe the spacing of the series with this file. If another file
+        # was added since, this is left to the upload of the last one, which
+        # sees all of them.
+        slicePositions = [fileData['dicom']['SlicePosition']] + [
+            f['dicom'].get('SlicePosition') for f in previous['dicom']['files']
+            if f['dicom'].get('SeriesInstanceUID') == uid]
+        Item().update({'_id': item['_id'], 'dicom.series': {'$elemMatch': {
+            'SeriesInstanceUID': uid,
+            'fileCount': len(slicePositions)
+        }}}, {'$set': {
+            'dicom.series.$.geometry': _seriesGeometry(slicePositions)
+        }}, multi=False)
+
+    if uniqueKeys:
+        # Remove the search tokens which only came from the keys that this
+        # update actually removed; the result does not depend on the order in
+        # which concurrent uploads are applied.
+        previousMeta = previous['dicom']['meta']
+        currentMeta = {k: v for k, v in previousMeta.items() if k not in uniqueKeys}
+        removedTokens = set(_searchTokens(previousMeta)) - set(_searchTokens(currentMeta))
+        if removedTokens:
+            Item().update({'_id': item['_id']}, {
+                '$pullAll': {'dicomSearch': sorted(removedTokens)}
+            }, multi=False)
+    _FACET_CACHE.clear()
     events.trigger('dicom_viewer.upload.success')
 
 
+def _dicomSummary(dicomMeta, fileCount, seriesCount=None):
+    """
+    Build the compact description of a DICOM item which is included in item
+    listings.
+    """
+    summary = {key: dicomMeta[key] for key in DICOM_SUMMARY_KEYS if key in dicomMeta}
+    summary['files'] = fileCount
+    if seriesCount is not None:
+        summary['series'] = seriesCount
+    return summary
+
+
+def _searchString(value):
+    """
+    Format a metadata value the way JavaScript's ``toString`` would, which is
+    what the "dicom" search mode has always matched against.
+    """
+    if isinstance(value, list):
+        return ','.join(_searchString(v) for v in value)
+    if isinstance(value, float):
+        if value.is_integer() and abs(value) < 1e21:
+            return str(int(value))
+        # JavaScript does not zero-pad exponents
+        return re.sub(r'e([+-])0*(?=\d)', r'e\1', repr(value))
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+
+def _searchTokens(dicomMeta):
+    """
+    Flatten DICOM metadata into the sorted, lowercase keys and values which are
+    stored as ``item['dicomSearch']`` and matched by the "dicom" search mode.
+    """
+    tokens = set()
+    for key, value in dicomMeta.items():
+        tokens.add(key.lower()[:DICOM_SEARCH_MAX_TOKEN_LENGTH])
+        tokens.add(_searchString(value).lower()[:DICOM_SEARCH_MAX_TOKEN_LENGTH])
+    return sorted(tokens)
+
+
+def _addMissingSearchTokens():
+    """
+    Index and summarize the DICOM items again, e.g. those which were parsed
+    before their search tokens and their summary were stored, and drop the
+    copies of their files which their series used to hold. This scans every
+    DICOM item, so it only runs when ``DICOM_SEARCH_VERSION`` changes.
+    """
+    for item in Item().find({'dicom': {'$exists': True}}, fields=['dicom']):
+        dicomMeta = item['dicom'].get('meta') or {}
+        update = {
+            'dicomSummary': _dicomSummary(
+                dicomMeta, len(item['dicom'].get('files') or []),
+                len(item['dicom']['series']) if 'series' in item['dicom'] else None),
+            'dicomSearch': _searchTokens(dicomMeta)
+        }
+        if any('files' in series for series in item['dicom'].get('series', [])):
+            update['dicom.series'] = [
+                dict({key: value for key, value in series.items() if key != 'files'},
+                     fileCount=len(series['files']))
+                for series in item['dicom']['series']]
+        Item().update({'_id': item['_id']}, {'$set': update})
+
+
+def _migrateSearchTokens():
+    """
+    Index the DICOM items again if they were indexed by an older version of
+    the plugin, once.
+    """
+    if Setting().get(PluginSettings.SEARCH_VERSION) < DICOM_SEARCH_VERSION:
+        _addMissingSearchTokens()
+        Setting().set(PluginSettings.SEARCH_VERSION, DICOM_SEARCH_VERSION)
+
+
+#: The folders which each user can access, for searches.
+_ACCESSIBLE_FOLDERS = AccessibleFolders()
+
+#: The counts of "GET /item/dicom/facets", which are cleared whenever DICOM
+#: metadata is written.
+_FACET_CACHE = FacetCache()
+
+
+def _clearSearchCaches(event=None):
+    """Forget which folders users can access, and what they can count."""
+    _ACCESSIBLE_FOLDERS.clear()
+    _FACET_CACHE.clear()
+
+
+def _dicomSearchQuery(query):
+    """
+    Build the MongoDB query of the items having a key or a value containing
+    the query, case-insensitively, within its first
+    ``DICOM_SEARCH_MAX_TOKEN_LENGTH`` characters.
+    """
+    # Match the indexed tokens, rather than running JavaScript against every item
+    return {'dicomSearch': {'$regex': re.escape(query.lower())}}
+
+
 def dicomSubstringSearchHandler(query, types, user=None, level=None, limit=0, offset=0):
     """
     Provide a substring search on both keys and values.
@@ -256,30 +1783,8 @@ def dicomSubstringSearchHandler(query, types, user=None, level=None, limit=0, of
     if not isinstance(query, str):
         raise RestException('The search query must be a string.')
 
-    jsQuery = """
-        function() {
-            var queryKey = %(query)s.toLowerCase();
-            var queryValue = queryKey;
-            var dicomMeta = obj.dicom.meta;
-            return Object.keys(dicomMeta).some(
-                function(key) {
-                    return (key.toLowerCase().indexOf(queryKey) !== -1)  ||
-                        dicomMeta[key].toString().toLowerCase().indexOf(queryValue) !== -1;
-                })
-            }
-    """ % {
-        # This could eventually be a separately-defined key and value
-        'query': json.dumps(query)
-    }
-
-    # Sort the documents inside MongoDB
-    cursor = Item().find({'dicom': {'$exists': True}, '$where': jsQuery})
-    # Filter the result
-    result = {
-        'item': [
-            Item().filter(doc, user)
-            for doc in Item().filterResultsByPermission(cursor, user, level, limit, offset)
-        ]
-    }
-
-    return result
+    # Filter on the accessible folders in MongoDB, rather than on each result
+    items, _ = searchItems(
+        _dicomSearchQuery(query), _ACCESSIBLE_FOLDERS, user, level,
+        limit=limit, offset=offset)
+    return {'item': [Item().filter(doc, user) for doc in items]}
@@ -0,0 +1,194 @@
+import copy
+import struct
+
+import pydicom
+import pydicom.encaps
+
+#: The tag of the pixel data element, as it is stored in little endian files.
+PIXEL_DATA_TAG = struct.pack('<HH', 0x7FE0, 0x0010)
+
+#: Item and sequence delimiter tags of encapsulated pixel data.
+ITEM_TAG = (0xFFFE, 0xE000)
+SEQUENCE_DELIMITER_TAG = (0xFFFE, 0xE0DD)
+
+#: The value representations which pixel data may be stored with, in explicit
+#: VR files.
+PIXEL_DATA_VRS = {b'OB', b'OW', b'OD', b'OF', b'OL', b'OV', b'UN'}
+
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+#: The media types of the frames of each compressed transfer syntax.
+FRAME_MEDIA_TYPES = {
+    '1.2.840.10008.1.2.4.50': 'image/jpeg',
+    '1.2.840.10008.1.2.4.51': 'image/jpeg',
+    '1.2.840.10008.1.2.4.57': 'image/jpeg',
+    '1.2.840.10008.1.2.4.70': 'image/jpeg',
+    '1.2.840.10008.1.2.4.80': 'image/jls',
+    '1.2.840.10008.1.2.4.81': 'image/jls',
+    '1.2.840.10008.1.2.4.90': 'image/jp2',
+    '1.2.840.10008.1.2.4.91': 'image/jp2',
+    '1.2.840.10008.1.2.4.201': 'image/jphc',
+    '1.2.840.10008.1.2.4.202': 'image/jphc',
+    '1.2.840.10008.1.2.4.203': 'image/jphc',
+    '1.2.840.10008.1.2.5': 'image/dicom-rle'
+}
+
+#: The transfer syntaxes whose pixel data is not where it is in the file, or
+#: not in little endian.
+UNSUPPORTED_TRANSFER_SYNTAXES = {
+    '1.2.840.10008.1.2.1.99',  # Deflated Explicit VR Little Endian
+    '1.2.840.10008.1.2.2'  # Explicit VR Big Endian
+}
+
+
+def _transferSyntax(dataset):
+    fileMeta = getattr(dataset, 'file_meta', None)
+    return str(fileMeta.get('TransferSyntaxUID', '')) if fileMeta is not None else ''
+
+
+def _frameCount(dataset):
+    try:
+        return max(int(dataset.get('NumberOfFrames') or 1), 1)
+    except (TypeError, ValueError):
+        return 1
+
+
+def _readItemHeader(fp):
+    data = fp.read(8)
+    if len(data) < 8:
+        return None, 0
+    group, element, length = struct.unpack('<HHI', data)
+    return (group, element), length
+
+
+def _fragments(fp):
+    """
+    List the ``(offset, length)`` of the fragments of encapsulated pixel data,
+    reading only their item headers.
+    """
+    fragments = []
+    while True:
+        tag, length = _readItemHeader(fp)
+        if tag != ITEM_TAG or length == UNDEFINED_LENGTH:
+            return fragments
+        fragments.append((fp.tell(), length))
+        fp.seek(length, 1)
+
+
+def _encapsulatedFrames(dataset, fp, frameCount):
+    tag, length = _readItemHeader(fp)
+    if tag != ITEM_TAG:
+        return None
+    basicOffsets = list(struct.unpack('<%dI' % (length // 4), fp.read(length)))
+    firstFragment = fp.tell()
+
+    if 'ExtendedOffsetTable' in dataset and 'ExtendedOffsetTableLengths' in dataset:
+        # One fragment per frame, whose positions are given up front
+        offsets = struct.unpack('<%dQ' % frameCount, dataset.ExtendedOffsetTable)
+        lengths = struct.unpack('<%dQ' % frameCount, dataset.ExtendedOffsetTableLengths)
+        return [[[firstFragment + offset + 8, length]]
+                for offset, length in zip(offsets, lengths)]
+
+    fragments = _fragments(fp)
+    if frameCount == 1:
+        return [[list(fragment) for fragment in fragments]] if fragments else None
+    if len(basicOffsets) == frameCount:
+        # The Basic Offset Table gives the position of the first item of each frame
+        starts = [firstFragment + offset + 8 for offset in basicOffsets]
+        frames = []
+        for start, end in zip(starts, starts[1:] + [float('inf')]):
+            frames.append([[offset, length] for offset, length in fragments
+                           if start <= offset < end])
+        return frames if all(frames) else None
+    if len(fragments) == frameCount:
+        return [[list(fragment)] for fragment in fragments]
+    # Without an offset table, the fragments of each frame cannot be told apart
+    return None
+
+
+def _nativeFrames(dataset, length, start, frameCount):
+    bitsAllocated = int(dataset.get('BitsAllocated', 0))
+    if not bitsAllocated or bitsAllocated % 8:
+        # Bit-packed frames do not start on a byte boundary
+        return None
+    frameLength = (int(dataset.get('Rows', 0)) * int(dataset.get('Columns', 0)) *
+                   int(dataset.get('SamplesPerPixel', 1)) * bitsAllocated // 8)
+    if not frameLength or frameLength * frameCount > length:
+        return None
+    return [[[start + index * frameLength, frameLength]] for index in range(frameCount)]
+
+
+def frameTable(fp):
+    """
+    Locate the frames of a DICOM file, reading its header and, for compressed
+    pixel data, the headers of its fragments, but none of the frames.
+
+    :param fp: A seekable file-like object, e.g. a ``HeaderReader``.
+    :returns: A dict with the ``transferSyntax`` of the file, whether its
+        pixel data is ``encapsulated``, and its ``frames``: for each frame, a
+        list of ``[offset, length]`` byte ranges of the file, whose
+        concatenation is the frame. None if the frames cannot be located.
+    """
+    dataset = pydicom.dcmread(fp, defer_size=1024, stop_before_pixels=True)
+    transferSyntax = _transferSyntax(dataset)
+    if transferSyntax in UNSUPPORTED_TRANSFER_SYNTAXES:
+        return None
+
+    # Parsing stopped at the pixel data element
+    if fp.read(4) != PIXEL_DATA_TAG:
+        return None
+    vr = fp.read(4)
+    if vr[:2] in PIXEL_DATA_VRS and vr[2:] == b'\0\0':
+        length, = struct.unpack('<I', fp.read(4))
+    else:
+        # Implicit VR: these bytes were the length
+        length, = struct.unpack('<I', vr)
+
+    frameCount = _frameCount(dataset)
+    if length == UNDEFINED_LENGTH:
+        frames = _encapsulatedFrames(dataset, fp, frameCount)
+    else:
+        frames = _nativeFrames(dataset, length, fp.tell(), frameCount)
+    if frames is None:
+        return None
+    return {
+        'transferSyntax': transferSyntax,
+        'encapsulated': length == UNDEFINED_LENGTH,
+        'frames': frames
+    }
+
+
+def frameMediaType(table):
+    """
+    :returns: The Content-Type of the frames of a file, including their
+        transfer syntax, like DICOMweb frame retrieval does.
+    """
+    if table['encapsulated']:
+        mediaType = FRAME_MEDIA_TYPES.get(table['transferSyntax'], 'application/octet-stream')
+    else:
+        mediaType = 'application/octet-stream'
+    return '%s; transfer-syntax=%s' % (mediaType, table['transferSyntax'])
+
+
+def frameDataset(dataset, table, data):
+    """
+    Build a single-frame dataset from the header of a multi-frame file and
+    the data of one of its frames, so that only this frame is decoded.
+
+    :param dataset: The header of the file, read without its pixel data.
+    :param table: The frame table of the file, from ``frameTable``.
+    :param data: The bytes of the frame.
+    """
+    dataset = copy.deepcopy(dataset)
+    for keyword in ('ExtendedOffsetTable', 'ExtendedOffsetTableLengths'):
+        if keyword in dataset:
+            del dataset[keyword]
+    dataset.NumberOfFrames = 1
+    if table['encapsulated']:
+        dataset.PixelData = pydicom.encaps.encapsulate([data])
+        dataset['PixelData'].VR = 'OB'
+        dataset['PixelData'].is_undefined_length = True
+    else:
+        dataset.PixelData = data
+        dataset['PixelData'].VR = 'OW' if int(dataset.get('BitsAllocated', 8)) > 8 else 'OB'
+    return dataset
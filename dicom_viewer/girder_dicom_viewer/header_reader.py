@@ -0,0 +1,156 @@
+import io
+import os
+import threading
+
+from girder.models.file import File
+
+#: The number of bytes fetched by the first read of a file.
+PREFETCH_SIZE = 64 * 1024
+
+
+class HeaderTruncated(Exception):
+    """
+    Raised by a ``PrefixBuffer`` when parsing needs more bytes than were
+    read ahead.
+    """
+
+
+class HeaderReader:
+    """
+    A read-only, seekable file-like object over a Girder file, which fetches
+    byte ranges from the assetstore on demand, instead of streaming the file
+    from the current position to its end like ``File().open`` does.
+
+    Fetched bytes are kept in memory as a few contiguous segments. A read
+    which runs past the end of a segment extends it, fetching twice as many
+    bytes as the previous extension; a read elsewhere (e.g. a deferred value
+    which was skipped over) fetches a new segment of ``prefetchSize`` bytes.
+    When parsing stops before the pixel data, the pixel data is therefore
+    never fetched, except for what falls within the last read-ahead.
+
+    The ``bytesRead`` and ``requests`` attributes count what was fetched from
+    the assetstore for this file, and ``ranges`` lists the ``(start, end)``
+    byte ranges which were fetched.
+    Usage:
+        with HeaderReader(file) as fp:
+            dataset = pydicom.dcmread(fp, stop_before_pixels=True)
+    """
+
+    def __init__(self, file, prefetchSize=PREFETCH_SIZE):
+        self.prefetchSize = prefetchSize
+        self.bytesRead = 0
+        self.requests = 0
+        self.ranges = []
+        self.closed = False
+        self._file = file
+        self._size = file['size']
+        self._pos = 0
+        self._growSize = prefetchSize
+        # A list of [start, bytes] segments of the file which were fetched
+        self._segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _fetch(self, offset, length):
+        endByte = min(offset + length, self._size)
+        if endByte <= offset:
+            return b''
+        data = b''.join(File().download(
+            self._file, offset=offset, headers=False, endByte=endByte)())
+        self.bytesRead += len(data)
+        self.requests += 1
+        self.ranges.append((offset, offset + len(data)))
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._size - self._pos
+        size = max(min(size, self._size - self._pos), 0)
+
+        for segment in self._segments:
+            start, data = segment
+            if start <= self._pos <= start + len(data):
+                missing = self._pos + size - (start + len(data))
+                if missing > 0:
+                    self._growSize *= 2
+                    data += self._fetch(start + len(data), max(missing, self._growSize))
+                    segment[1] = data
+                break
+        else:
+            start = self._pos
+            data = self._fetch(start, max(size, self.prefetchSize))
+            self._segments.append([start, data])
+
+        offset = self._pos - start
+        result = data[offset:offset + size]
+        self._pos += len(result)
+        return result
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        elif whence == os.SEEK_END:
+            self._pos = self._size + offset
+        self._pos = max(self._pos, 0)
+        return self._pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.closed = True
+        self._segments = []
+
+
+class PrefixBuffer(io.BytesIO):
+    """
+    An in-memory file-like object over the first bytes of a file, which raises
+    ``HeaderTruncated`` when a read goes past them, instead of reporting the end
+    of the file, unless they are the whole file.
+
+    This allows parsing a header in a process which cannot read from the
+    assetstore: the caller reads a prefix of the file, and retries with a
+    longer one when ``HeaderTruncated`` is raised.
+    """
+
+    def __init__(self, prefix, size):
+        super().__init__(prefix)
+        self._length = len(prefix)
+        self._complete = self._length >= size
+
+    def read(self, size=-1):
+        if not self._complete and (
+                size is None or size < 0 or self.tell() + size > self._length):
+            raise HeaderTruncated()
+        return super().read(size)
+
+
+class ReadCounters:
+    """
+    Thread-safe totals of what was read from the assetstore while parsing
+    several files.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytesRead = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def add(self, reader):
+        with self._lock:
+            self.files += 1
+            self.bytesRead += reader.bytesRead
+            self.requests += reader.requests
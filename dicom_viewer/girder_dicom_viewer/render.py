@@ -0,0 +1,87 @@
+import io
+
+import numpy as np
+from PIL import Image
+import pydicom.multival
+
+#: The image formats which slices can be rendered to, and their MIME types.
+RENDER_FORMATS = {
+    'png': 'image/png',
+    'webp': 'image/webp'
+}
+
+
+def _firstValue(value):
+    """WindowCenter and WindowWidth may hold several windows; use the first one."""
+    if isinstance(value, (pydicom.multival.MultiValue, list, tuple)):
+        value = value[0] if len(value) else None
+    return float(value) if value not in (None, '') else None
+
+
+def _grayscaleImage(dataset, pixels, window, level):
+    pixels = pixels.astype(np.float64)
+    slope = float(dataset.get('RescaleSlope', 1) or 1)
+    intercept = float(dataset.get('RescaleIntercept', 0) or 0)
+    pixels = pixels * slope + intercept
+
+    if window is None:
+        window = _firstValue(dataset.get('WindowWidth'))
+    if level is None:
+        level = _firstValue(dataset.get('WindowCenter'))
+    if window is None or level is None:
+        # Fit the window to the values of the slice
+        low, high = float(pixels.min()), float(pixels.max())
+        window = high - low if window is None else window
+        level = (high + low) / 2 if level is None else level
+    window = max(window, 1e-6)
+
+    pixels = np.clip((pixels - (level - window / 2)) / window, 0, 1) * 255
+    if dataset.get('PhotometricInterpretation') == 'MONOCHROME1':
+        pixels = 255 - pixels
+    return Image.fromarray(np.rint(pixels).astype(np.uint8), 'L')
+
+
+def _colorImage(pixels):
+    if pixels.dtype != np.uint8:
+        maximum = float(pixels.max()) or 1
+        pixels = np.rint(pixels.astype(np.float64) * (255 / maximum)).astype(np.uint8)
+    return Image.fromarray(pixels, 'RGB')
+
+
+def renderSlice(dataset, frame=0, window=None, level=None, size=None, imageFormat='png'):
+    """
+    Render a frame of a DICOM dataset to a compressed image.
+
+    :param dataset: A pydicom dataset, including its pixel data.
+    :param frame: The index of the frame, for multi-frame datasets.
+    :param window: The window width, in rescaled units. By default, the
+        WindowWidth of the dataset, or its range of values.
+    :param level: The window center, in rescaled units. By default, the
+        WindowCenter of the dataset, or the middle of its range of values.
+    :param size: If given, the image is scaled down to fit within a square of
+        this many pixels, preserving its aspect ratio.
+    :param imageFormat: One of ``RENDER_FORMATS``.
+    :returns: The encoded image.
+    :raises ValueError: if the frame does not exist.
+    """
+    pixels = dataset.pixel_array
+    frames = int(dataset.get('NumberOfFrames', 1) or 1)
+    if not 0 <= frame < frames:
+        raise ValueError('The frame must be between 0 and %d.' % (frames - 1))
+    if frames > 1:
+        pixels = pixels[frame]
+
+    if int(dataset.get('SamplesPerPixel', 1)) == 1:
+        image = _grayscaleImage(dataset, pixels, window, level)
+    else:
+        # Window and level do not apply to color images
+        image = _colorImage(pixels)
+    if size:
+        image.thumbnail((size, size), Image.LANCZOS)
+
+    output = io.BytesIO()
+    if imageFormat == 'webp':
+        image.save(output, format='WEBP', quality=90)
+    else:
+        image.save(output, format='PNG')
+    return output.getvalue()
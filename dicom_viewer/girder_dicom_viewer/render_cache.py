@@ -0,0 +1,90 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+class RenderCache:
+    """
+    A bounded on-disk cache of rendered images, which evicts the least
+    recently used ones once their total size exceeds ``maxSize`` bytes.
+
+    Each entry is a file of the cache directory, named after the hash of its
+    key. The recency of entries is kept in memory, and in the modification
+    time of their file, so that it survives a restart.
+    """
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        self._lock = threading.Lock()
+        # The size of each entry, from the least to the most recently used
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+        os.makedirs(path, exist_ok=True)
+        existing = []
+        for entry in os.scandir(path):
+            if entry.is_file() and not entry.name.startswith('.'):
+                stat = entry.stat()
+                existing.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(existing):
+            self._entries[name] = size
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def key(*parts):
+        """Build the key of an entry from JSON-serializable parts."""
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+    def get(self, key):
+        """
+        :returns: The cached data, or None if it is not cached.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        entryPath = os.path.join(self.path, key)
+        try:
+            with open(entryPath, 'rb') as fp:
+                data = fp.read()
+            os.utime(entryPath)
+        except FileNotFoundError:
+            # Removed by another process sharing the directory
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+            return None
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.maxSize:
+            return
+        # Write to a temporary file first, so that entries are never partial
+        fd, tempPath = tempfile.mkstemp(dir=self.path, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.replace(tempPath, os.path.join(self.path, key))
+        except OSError:
+            if os.path.exists(tempPath):
+                os.unlink(tempPath)
+            raise
+        with self._lock:
+            self._size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.maxSize and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,132 @@
+import os
+import tempfile
+
+from girder.exceptions import ValidationException
+from girder.utility import setting_utilities
+
+from .tag_filter import parseTagRule
+
+
+class PluginSettings:
+    TAG_ALLOW_LIST = 'dicom_viewer.tag_allow_list'
+    TAG_DENY_LIST = 'dicom_viewer.tag_deny_list'
+    INCLUDE_PRIVATE_TAGS = 'dicom_viewer.include_private_tags'
+    MAX_VALUE_LENGTH = 'dicom_viewer.max_value_length'
+    RENDER_CACHE_PATH = 'dicom_viewer.render_cache_path'
+    RENDER_CACHE_SIZE = 'dicom_viewer.render_cache_size'
+    UPLOAD_PROCESSING = 'dicom_viewer.upload_processing'
+    UPLOAD_WORKERS = 'dicom_viewer.upload_workers'
+    #: The version of the search tokens of the DICOM items, which is set by
+    #: the plugin once it has indexed them.
+    SEARCH_VERSION = 'dicom_viewer.search_version'
+
+
+#: How uploaded files are parsed: in the request which uploads them, or by
+#: a queue of background workers.
+UPLOAD_PROCESSING_MODES = ('sync', 'async')
+
+
+@setting_utilities.default({
+    PluginSettings.TAG_ALLOW_LIST,
+    PluginSettings.TAG_DENY_LIST,
+})
+def _defaultTagLists():
+    return []
+
+
+@setting_utilities.default(PluginSettings.INCLUDE_PRIVATE_TAGS)
+def _defaultIncludePrivateTags():
+    return True
+
+
+@setting_utilities.default(PluginSettings.MAX_VALUE_LENGTH)
+def _defaultMaxValueLength():
+    return 0
+
+
+@setting_utilities.default(PluginSettings.RENDER_CACHE_PATH)
+def _defaultRenderCachePath():
+    return os.path.join(tempfile.gettempdir(), 'girder_dicom_viewer', 'renders')
+
+
+@setting_utilities.default(PluginSettings.RENDER_CACHE_SIZE)
+def _defaultRenderCacheSize():
+    return 512 * 1024 ** 2
+
+
+@setting_utilities.default(PluginSettings.UPLOAD_PROCESSING)
+def _defaultUploadProcessing():
+    return 'sync'
+
+
+@setting_utilities.default(PluginSettings.UPLOAD_WORKERS)
+def _defaultUploadWorkers():
+    return 2
+
+
+@setting_utilities.default(PluginSettings.SEARCH_VERSION)
+def _defaultSearchVersion():
+    return 0
+
+
+@setting_utilities.validator({
+    PluginSettings.TAG_ALLOW_LIST,
+    PluginSettings.TAG_DENY_LIST,
+})
+def _validateTagLists(doc):
+    if not isinstance(doc['value'], (list, tuple)):
+        raise ValidationException('The tag list must be a list.', 'value')
+    for rule in doc['value']:
+        if not isinstance(rule, str):
+            raise ValidationException('Each tag rule must be a string.', 'value')
+        try:
+            parseTagRule(rule)
+        except ValueError as e:
+            raise ValidationException(str(e), 'value')
+
+
+@setting_utilities.validator(PluginSettings.INCLUDE_PRIVATE_TAGS)
+def _validateIncludePrivateTags(doc):
+    if not isinstance(doc['value'], bool):
+        raise ValidationException('Include private tags setting must be boolean.', 'value')
+
+
+@setting_utilities.validator(PluginSettings.MAX_VALUE_LENGTH)
+def _validateMaxValueLength(doc):
+    if not isinstance(doc['value'], int) or isinstance(doc['value'], bool) or doc['value'] < 0:
+        raise ValidationException(
+            'Maximum value length must be a non-negative integer (0 for no limit).', 'value')
+
+
+@setting_utilities.validator(PluginSettings.RENDER_CACHE_PATH)
+def _validateRenderCachePath(doc):
+    if not isinstance(doc['value'], str) or not doc['value'].strip():
+        raise ValidationException('Render cache path must be a non-empty string.', 'value')
+
+
+@setting_utilities.validator(PluginSettings.RENDER_CACHE_SIZE)
+def _validateRenderCacheSize(doc):
+    if not isinstance(doc['value'], int) or isinstance(doc['value'], bool) or doc['value'] < 0:
+        raise ValidationException(
+            'Render cache size must be a non-negative number of bytes (0 to disable it).',
+            'value')
+
+
+@setting_utilities.validator(PluginSettings.UPLOAD_PROCESSING)
+def _validateUploadProcessing(doc):
+    if doc['value'] not in UPLOAD_PROCESSING_MODES:
+        raise ValidationException(
+            'Upload processing must be one of %s.' % ', '.join(UPLOAD_PROCESSING_MODES),
+            'value')
+
+
+@setting_utilities.validator(PluginSettings.UPLOAD_WORKERS)
+def _validateUploadWorkers(doc):
+    if not isinstance(doc['value'], int) or isinstance(doc['value'], bool) or doc['value'] < 1:
+        raise ValidationException('Upload workers must be a positive integer.', 'value')
+
+
+@setting_utilities.validator(PluginSettings.SEARCH_VERSION)
+def _validateSearchVersion(doc):
+    if not isinstance(doc['value'], int) or isinstance(doc['value'], bool) or doc['value'] < 0:
+        raise ValidationException('Search version must be a non-negative integer.', 'value')
@@ -0,0 +1,106 @@
+import re
+
+import pydicom.datadict
+
+_GROUP_RANGE_PATTERN = re.compile(r'^([0-9a-fA-F]{4})-([0-9a-fA-F]{4})$')
+_TAG_PATTERN = re.compile(r'^\(?([0-9a-fA-F]{4}),?\s*([0-9a-fA-F]{4})\)?$')
+
+
+def parseTagRule(rule):
+    """
+    Parse an entry of a tag allow-list or deny-list, which may be:
+      * a group range, e.g. "0009-0011" (inclusive, in hexadecimal);
+      * a tag, e.g. "(0028, 0010)", "0028,0010" or "00280010";
+      * a keyword from the DICOM dictionary, e.g. "PatientName".
+
+    :returns: A ``('groups', first, last)``, ``('tag', tag)`` or
+        ``('keyword', keyword)`` tuple.
+    :raises ValueError: if the rule is none of these.
+    """
+    rule = rule.strip()
+    match = _GROUP_RANGE_PATTERN.match(rule)
+    if match:
+        first, last = int(match.group(1), 16), int(match.group(2), 16)
+        if first > last:
+            raise ValueError('Invalid group range "%s".' % rule)
+        return ('groups', first, last)
+    match = _TAG_PATTERN.match(rule)
+    if match:
+        return ('tag', int(match.group(1) + match.group(2), 16))
+    if pydicom.datadict.tag_for_keyword(rule) is None:
+        raise ValueError('Unknown DICOM keyword "%s".' % rule)
+    return ('keyword', rule)
+
+
+class _TagRules:
+    def __init__(self, rules):
+        self.keywords = set()
+        self.tags = set()
+        self.groupRanges = []
+        for rule in rules:
+            parsed = parseTagRule(rule)
+            if parsed[0] == 'groups':
+                self.groupRanges.append(parsed[1:])
+            elif parsed[0] == 'tag':
+                self.tags.add(parsed[1])
+            else:
+                self.keywords.add(parsed[1])
+        self.empty = not rules
+
+    def matches(self, tag, keyword):
+        return (
+            tag in self.tags or
+            keyword in self.keywords or
+            any(first <= tag.group <= last for first, last in self.groupRanges)
+        )
+
+
+class TagFilter:
+    """
+    Decide which data elements are stored in the DICOM metadata of items.
+
+    :param allow: Rules (see ``parseTagRule``) for the elements to keep. If
+        empty, all elements are kept, except for the denied ones.
+    :param deny: Rules for the elements to drop; they take precedence over
+        the allowed ones.
+    :param includePrivate: Whether to keep private elements.
+    :param maxValueLength: Drop elements whose value is longer than this, as
+        text; 0 for no limit.
+    """
+
+    def __init__(self, allow=(), deny=(), includePrivate=True, maxValueLength=0):
+        self.allow = list(allow)
+        self.deny = list(deny)
+        self.includePrivate = includePrivate
+        self.maxValueLength = maxValueLength
+        self._allowRules = _TagRules(self.allow)
+        self._denyRules = _TagRules(self.deny)
+
+    @property
+    def key(self):
+        """
+        A value which changes whenever the filter would keep different elements.
+        """
+        return {
+            'allow': sorted(self.allow),
+            'deny': sorted(self.deny),
+            'includePrivate': self.includePrivate,
+            'maxValueLength': self.maxValueLength
+        }
+
+    def allowsTag(self, tag, keyword):
+        if tag.is_private and not self.includePrivate:
+            return False
+        if self._denyRules.matches(tag, keyword):
+            return False
+        return self._allowRules.empty or self._allowRules.matches(tag, keyword)
+
+    def allowsValueText(self, text):
+        return not self.maxValueLength or len(text) <= self.maxValueLength
+
+    def __getstate__(self):
+        # The parsed rules are rebuilt, so this stays cheap to send to worker processes
+        return (self.allow, self.deny, self.includePrivate, self.maxValueLength)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
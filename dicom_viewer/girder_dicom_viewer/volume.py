@@ -0,0 +1,125 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+#: The version of the volume format, which is part of the key of cached volumes.
+VOLUME_FORMAT_VERSION = 1
+
+#: The length prefix of the JSON header of a volume.
+VOLUME_HEADER = struct.Struct('<I')
+
+#: The header elements which are needed to lay out a volume.
+VOLUME_HEADER_TAGS = [
+    'SamplesPerPixel', 'NumberOfFrames', 'Rows', 'Columns', 'BitsStored',
+    'PixelRepresentation', 'RescaleSlope', 'RescaleIntercept', 'PixelSpacing',
+    'ImagePositionPatient', 'ImageOrientationPatient'
+]
+
+_INTEGER_DTYPES = [np.dtype('<i2'), np.dtype('<i4')]
+
+
+def _rescale(dataset):
+    return (
+        float(dataset.get('RescaleSlope', 1) or 1),
+        float(dataset.get('RescaleIntercept', 0) or 0)
+    )
+
+
+def _volumeDtype(datasets):
+    """
+    Choose the smallest type which holds the rescaled values of all slices:
+    a 16 or 32-bit integer if every rescale is integral, else a 32-bit float.
+    """
+    low = high = 0
+    for dataset in datasets:
+        slope, intercept = _rescale(dataset)
+        if not slope.is_integer() or not intercept.is_integer():
+            return np.dtype('<f4')
+        bitsStored = int(dataset.get('BitsStored', 16))
+        if int(dataset.get('PixelRepresentation', 0)):
+            storedRange = (-2 ** (bitsStored - 1), 2 ** (bitsStored - 1) - 1)
+        else:
+            storedRange = (0, 2 ** bitsStored - 1)
+        values = [slope * value + intercept for value in storedRange]
+        low, high = min(low, *values), max(high, *values)
+    for dtype in _INTEGER_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return np.dtype('<f4')
+
+
+def _floats(value):
+    return [float(v) for v in value] if value is not None else None
+
+
+def volumeHeader(headers, sliceSpacing=None):
+    """
+    Describe the volume made of the sorted slices of a series.
+
+    :param headers: The pydicom datasets of the slices, with at least the
+        ``VOLUME_HEADER_TAGS`` elements.
+    :param sliceSpacing: The distance between the slices.
+    :returns: The header of the volume.
+    :raises ValueError: if the slices cannot be stacked into a volume.
+    """
+    if not headers:
+        raise ValueError('The series has no slices.')
+    first = headers[0]
+    shape = (int(first.get('Rows', 0)), int(first.get('Columns', 0)))
+    for dataset in headers:
+        if int(dataset.get('SamplesPerPixel', 1)) != 1:
+            raise ValueError('Only grayscale slices can be stacked into a volume.')
+        if int(dataset.get('NumberOfFrames', 1) or 1) != 1:
+            raise ValueError('Only single-frame slices can be stacked into a volume.')
+        if (int(dataset.get('Rows', 0)), int(dataset.get('Columns', 0))) != shape or \
+                not all(shape):
+            raise ValueError('The slices do not all have the same size.')
+
+    pixelSpacing = _floats(first.get('PixelSpacing')) or [None, None]
+    return {
+        'version': VOLUME_FORMAT_VERSION,
+        'dtype': _volumeDtype(headers).name,
+        'byteOrder': 'little',
+        # The slowest varying axis first
+        'shape': [len(headers), shape[0], shape[1]],
+        'spacing': [sliceSpacing] + pixelSpacing,
+        'origin': _floats(first.get('ImagePositionPatient')),
+        'orientation': _floats(first.get('ImageOrientationPatient'))
+    }
+
+
+def volumeChunks(header, datasets):
+    """
+    Generate a volume, one slice at a time: the length of its JSON header as a
+    4-byte little-endian integer, its header, then the rescaled values of its
+    voxels as raw little-endian data.
+
+    :param header: The header of the volume, from ``volumeHeader``.
+    :param datasets: An iterable of the pydicom datasets of the slices, with
+        their pixel data, which are read as they are needed.
+    """
+    encodedHeader = json.dumps(header).encode('utf8')
+    yield VOLUME_HEADER.pack(len(encodedHeader)) + encodedHeader
+
+    dtype = np.dtype(header['dtype'])
+    for dataset in datasets:
+        slope, intercept = _rescale(dataset)
+        pixels = dataset.pixel_array
+        if pixels.shape != tuple(header['shape'][1:]):
+            raise ValueError('The slices do not all have the same size.')
+        if slope != 1 or intercept != 0 or pixels.dtype != dtype:
+            pixels = pixels * slope + intercept
+        yield pixels.astype(dtype).tobytes()
+
+
+def gzipChunks(chunks, level=6):
+    """Compress a stream of chunks in the gzip format."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -20,13 +20,27 @@ wrap(ItemView, 'render', function (render) {
             }));
         }
 
-        if (this.model.has('dicom')) {
-            new DicomItemView({
-                parentView: this,
-                item: this.model
+        if (this.model.has('dicomSummary')) {
+            // Item listings only include a summary, so fetch the list of series;
+            // the files of a series are fetched when it is viewed
+            const renderSeries = (series) => {
+                new DicomItemView({
+                    parentView: this,
+                    item: this.model,
+                    series: series
+                })
+                    .render()
+                    .$el.insertAfter(this.$('.g-item-info'));
+            };
+            restRequest({
+                url: `item/${this.model.id}/dicom/series`,
+                error: null
             })
-                .render()
-                .$el.insertAfter(this.$('.g-item-info'));
+                .done(renderSeries)
+                .fail(() => {
+                    // The series of this item are not indexed, view all its files at once
+                    renderSeries([{ SeriesInstanceUID: null }]);
+                });
         }
     });
     return render.call(this);
@@ -1,3 +1,4 @@
+import $ from 'jquery';
 import _ from 'underscore';
 import daikon from 'daikon';
 import vtkImageSlice from 'vtk.js/Sources/Rendering/Core/ImageSlice';
@@ -10,7 +11,8 @@ import vtkRenderer from 'vtk.js/Sources/Rendering/Core/Renderer';
 import vtkRenderWindow from 'vtk.js/Sources/Rendering/Core/RenderWindow';
 import vtkRenderWindowInteractor from 'vtk.js/Sources/Rendering/Core/RenderWindowInteractor';
 
-import { restRequest } from '@girder/core/rest';
+import { getCurrentToken } from '@girder/core/auth';
+import { getApiRoot, restRequest } from '@girder/core/rest';
 import FileModel from '@girder/core/models/FileModel';
 import FileCollection from '@girder/core/collections/FileCollection';
 import View from '@girder/core/views/View';
@@ -20,31 +22,295 @@ import '../stylesheets/dicomItem.styl';
 import DicomSliceMetadataTemplate from '../templates/dicomSliceMetadata.pug';
 import '../stylesheets/dicomSliceMetadata.styl';
 
-const DicomFileModel = FileModel.extend({
-    getSlice: function () {
-        if (!this._slice) {
-            // Cache the slice on the model
-            this._slice = restRequest({
-                url: `file/${this.id}/download`,
-                xhrFields: {
-                    responseType: 'arraybuffer'
+/**
+ * Parse the response of `GET /item/:id/dicom/slices` as it arrives, calling
+ * `onSlice(header, arrayBuffer)` for each complete slice.
+ */
+class DicomSliceStreamParser {
+    constructor(onSlice) {
+        this._onSlice = onSlice;
+        this._chunks = [];
+        this._length = 0;
+        this._headerLength = null;
+        this._header = null;
+    }
+
+    /**
+     * @param {Uint8Array} chunk The next bytes of the response.
+     */
+    push(chunk) {
+        this._chunks.push(chunk);
+        this._length += chunk.byteLength;
+        for (;;) {
+            if (this._headerLength === null) {
+                if (this._length < 4) {
+                    return;
+                }
+                this._headerLength = new DataView(this._take(4).buffer).getUint32(0, true);
+            } else if (this._header === null) {
+                if (this._length < this._headerLength) {
+                    return;
+                }
+                this._header = JSON.parse(new TextDecoder().decode(this._take(this._headerLength)));
+            } else {
+                if (this._length < this._header.size) {
+                    return;
+                }
+                const header = this._header;
+                const data = this._take(header.size);
+                this._headerLength = null;
+                this._header = null;
+                this._onSlice(header, data.buffer);
+            }
+        }
+    }
+
+    _take(length) {
+        const result = new Uint8Array(length);
+        let offset = 0;
+        while (offset < length) {
+            const chunk = this._chunks[0];
+            const size = Math.min(chunk.byteLength, length - offset);
+            result.set(chunk.subarray(0, size), offset);
+            offset += size;
+            if (size === chunk.byteLength) {
+                this._chunks.shift();
+            } else {
+                this._chunks[0] = chunk.subarray(size);
+            }
+        }
+        this._length -= length;
+        return result;
+    }
+}
+
+/**
+ * A cache of parsed slices, which evicts the least recently used ones once the
+ * size of their files exceeds a budget, and prefetches ranges of slices, each
+ * in a single streamed request, with a limited number of concurrent requests.
+ */
+class DicomSliceCache {
+    /**
+     * @param {Number} [settings.maxBytes] The budget of the cache, in bytes of DICOM files.
+     * @param {Number} [settings.concurrency] The number of ranges prefetched at once.
+     */
+    constructor(settings = {}) {
+        this.maxBytes = settings.maxBytes || 256 * 1024 * 1024;
+        this.concurrency = settings.concurrency || 2;
+
+        // Entries by file ID, from the least to the most recently used
+        this._entries = new Map();
+        this._bytes = 0;
+        // Ranges waiting to be prefetched, by priority
+        this._queue = [];
+        // Ranges being prefetched
+        this._requests = new Set();
+    }
+
+    /**
+     * Get a slice, from the cache or from the server.
+     *
+     * @param {DicomFileModel} file
+     * @returns {Promise} The parsed slice.
+     */
+    get(file) {
+        const entry = this._entries.get(file.id);
+        if (entry) {
+            entry.prefetch = false;
+            this._entries.delete(file.id);
+            this._entries.set(file.id, entry);
+            return entry.promise;
+        }
+        return this._fetchFile(file.id, this._newEntry(file.id, false)).promise;
+    }
+
+    /**
+     * Prefetch the slices of a window which are not cached yet, cancelling the
+     * pending prefetches which are entirely out of the window.
+     *
+     * @param {Number} window.index The index of the current slice.
+     * @param {Number} window.start The index of the first slice of the window.
+     * @param {DicomFileModel[]} window.files The sorted slices of the window.
+     * @param {Function} window.url Build the URL of a range of slices, from
+     *     the index of its first slice and its number of slices.
+     */
+    prefetch(window) {
+        const runs = [];
+        let run = null;
+        window.files.forEach((file, offset) => {
+            if (this._entries.has(file.id)) {
+                run = null;
+                return;
+            }
+            if (!run) {
+                run = { start: window.start + offset, ids: [] };
+                runs.push(run);
+            }
+            run.ids.push(file.id);
+        });
+        const distance = (run) => Math.min(
+            Math.abs(run.start - window.index),
+            Math.abs(run.start + run.ids.length - 1 - window.index));
+        // Aborting requests starts the next queued ones, so replace the queue first
+        this._queue = _.sortBy(runs, distance).map((run) => ({
+            url: window.url(run.start, run.ids.length),
+            ids: run.ids
+        }));
+
+        const wanted = new Set(window.files.map((file) => file.id));
+        for (const request of this._requests) {
+            if (!request.ids.some((id) => wanted.has(id))) {
+                request.abort();
+            }
+        }
+        this._pump();
+    }
+
+    _newEntry(id, prefetch) {
+        const entry = {
+            deferred: $.Deferred(),
+            prefetch: prefetch,
+            loading: true,
+            bytes: 0
+        };
+        entry.promise = entry.deferred.promise();
+        this._entries.set(id, entry);
+        return entry;
+    }
+
+    _fetchFile(id, entry) {
+        restRequest({
+            url: `file/${id}/download`,
+            xhrFields: {
+                responseType: 'arraybuffer'
+            }
+        })
+            .done((resp) => this._resolve(id, entry, resp))
+            .fail(() => this._reject(id, entry));
+        return entry;
+    }
+
+    _resolve(id, entry, buffer) {
+        entry.loading = false;
+        if (this._entries.get(id) === entry) {
+            entry.bytes = buffer.byteLength;
+            this._bytes += entry.bytes;
+            this._evict();
+        }
+        const dataView = new DataView(buffer);
+        entry.deferred.resolve(daikon.Series.parseImage(dataView));
+    }
+
+    _reject(id, entry) {
+        if (this._entries.get(id) === entry) {
+            this._entries.delete(id);
+        }
+        entry.deferred.reject();
+    }
+
+    _pump() {
+        while (this._requests.size < this.concurrency && this._queue.length) {
+            const range = this._queue.shift();
+            const entries = new Map();
+            range.ids.forEach((id) => {
+                if (!this._entries.has(id)) {
+                    entries.set(id, this._newEntry(id, true));
                 }
+            });
+            if (entries.size) {
+                this._streamRange(range.url, entries);
+            }
+        }
+    }
+
+    _streamRange(url, entries) {
+        const controller = new AbortController();
+        const request = {
+            ids: Array.from(entries.keys()),
+            abort: () => controller.abort()
+        };
+        this._requests.add(request);
+
+        const parser = new DicomSliceStreamParser((header, buffer) => {
+            const entry = entries.get(header._id);
+            if (entry) {
+                entries.delete(header._id);
+                this._resolve(header._id, entry, buffer);
+            }
+        });
+        const token = getCurrentToken();
+        fetch(`${getApiRoot()}/${url}`, {
+            headers: token ? { 'Girder-Token': token } : {},
+            signal: controller.signal
+        })
+            .then((resp) => {
+                if (!resp.ok) {
+                    throw new Error(`Could not download the slices: ${resp.status}`);
+                }
+                // Slices are parsed as soon as they are received
+                const reader = resp.body.getReader();
+                const read = () => reader.read().then(({ done, value }) => {
+                    if (!done) {
+                        parser.push(value);
+                        return read();
+                    }
+                });
+                return read();
             })
-                .then((resp) => {
-                    const dataView = new DataView(resp);
-                    return daikon.Series.parseImage(dataView);
+            .catch(() => {})
+            .then(() => {
+                this._requests.delete(request);
+                // Slices which were not received are fetched on their own if
+                // they were asked for meanwhile, and dropped otherwise
+                entries.forEach((entry, id) => {
+                    if (entry.prefetch || this._entries.get(id) !== entry) {
+                        this._reject(id, entry);
+                    } else {
+                        this._fetchFile(id, entry);
+                    }
                 });
+                this._pump();
+            });
+        return request;
+    }
+
+    _evict() {
+        // Slices which are still being fetched are not counted yet
+        for (const [id, entry] of this._entries) {
+            if (this._bytes <= this.maxBytes) {
+                break;
+            }
+            if (!entry.loading) {
+                this._entries.delete(id);
+                this._bytes -= entry.bytes;
+            }
         }
-        return this._slice;
+    }
+}
+
+const DicomFileModel = FileModel.extend({
+    getSlice: function () {
+        return this.collection.sliceCache.get(this);
     }
 });
 
 const DicomFileCollection = FileCollection.extend({
     model: DicomFileModel,
 
-    initialize: function () {
+    /**
+     * @param {DicomSliceCache} [options.sliceCache] The cache of the slices.
+     * @param {Number} [options.prefetchRadius] The number of slices prefetched
+     *     on each side of the selected one.
+     * @param {Function} [options.slicesUrl] Build the URL downloading a range of
+     *     the slices, from the index of its first slice and its number of slices.
+     *     Without it, slices are not prefetched.
+     */
+    initialize: function (models, options = {}) {
         FileCollection.prototype.initialize.apply(this, arguments);
 
+        this.sliceCache = options.sliceCache || new DicomSliceCache();
+        this.prefetchRadius = options.prefetchRadius !== undefined ? options.prefetchRadius : 8;
+        this.slicesUrl = options.slicesUrl || null;
         this._selectedIndex = null;
     },
 
@@ -53,6 +319,21 @@ const DicomFileCollection = FileCollection.extend({
     selectIndex: function (index) {
         this._selectedIndex = index;
         this.trigger('g:selected', this.at(index), index);
+        this._prefetch(index);
+    },
+
+    _prefetch: function (index) {
+        if (!this.slicesUrl) {
+            return;
+        }
+        const start = Math.max(0, index - this.prefetchRadius);
+        const end = Math.min(this.length, index + this.prefetchRadius + 1);
+        this.sliceCache.prefetch({
+            index: index,
+            start: start,
+            files: this.slice(start, end),
+            url: this.slicesUrl
+        });
     },
 
     selectNext: function () {
@@ -339,6 +620,9 @@ const DicomItemView = View.extend({
     className: 'g-dicom-view',
 
     events: {
+        'change .g-dicom-series': function (event) {
+            this._loadSeries(this._series[parseInt(event.target.value)]);
+        },
         'input .g-dicom-slider': _.debounce(function (event) {
             this._files.selectIndex(parseInt(event.target.value));
         }, 10),
@@ -376,10 +660,26 @@ const DicomItemView = View.extend({
 
     /**
      *
-     * @param {ItemModel} settings.item An item with its `dicom` attribute set.
+     * @param {ItemModel} settings.item A DICOM item.
+     * @param {Object[]} settings.series The series of the item, as returned by
+     *     `GET /item/:id/dicom/series`. A series without a `SeriesInstanceUID`
+     *     stands for all the files of the item.
+     * @param {Number} [settings.sliceCacheBytes] The budget of the slice cache, in bytes.
+     * @param {Number} [settings.prefetchRadius] The number of slices prefetched on each
+     *     side of the current one.
+     * @param {Number} [settings.prefetchConcurrency] The number of ranges of slices
+     *     prefetched at once.
      */
     initialize: function (settings) {
-        this._files = new DicomFileCollection(settings.item.get('dicom').files);
+        this._item = settings.item;
+        this._series = settings.series;
+        this._files = new DicomFileCollection([], {
+            sliceCache: new DicomSliceCache({
+                maxBytes: settings.sliceCacheBytes,
+                concurrency: settings.prefetchConcurrency
+            }),
+            prefetchRadius: settings.prefetchRadius
+        });
 
         this._sliceMetadataView = null;
         this._sliceImageView = null;
@@ -392,7 +692,7 @@ const DicomItemView = View.extend({
 
     render: function () {
         this.$el.html(DicomItemTemplate({
-            files: this._files
+            series: this._series
         }));
 
         this._sliceMetadataView = new DicomSliceMetadataWidget({
@@ -404,16 +704,37 @@ const DicomItemView = View.extend({
             parentView: this
         });
 
-        this._files.selectFirst();
+        this._loadSeries(this._series[0]);
 
         return this;
     },
 
+    _loadSeries: function (series) {
+        this.pause();
+        const url = series.SeriesInstanceUID
+            ? `item/${this._item.id}/dicom/series/${encodeURIComponent(series.SeriesInstanceUID)}`
+            : `item/${this._item.id}/dicom`;
+        return restRequest({ url: url }).done((resp) => {
+            const seriesParam = series.SeriesInstanceUID
+                ? `&series=${encodeURIComponent(series.SeriesInstanceUID)}`
+                : '';
+            this._files.slicesUrl = (start, count) =>
+                `item/${this._item.id}/dicom/slices?start=${start}&count=${count}${seriesParam}`;
+            this._files.reset(resp.files);
+            this.$('.g-dicom-slider').attr('max', resp.files.length - 1);
+            this._files.selectFirst();
+        });
+    },
+
     _onSelectionChanged: function (selectedFile, selectedIndex) {
         this._toggleControls(false);
 
         selectedFile.getSlice()
             .done((slice) => {
+                if (this._files.at(this._files._selectedIndex) !== selectedFile) {
+                    // Another slice was selected meanwhile
+                    return;
+                }
                 this.$('.g-dicom-filename').text(selectedFile.name()).attr('title', selectedFile.name());
                 this.$('.g-dicom-slider').val(selectedIndex);
 
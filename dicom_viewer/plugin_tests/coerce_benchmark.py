@@ -0,0 +1,104 @@
+"""
+Compare the time taken to coerce DICOM headers into metadata with the per-VR
+dispatch of ``_coerceMetadata`` and with the original generic loop over
+``_coerceValue``, and check that both produce identical metadata. The
+per-VR dispatch is given the default tag filter, as files are parsed with.
+
+Usage:
+    python coerce_benchmark.py [--repeat N] [file.dcm ...]
+
+Without files, the pydicom test files are used, along with a synthetic header
+of several thousand elements, similar to an enhanced MR one.
+"""
+import argparse
+import functools
+import time
+
+import pydicom
+import pydicom.sequence
+from pydicom.data import get_testdata_file
+
+from girder_dicom_viewer import _coerceMetadata, _coerceValue
+from girder_dicom_viewer.tag_filter import TagFilter
+
+SAMPLE_FILES = ['CT_small.dcm', 'MR_small.dcm', 'rtplan.dcm', 'rtdose.dcm', 'JPEG2000.dcm']
+
+
+def coerceMetadataGeneric(dataset):
+    """The implementation of ``_coerceMetadata`` without per-VR dispatch."""
+    metadata = {}
+    for tag in dataset.keys():
+        try:
+            dataElement = dataset[tag]
+        except OSError:
+            continue
+        if dataElement.tag.element == 0:
+            continue
+        tagKey = dataElement.keyword \
+            if dataElement.keyword and not dataElement.tag.is_private else \
+            str(dataElement.tag)
+        try:
+            tagValue = _coerceValue(dataElement.value)
+        except ValueError:
+            continue
+        metadata[tagKey] = tagValue
+    return metadata
+
+
+def syntheticHeader(size):
+    """
+    Build a dataset of about ``size`` elements, by copying the elements of the
+    sample files into private groups.
+    """
+    elements = []
+    for name in SAMPLE_FILES:
+        dataset = pydicom.dcmread(get_testdata_file(name), stop_before_pixels=True)
+        elements.extend(
+            dataset[tag] for tag in dataset.keys()
+            if tag.group > 0x0002 and dataset[tag].VR != 'SQ')
+    header = pydicom.Dataset()
+    # Sequences are omitted by both implementations, even empty ones
+    header.ReferencedImageSequence = pydicom.sequence.Sequence()
+    for index in range(size):
+        element = elements[index % len(elements)]
+        group = 0x0009 + 2 * (index // 0xff00)
+        header.add_new((group, 0x0100 + index % 0xff00), element.VR, element.value)
+    return header
+
+
+def benchmark(name, dataset, repeat):
+    # Convert all raw elements first, so that both implementations do the same work
+    expected = coerceMetadataGeneric(dataset)
+    coerceMetadata = functools.partial(_coerceMetadata, tagFilter=TagFilter())
+    if coerceMetadata(dataset) != expected:
+        raise AssertionError('Different metadata for %s' % name)
+
+    timings = []
+    for coerce in (coerceMetadataGeneric, coerceMetadata):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            coerce(dataset)
+        timings.append((time.perf_counter() - start) / repeat)
+    print('%-24s %6d elements  generic %8.3f ms  per-VR %8.3f ms  speedup %.2fx' % (
+        name, len(dataset), timings[0] * 1000, timings[1] * 1000, timings[0] / timings[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    if args.files:
+        datasets = [(path, pydicom.dcmread(path, stop_before_pixels=True))
+                    for path in args.files]
+    else:
+        datasets = [(name, pydicom.dcmread(get_testdata_file(name), stop_before_pixels=True))
+                    for name in SAMPLE_FILES]
+        datasets.append(('synthetic', syntheticHeader(3000)))
+    for name, dataset in datasets:
+        benchmark(name, dataset, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,39 @@
+import concurrent.futures
+import gzip
 import io
 import os
 import json
+import shutil
+import struct
+import tempfile
+import time
 
+from girder import events
+from girder.constants import AccessType
 from girder.models.collection import Collection
+from girder.models.file import File
 from girder.models.folder import Folder
 from girder.models.item import Item
+from girder.models.setting import Setting
 from girder.models.upload import Upload
 from girder.models.user import User
+import numpy as np
+from PIL import Image
 import pydicom
 from tests import base
 
-from girder_dicom_viewer import _removeUniqueMetadata, _extractFileData
+from girder_dicom_viewer import (
+    DICOM_SEARCH_VERSION, _batchItems, _removeUniqueMetadata, _coerceElementValue,
+    _coerceMetadata, _coerceValue, _extractFileData, _getParseQueue, _makeDicomItem,
+    _migrateSearchTokens, _parseQueuedItem, _parseStream, _searchString, _searchTokens,
+    _seriesGeometry, _slicePositions, _uploadHandler)
 from girder_dicom_viewer.event_helper import _EventHelper
+from girder_dicom_viewer.frames import frameDataset
+from girder_dicom_viewer.settings import PluginSettings
+from girder_dicom_viewer.header_reader import (
+    HeaderReader, HeaderTruncated, PrefixBuffer, ReadCounters)
+from girder_dicom_viewer.render import renderSlice
+from girder_dicom_viewer.render_cache import RenderCache
 
 
 def setUpModule():
@@ -65,6 +87,12 @@ class DicomViewerTest(base.TestCase):
         }
         self.assertEqual(_removeUniqueMetadata(dicomMeta, additionalMeta), commonMeta)
 
+        # Multi-valued elements are compared as a whole
+        self.assertEqual(_removeUniqueMetadata(
+            {'key1': [0.5, 0.5], 'key2': [1, 2]},
+            {'key1': [0.5, 0.5], 'key2': [1, 3]}
+        ), {'key1': [0.5, 0.5]})
+
     def testExtractFileData(self):
         dicomFile = {
             '_id': '599c4cf3c9c5cb11f1ff5d97',
@@ -79,7 +107,9 @@ class DicomViewerTest(base.TestCase):
         dicomMeta = {
             'SeriesNumber': 1,
             'InstanceNumber': 1,
-            'SliceLocation': 0
+            'SliceLocation': 0,
+            'SeriesInstanceUID': '1.2.3.4',
+            'StudyInstanceUID': '1.2.3'
         }
         result = {
             '_id': '599c4cf3c9c5cb11f1ff5d97',
@@ -87,11 +117,249 @@ class DicomViewerTest(base.TestCase):
             'dicom': {
                 'SeriesNumber': 1,
                 'InstanceNumber': 1,
-                'SliceLocation': 0
+                'SliceLocation': 0,
+                'SeriesInstanceUID': '1.2.3.4',
+                'StudyInstanceUID': '1.2.3'
             }
         }
         self.assertEqual(_extractFileData(dicomFile, dicomMeta), result)
 
+    def testCoerceElementValue(self):
+        # The per-VR conversion must match the generic one for every element
+        for name in ['CT_small.dcm', 'MR_small.dcm', 'rtplan.dcm', 'OBXXXX1A.dcm']:
+            dataset = pydicom.dcmread(
+                pydicom.data.get_testdata_file(name), stop_before_pixels=True)
+            for tag in dataset.keys():
+                dataElement = dataset[tag]
+                try:
+                    expected = _coerceValue(dataElement.value)
+                except ValueError:
+                    with self.assertRaises(ValueError):
+                        _coerceElementValue(dataElement.value, dataElement.VR)
+                    continue
+                self.assertEqual(
+                    _coerceElementValue(dataElement.value, dataElement.VR), expected)
+
+        # Sequences are omitted, even empty ones
+        for vr in ('SQ', 'UN'):
+            with self.assertRaises(ValueError):
+                _coerceElementValue(pydicom.sequence.Sequence(), vr)
+        dataset = pydicom.Dataset()
+        dataset.ReferencedImageSequence = pydicom.sequence.Sequence()
+        dataset.Modality = 'CT'
+        self.assertEqual(_coerceMetadata(dataset), {'Modality': 'CT'})
+
+    def testSlicePositions(self):
+        # An oblique series, listed out of order, with slices 2.5 apart
+        rowDirection = [0.0, 0.8, -0.6]
+        columnDirection = [1.0, 0.0, 0.0]
+        normal = [0.0, -0.6, -0.8]
+        origin = [10.0, -20.0, 30.0]
+        steps = [2, 0, 3, 1]
+        imagePositions = [
+            [origin[axis] + 2.5 * step * normal[axis] for axis in range(3)] for step in steps]
+        slicePositions = _slicePositions(
+            imagePositions, [rowDirection + columnDirection] * len(steps))
+        self.assertEqual(sorted(range(len(steps)), key=lambda i: slicePositions[i]),
+                         sorted(range(len(steps)), key=lambda i: steps[i]))
+        # Each slice has the same position when it is projected alone
+        for imagePosition, slicePosition in zip(imagePositions, slicePositions):
+            self.assertEqual(_slicePositions(
+                [imagePosition], [rowDirection + columnDirection]), [slicePosition])
+
+        geometry = _seriesGeometry(slicePositions)
+        self.assertAlmostEqual(geometry['sliceSpacing'], 2.5)
+        self.assertFalse(geometry['irregularSpacing'])
+
+        # A missing slice, a duplicate slice and a slice without geometry
+        self.assertTrue(_seriesGeometry(slicePositions[:3])['irregularSpacing'])
+        self.assertTrue(_seriesGeometry(slicePositions + [slicePositions[0]])['irregularSpacing'])
+        self.assertTrue(_seriesGeometry(slicePositions + [None])['irregularSpacing'])
+
+        # Missing or invalid geometry
+        self.assertEqual(_slicePositions(
+            [None, [1.0, 2.0], [1.0, 2.0, 3.0]],
+            [rowDirection + columnDirection] * 2 + [[0.0] * 6]), [None, None, None])
+
+    def testRenderSlice(self):
+        dataset = pydicom.dcmread(pydicom.data.get_testdata_file('CT_small.dcm'))
+        image = Image.open(io.BytesIO(renderSlice(dataset)))
+        self.assertEqual((image.format, image.size, image.mode), ('PNG', (128, 128), 'L'))
+
+        image = Image.open(io.BytesIO(renderSlice(dataset, size=32, imageFormat='webp')))
+        self.assertEqual((image.format, image.size), ('WEBP', (32, 32)))
+
+        # A window below every value renders white, above every value black
+        rescaled = dataset.pixel_array * float(dataset.RescaleSlope) + \
+            float(dataset.RescaleIntercept)
+        for level, value in [(rescaled.min() - 10, 255), (rescaled.max() + 10, 0)]:
+            image = Image.open(io.BytesIO(renderSlice(dataset, window=1, level=level)))
+            self.assertEqual(image.getextrema(), (value, value))
+
+        with self.assertRaises(ValueError):
+            renderSlice(dataset, frame=1)
+
+    def testRenderCache(self):
+        path = tempfile.mkdtemp()
+        try:
+            cache = RenderCache(path, 100)
+            cache.put('a', b'a' * 40)
+            cache.put('b', b'b' * 40)
+            self.assertEqual(cache.get('a'), b'a' * 40)
+            # The least recently used entry is evicted
+            cache.put('c', b'c' * 40)
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual(sorted(os.listdir(path)), ['a', 'c'])
+            # Entries larger than the cache are not stored
+            cache.put('d', b'd' * 101)
+            self.assertIsNone(cache.get('d'))
+
+            # The entries and their recency are kept across restarts
+            cache = RenderCache(path, 50)
+            self.assertEqual(os.listdir(path), ['c'])
+            self.assertEqual(cache.get('c'), b'c' * 40)
+        finally:
+            shutil.rmtree(path)
+
+    def testRenderDicomFile(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection14', admin, public=True)
+        folder = Folder().createFolder(
+            collection, 'folder14', parentType='collection', public=True)
+        item = Item().createItem('item14', admin, folder)
+        self._uploadDicomFiles(item, admin)
+        file = Item().load(item['_id'], force=True)['dicom']['files'][0]
+
+        cachePath = tempfile.mkdtemp()
+        Setting().set(PluginSettings.RENDER_CACHE_PATH, cachePath)
+        try:
+            path = '/file/%s/dicom/render' % file['_id']
+            resp = self.request(path=path, user=user, isJson=False, params={
+                'size': 64, 'encoding': 'webp', 'window': 400, 'level': 40})
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['Content-Type'], 'image/webp')
+            image = Image.open(io.BytesIO(self.getBody(resp, text=False)))
+            self.assertEqual(image.format, 'WEBP')
+            self.assertLessEqual(max(image.size), 64)
+            self.assertEqual(len(os.listdir(cachePath)), 1)
+
+            # The same rendering is served from the cache
+            resp = self.request(path=path, user=user, isJson=False, params={
+                'size': 64, 'encoding': 'webp', 'window': 400, 'level': 40})
+            self.assertStatusOk(resp)
+            self.assertEqual(len(os.listdir(cachePath)), 1)
+            resp = self.request(path=path, user=user, isJson=False)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['Content-Type'], 'image/png')
+            self.assertEqual(len(os.listdir(cachePath)), 2)
+
+            for params in [{'size': 0}, {'window': 0}, {'frame': 5}]:
+                resp = self.request(path=path, user=user, params=params)
+                self.assertStatus(resp, 400)
+        finally:
+            Setting().unset(PluginSettings.RENDER_CACHE_PATH)
+            shutil.rmtree(cachePath)
+
+    def testDicomFrames(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection17', admin, public=True)
+        folder = Folder().createFolder(
+            collection, 'folder17', parentType='collection', public=True)
+        item = Item().createItem('item17', admin, folder)
+        files = {}
+        for name in ['rtdose.dcm', 'rtdose_rle.dcm', 'rtdose_expb.dcm']:
+            samplePath = pydicom.data.get_testdata_file(name)
+            with open(samplePath, 'rb') as fp, \
+                    _EventHelper('dicom_viewer.upload.success') as helper:
+                files[name] = Upload().uploadFromFile(
+                    obj=fp, size=os.path.getsize(samplePath), name=name,
+                    parentType='item', parent=item, mimeType='application/dicom', user=admin)
+                self.assertTrue(helper.wait())
+        expected = pydicom.dcmread(pydicom.data.get_testdata_file('rtdose.dcm')).pixel_array
+
+        for name, contentType in [
+                ('rtdose.dcm', 'application/octet-stream; transfer-syntax=1.2.840.10008.1.2'),
+                ('rtdose_rle.dcm', 'image/dicom-rle; transfer-syntax=1.2.840.10008.1.2.5')]:
+            # The frames were located when the file was parsed
+            file = File().load(files[name]['_id'], force=True)
+            self.assertEqual(len(file['dicomFrames']['table']['frames']), 15)
+
+            resp = self.request(
+                path='/file/%s/dicom/frames/7' % file['_id'], user=user, isJson=False)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['Content-Type'], contentType)
+            with File().open(file) as fp:
+                header = pydicom.dcmread(fp, stop_before_pixels=True)
+            dataset = frameDataset(
+                header, file['dicomFrames']['table'], self.getBody(resp, text=False))
+            self.assertTrue(np.array_equal(dataset.pixel_array, expected[7]))
+
+            resp = self.request(path='/file/%s/dicom/frames/15' % file['_id'], user=user)
+            self.assertStatus(resp, 400)
+
+        # Rendering a frame reads only this frame
+        Setting().set(PluginSettings.RENDER_CACHE_SIZE, 0)
+        try:
+            resp = self.request(
+                path='/file/%s/dicom/render' % files['rtdose_rle.dcm']['_id'], user=user,
+                isJson=False, params={'frame': 14})
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['Content-Type'], 'image/png')
+        finally:
+            Setting().unset(PluginSettings.RENDER_CACHE_SIZE)
+
+        # Big endian pixel data cannot be read in place
+        resp = self.request(
+            path='/file/%s/dicom/frames/0' % files['rtdose_expb.dcm']['_id'], user=user)
+        self.assertStatus(resp, 400)
+
+        # Files parsed before frames were located get their frames on demand
+        file = File().load(files['rtdose.dcm']['_id'], force=True)
+        File().update({'_id': file['_id']}, {'$unset': {'dicomFrames': ''}})
+        resp = self.request(
+            path='/file/%s/dicom/frames/0' % file['_id'], user=user, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertIn('dicomFrames', File().load(file['_id'], force=True))
+
+    def testSearchTokens(self):
+        dicomMeta = {
+            'PatientName': 'Brain Research',
+            'Rows': 512,
+            'SliceThickness': 1.0,
+            'PixelSpacing': [0.5, 0.5]
+        }
+        self.assertEqual(_searchTokens(dicomMeta), [
+            '0.5,0.5', '1', '512', 'brain research', 'patientname', 'pixelspacing', 'rows',
+            'slicethickness'
+        ])
+        # Long values are truncated
+        tokens = _searchTokens({'ImageComments': 'A' * 1000})
+        self.assertEqual(tokens, ['a' * 256, 'imagecomments'])
+
+    def testAddMissingSearchTokens(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection21', admin, public=True)
+        folder = Folder().createFolder(
+            collection, 'folder21', parentType='collection', public=True)
+        item = Item().createItem('item21', admin, folder)
+        fileData = {'dicom': {'SeriesInstanceUID': '1.2.3'}, 'name': 'a.dcm', '_id': 'a'}
+        Item().update({'_id': item['_id']}, {'$set': {'dicom': {
+            'meta': {'Modality': 'CT'}, 'files': [fileData],
+            'series': [{'SeriesInstanceUID': '1.2.3', 'files': [fileData]}]}}})
+
+        # The items are indexed once, when the search version changes
+        Setting().set(PluginSettings.SEARCH_VERSION, DICOM_SEARCH_VERSION)
+        _migrateSearchTokens()
+        self.assertNotIn('dicomSearch', Item().load(item['_id'], force=True))
+        Setting().set(PluginSettings.SEARCH_VERSION, 0)
+        _migrateSearchTokens()
+        item = Item().load(item['_id'], force=True)
+        self.assertEqual(item['dicomSearch'], ['ct', 'modality'])
+        self.assertEqual(item['dicomSummary'], {'Modality': 'CT', 'files': 1, 'series': 1})
+        # The series no longer hold copies of their files
+        self.assertEqual(item['dicom']['series'], [{'SeriesInstanceUID': '1.2.3', 'fileCount': 1}])
+        self.assertEqual(Setting().get(PluginSettings.SEARCH_VERSION), DICOM_SEARCH_VERSION)
+
     def testFileProcessHandler(self):
         admin, user = self.users
 
@@ -153,6 +421,562 @@ class DicomViewerTest(base.TestCase):
         resp = self.request(path=path, method='POST', user=user)
         self.assertStatus(resp, 403)
 
+    def testGetDicomItem(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection13', admin, public=True)
+        folder = Folder().createFolder(
+            collection, 'folder13', parentType='collection', public=True)
+        item = Item().createItem('item13', admin, folder)
+        self._uploadDicomFiles(item, admin)
+        dicomItem = Item().load(item['_id'], force=True)
+
+        # Listings only include the summary of the DICOM metadata
+        resp = self.request(path='/item', user=user, params={'folderId': folder['_id']})
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), 1)
+        self.assertNotIn('dicom', resp.json[0])
+        self.assertEqual(resp.json[0]['dicomSummary']['files'], 4)
+        self.assertEqual(
+            resp.json[0]['dicomSummary'].get('Modality'),
+            dicomItem['dicom']['meta'].get('Modality'))
+
+        # The whole metadata has its own endpoint
+        resp = self.request(path='/item/%s/dicom' % item['_id'], user=user)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['meta'], dicomItem['dicom']['meta'])
+        self.assertEqual(
+            [f['name'] for f in resp.json['files']],
+            [f['name'] for f in dicomItem['dicom']['files']])
+
+        nonDicomItem = Item().createItem('item13b', admin, folder)
+        resp = self.request(path='/item/%s/dicom' % nonDicomItem['_id'], user=user)
+        self.assertStatus(resp, 400)
+
+    def testDicomSeries(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection12', admin, public=True)
+        folder = Folder().createFolder(
+            collection, 'folder12', parentType='collection', public=True)
+        item = Item().createItem('item12', admin, folder)
+        self._uploadDicomFiles(item, admin)
+
+        # Add a second series, made of copies of a file with other UIDs
+        dataset = pydicom.dcmread(os.path.join(self.dataDir, '000000.dcm'))
+        firstSeriesUid = dataset.SeriesInstanceUID
+        dataset.SeriesInstanceUID = pydicom.uid.generate_uid()
+        dataset.SeriesNumber = 1000
+        for i in range(2):
+            dataset.SOPInstanceUID = pydicom.uid.generate_uid()
+            dataset.InstanceNumber = i + 1
+            fp = io.BytesIO()
+            dataset.save_as(fp)
+            fp.seek(0)
+            with _EventHelper('dicom_viewer.upload.success') as helper:
+                Upload().uploadFromFile(
+                    obj=fp, size=len(fp.getvalue()), name=f'otherSeries{i}.dcm',
+                    parentType='item', parent=item, mimeType='application/dicom',
+                    user=admin)
+                self.assertTrue(helper.wait())
+
+        # The upload handler and parsing the whole item build the same index
+        uploadedDicom = Item().load(item['_id'], force=True)['dicom']
+        resp = self.request(
+            path='/item/%s/parseDicom' % item['_id'], method='POST', user=admin)
+        self.assertStatusOk(resp)
+        dicomItem = Item().load(item['_id'], force=True)
+        self.assertEqual(uploadedDicom, dicomItem['dicom'])
+        self.assertEqual(dicomItem['dicomSummary']['series'], 2)
+        self.assertNotIn('SeriesInstanceUID', dicomItem['dicom']['meta'])
+        # The files are only listed once in the item
+        self.assertNotIn('files', dicomItem['dicom']['series'][0])
+
+        resp = self.request(path='/item/%s/dicom/series' % item['_id'], user=user)
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            [(series['SeriesInstanceUID'], series['fileCount']) for series in resp.json],
+            [(firstSeriesUid, 4), (dataset.SeriesInstanceUID, 2)])
+        self.assertNotIn('files', resp.json[0])
+        # The copies of a slice share its position
+        self.assertTrue(resp.json[1]['geometry']['irregularSpacing'])
+        self.assertEqual(resp.json[1]['meta']['SeriesNumber'], 1000)
+
+        resp = self.request(
+            path='/item/%s/dicom/series/%s' % (item['_id'], dataset.SeriesInstanceUID),
+            user=user)
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            [f['name'] for f in resp.json['files']], ['otherSeries0.dcm', 'otherSeries1.dcm'])
+        self.assertEqual(resp.json['meta']['SeriesInstanceUID'], dataset.SeriesInstanceUID)
+
+        resp = self.request(path='/item/%s/dicom/series/1.2.3' % item['_id'], user=user)
+        self.assertStatus(resp, 404)
+
+    def testDicomSliceOrder(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection22', admin, public=True)
+        folder = Folder().createFolder(
+            collection, 'folder22', parentType='collection', public=True)
+        item = Item().createItem('item22', admin, folder)
+
+        # The files are named, numbered and positioned in different orders
+        dataset = pydicom.dcmread(os.path.join(self.dataDir, '000000.dcm'))
+        dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        for name, instanceNumber, z in [('a.dcm', 3, 10.0), ('b.dcm', 1, 30.0),
+                                        ('c.dcm', 2, 20.0)]:
+            dataset.SOPInstanceUID = pydicom.uid.generate_uid()
+            dataset.InstanceNumber = instanceNumber
+            dataset.ImagePositionPatient = [0, 0, z]
+            dataset.SliceLocation = z
+            fp = io.BytesIO()
+            dataset.save_as(fp)
+            fp.seek(0)
+            with _EventHelper('dicom_viewer.upload.success') as helper:
+                Upload().uploadFromFile(
+                    obj=fp, size=len(fp.getvalue()), name=name, parentType='item',
+                    parent=item, mimeType='application/dicom', user=admin)
+                self.assertTrue(helper.wait())
+        uploadedDicom = Item().load(item['_id'], force=True)['dicom']
+
+        resp = self.request(
+            path='/item/%s/parseDicom' % item['_id'], method='POST', user=admin)
+        self.assertStatusOk(resp)
+        dicomItem = Item().load(item['_id'], force=True)
+        self.assertEqual(uploadedDicom, dicomItem['dicom'])
+        # Each file has its own position
+        self.assertEqual(
+            [(f['name'], f['dicom']['SlicePosition']) for f in dicomItem['dicom']['files']],
+            [('b.dcm', 30.0), ('c.dcm', 20.0), ('a.dcm', 10.0)])
+
+        resp = self.request(path='/item/%s/dicom/series/%s' % (
+            item['_id'], dataset.SeriesInstanceUID), user=user)
+        self.assertStatusOk(resp)
+        self.assertEqual([f['name'] for f in resp.json['files']], ['a.dcm', 'c.dcm', 'b.dcm'])
+        self.assertEqual(resp.json['geometry']['sliceSpacing'], 10.0)
+        self.assertFalse(resp.json['geometry']['irregularSpacing'])
+
+    def testGetDicomSlices(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection15', admin, public=True)
+        folder = Folder().createFolder(
+            collection, 'folder15', parentType='collection', public=True)
+        item = Item().createItem('item15', admin, folder)
+        self._uploadDicomFiles(item, admin)
+        dicomItem = Item().load(item['_id'], force=True)
+        resp = self.request(path='/item/%s/dicom/series/%s' % (
+            item['_id'], dicomItem['dicom']['series'][0]['SeriesInstanceUID']), user=user)
+        self.assertStatusOk(resp)
+        series = resp.json
+
+        def getSlices(**params):
+            resp = self.request(
+                path='/item/%s/dicom/slices' % item['_id'], user=user, isJson=False,
+                params=params)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['Content-Type'], 'application/octet-stream')
+            body = self.getBody(resp, text=False)
+            slices = []
+            while body:
+                headerLength, = struct.unpack('<I', body[:4])
+                header = json.loads(body[4:4 + headerLength])
+                end = 4 + headerLength + header['size']
+                slices.append((header, body[4 + headerLength:end]))
+                body = body[end:]
+            return slices
+
+        slices = getSlices(start=1, count=2)
+        self.assertEqual(
+            [(header['index'], header['_id']) for header, data in slices],
+            [(1, str(dicomItem['dicom']['files'][1]['_id'])),
+             (2, str(dicomItem['dicom']['files'][2]['_id']))])
+        for header, data in slices:
+            file = File().load(header['_id'], force=True)
+            with File().open(file) as fp:
+                self.assertEqual(data, fp.read())
+
+        # The slices of a series are in the order of the series
+        slices = getSlices(series=series['SeriesInstanceUID'])
+        self.assertEqual(
+            [header['_id'] for header, data in slices],
+            [f['_id'] for f in series['files']])
+        self.assertEqual(getSlices(start=10), [])
+
+        resp = self.request(
+            path='/item/%s/dicom/slices' % item['_id'], user=user, params={'count': 0})
+        self.assertStatus(resp, 400)
+        resp = self.request(
+            path='/item/%s/dicom/slices' % item['_id'], user=user, params={'series': '1.2.3'})
+        self.assertStatus(resp, 404)
+
+    def testGetDicomVolume(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection16', admin, public=True)
+        folder = Folder().createFolder(
+            collection, 'folder16', parentType='collection', public=True)
+        item = Item().createItem('item16', admin, folder)
+        self._uploadDicomFiles(item, admin)
+        uid = Item().load(item['_id'], force=True)['dicom']['series'][0]['SeriesInstanceUID']
+        resp = self.request(path='/item/%s/dicom/series/%s' % (item['_id'], uid), user=user)
+        self.assertStatusOk(resp)
+        series = resp.json
+        path = '/item/%s/dicom/series/%s/volume' % (item['_id'], uid)
+
+        def getVolume(**params):
+            resp = self.request(path=path, user=user, isJson=False, params=params)
+            self.assertStatusOk(resp)
+            return resp, self.getBody(resp, text=False)
+
+        resp, volume = getVolume()
+        self.assertEqual(resp.headers['Content-Type'], 'application/octet-stream')
+        headerLength, = struct.unpack('<I', volume[:4])
+        header = json.loads(volume[4:4 + headerLength])
+        self.assertEqual(header['SeriesInstanceUID'], series['SeriesInstanceUID'])
+        self.assertEqual(header['byteOrder'], 'little')
+        self.assertEqual(header['shape'][0], len(series['files']))
+        self.assertEqual(header['spacing'][0], series['geometry']['sliceSpacing'])
+        voxels = np.frombuffer(volume[4 + headerLength:], dtype=header['dtype'])
+        voxels = voxels.reshape(header['shape'])
+
+        # The slices are rescaled, in the order of the series
+        file = File().load(series['files'][1]['_id'], force=True)
+        with File().open(file) as fp:
+            dataset = pydicom.dcmread(fp)
+        expected = dataset.pixel_array * float(dataset.get('RescaleSlope', 1)) + \
+            float(dataset.get('RescaleIntercept', 0))
+        self.assertTrue(np.array_equal(voxels[1], expected))
+
+        # The volume is cached as a file attached to the item
+        query = {'attachedToType': 'item', 'attachedToId': item['_id']}
+        self.assertEqual(File().find(query).count(), 1)
+        resp, cachedVolume = getVolume()
+        self.assertEqual(cachedVolume, volume)
+        self.assertEqual(File().find(query).count(), 1)
+        self.assertEqual(len(Item().load(item['_id'], force=True)['dicom']['files']), 4)
+
+        resp, compressedVolume = getVolume(compression='gzip')
+        self.assertEqual(resp.headers['Content-Type'], 'application/gzip')
+        self.assertEqual(gzip.decompress(compressedVolume), volume)
+        self.assertEqual(File().find(query).count(), 2)
+
+        # A changed slice invalidates the cached volume, which is replaced
+        File().update({'_id': file['_id']}, {'$set': {'sha512': 'changed'}})
+        getVolume()
+        self.assertEqual(File().find(query).count(), 2)
+
+        resp = self.request(path='/item/%s/dicom/series/1.2.3/volume' % item['_id'], user=user)
+        self.assertStatus(resp, 404)
+
+        # The cached volumes are removed with the item
+        Item().remove(Item().load(item['_id'], force=True))
+        self.assertEqual(File().find(query).count(), 0)
+
+    def testMakeDicomItemParallel(self):
+        admin, user = self.users
+
+        # create a collection, folder, and item
+        collection = Collection().createCollection('collection6', admin, public=True)
+        folder = Folder().createFolder(collection, 'folder6', parentType='collection', public=True)
+        item = Item().createItem('item6', admin, folder)
+
+        # Upload files
+        self._uploadNonDicomFiles(item, admin)
+        self._uploadDicomFiles(item, admin)
+        path = '/item/%s/parseDicom' % item['_id']
+
+        # Parse sequentially, for reference
+        resp = self.request(path=path, method='POST', user=admin)
+        self.assertStatusOk(resp)
+        sequentialDicom = Item().load(item['_id'], force=True)['dicom']
+
+        # Both kinds of pool must produce exactly the same document
+        for pool in ['thread', 'process']:
+            Item().save(self._purgeDicomItem(Item().load(item['_id'], force=True)))
+            File().update({'itemId': item['_id']}, {'$unset': {'dicomCache': ''}})
+            resp = self.request(path=path, method='POST', user=admin, params={
+                'workers': 3,
+                'pool': pool
+            })
+            self.assertStatusOk(resp)
+            dicomItem = Item().load(item['_id'], force=True)
+            self.assertEqual(dicomItem['dicom'], sequentialDicom)
+
+        resp = self.request(path=path, method='POST', user=admin, params={'workers': 0})
+        self.assertStatus(resp, 400)
+
+    def testConcurrentUploadHandlers(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection8', admin, public=True)
+        folder = Folder().createFolder(collection, 'folder8', parentType='collection', public=True)
+        item = Item().createItem('item8', admin, folder)
+
+        # Upload several copies of each file
+        copies = 10
+        for copy in range(copies):
+            for i in range(4):
+                path = os.path.join(self.dataDir, '00000%i.dcm' % i)
+                with open(path, 'rb') as fp, \
+                        _EventHelper('dicom_viewer.upload.success') as helper:
+                    Upload().uploadFromFile(
+                        obj=fp, size=os.path.getsize(path), name=f'dicomFile{i}_{copy}.dcm',
+                        parentType='item', parent=item, mimeType='application/dicom',
+                        user=admin)
+                    self.assertTrue(helper.wait())
+
+        # Parse all the files sequentially, for reference
+        resp = self.request(
+            path='/item/%s/parseDicom' % item['_id'], method='POST', user=admin)
+        self.assertStatusOk(resp)
+        sequentialItem = Item().load(item['_id'], force=True)
+
+        # Process all the files again, at once
+        Item().update({'_id': item['_id']}, {'$unset': {
+            'dicom': '', 'dicomSummary': '', 'dicomSearch': ''}})
+        files = list(File().find({'itemId': item['_id']}))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+            list(pool.map(
+                lambda file: _uploadHandler(events.Event('data.process', {'file': file})),
+                files))
+
+        concurrentItem = Item().load(item['_id'], force=True)
+        self.assertEqual(len(concurrentItem['dicom']['files']), copies * 4)
+        self.assertEqual(concurrentItem['dicom'], sequentialItem['dicom'])
+        self.assertEqual(concurrentItem['dicomSummary'], sequentialItem['dicomSummary'])
+        self.assertEqual(concurrentItem['dicomSearch'], sequentialItem['dicomSearch'])
+
+    def testAsyncUploadProcessing(self):
+        admin, user = self.users
+        resp = self.request(path='/system/setting', method='PUT', user=admin, params={
+            'key': PluginSettings.UPLOAD_PROCESSING, 'value': 'later'})
+        self.assertStatus(resp, 400)
+
+        collection = Collection().createCollection('collection18', admin, public=True)
+        folder = Folder().createFolder(
+            collection, 'folder18', parentType='collection', public=True)
+        item = Item().createItem('item18', admin, folder)
+        nonDicomItem = Item().createItem('item18b', admin, folder)
+        Setting().set(PluginSettings.UPLOAD_PROCESSING, 'async')
+        try:
+            self._uploadNonDicomFiles(nonDicomItem, admin)
+            for i in range(4):
+                path = os.path.join(self.dataDir, '00000%i.dcm' % i)
+                with open(path, 'rb') as fp:
+                    Upload().uploadFromFile(
+                        obj=fp, size=os.path.getsize(path), name=f'dicomFile{i}.dcm',
+                        parentType='item', parent=item, mimeType='application/dicom',
+                        user=admin)
+            self.assertTrue(_getParseQueue().join(10))
+        finally:
+            Setting().unset(PluginSettings.UPLOAD_PROCESSING)
+
+        # The uploads of the item were merged into as few parses as possible
+        dicomItem = Item().load(item['_id'], force=True)
+        self.assertEqual(len(dicomItem['dicom']['files']), 4)
+        self.assertEqual(dicomItem['dicomProcessing']['state'], 'success')
+        self.assertGreaterEqual(dicomItem['dicomProcessing']['seconds'], 0)
+        # Items without DICOM files are not queued
+        self.assertNotIn('dicomProcessing', Item().load(nonDicomItem['_id'], force=True))
+
+        # An item queued again while it is parsed stays queued
+        def requeue(event):
+            Item().update({'_id': item['_id']}, {'$set': {'dicomProcessing': {
+                'state': 'queued'}}})
+
+        with events.bound('model.item.save.after', 'requeue', requeue):
+            _parseQueuedItem(item['_id'])
+        self.assertEqual(
+            Item().load(item['_id'], force=True)['dicomProcessing']['state'], 'queued')
+
+        resp = self.request(path='/item/%s' % item['_id'], user=user)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['dicomProcessing']['state'], 'success')
+
+        resp = self.request(path='/item/dicom/queue', user=user)
+        self.assertStatus(resp, 403)
+        resp = self.request(path='/item/dicom/queue', user=admin)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['queued'], 0)
+        self.assertEqual(resp.json['running'], 0)
+        self.assertGreaterEqual(resp.json['processed'], 1)
+        self.assertLessEqual(resp.json['processed'], 4)
+        self.assertIsNotNone(resp.json['processSeconds']['max'])
+
+    def testMakeFolderDicomItems(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection9', admin, public=True)
+        folder = Folder().createFolder(collection, 'folder9', parentType='collection', public=True)
+        subfolder = Folder().createFolder(folder, 'subfolder9', public=True)
+        items = [Item().createItem('item9a', admin, folder),
+                 Item().createItem('item9b', admin, subfolder)]
+        for item in items:
+            self._uploadDicomFiles(item, admin)
+            Item().update({'_id': item['_id']}, {'$unset': {
+                'dicom': '', 'dicomSummary': '', 'dicomSearch': ''}})
+        # An item whose file cannot be read does not stop the batch
+        failedItem = Item().createItem('item9c', admin, folder)
+        path = os.path.join(self.dataDir, '000000.dcm')
+        with open(path, 'rb') as fp, _EventHelper('dicom_viewer.upload.success') as helper:
+            failedFile = Upload().uploadFromFile(
+                obj=fp, size=os.path.getsize(path), name='missing.dcm', parentType='item',
+                parent=failedItem, mimeType='application/dicom', user=admin)
+            self.assertTrue(helper.wait())
+        File().update({'_id': failedFile['_id']}, {'$unset': {'dicomCache': ''}})
+        os.remove(File().getLocalFilePath(failedFile))
+
+        path = '/folder/%s/parseDicom' % folder['_id']
+        resp = self.request(path=path, method='POST', user=user)
+        self.assertStatus(resp, 403)
+
+        # Items are paged through by ID
+        query = {'folderId': {'$in': [folder['_id'], subfolder['_id']]}}
+        self.assertEqual(
+            [item['_id'] for item in _batchItems(query, pageSize=1)],
+            sorted(item['_id'] for item in items + [failedItem]))
+        self.assertEqual(
+            [item['_id'] for item in _batchItems(query, items[0]['_id'])],
+            [items[1]['_id'], failedItem['_id']])
+
+        # A batch cannot start while another one is running
+        Folder().update({'_id': folder['_id']}, {'$set': {'dicomParse': {'state': 'running'}}})
+        resp = self.request(path=path, method='POST', user=admin)
+        self.assertStatus(resp, 400)
+        Folder().update({'_id': folder['_id']}, {'$unset': {'dicomParse': ''}})
+
+        resp = self.request(path=path, method='POST', user=admin, params={'workers': 2})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['state'], 'running')
+
+        # Wait for the background task
+        for _ in range(100):
+            batch = Folder().load(folder['_id'], force=True)['dicomParse']
+            if batch['state'] != 'running':
+                break
+            time.sleep(0.1)
+        self.assertEqual(batch['state'], 'success')
+        self.assertEqual(batch['items'], 3)
+        self.assertEqual(batch['failedItemIds'], [failedItem['_id']])
+        self.assertEqual(batch['lastItemId'], failedItem['_id'])
+        self.assertEqual(batch['files'], 8)
+        self.assertGreater(batch['bytesRead'], 0)
+        self.assertIn('filesPerSecond', batch)
+        for item in items:
+            dicomItem = Item().load(item['_id'], force=True)
+            self.assertEqual(len(dicomItem['dicom']['files']), 4)
+
+    def testParseCache(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection10', admin, public=True)
+        folder = Folder().createFolder(
+            collection, 'folder10', parentType='collection', public=True)
+        item = Item().createItem('item10', admin, folder)
+        self._uploadNonDicomFiles(item, admin)
+        self._uploadDicomFiles(item, admin)
+        expectedDicom = Item().load(item['_id'], force=True)['dicom']
+
+        # Files were parsed on upload, so nothing needs to be parsed again
+        counters = ReadCounters()
+        _makeDicomItem(Item().load(item['_id'], force=True), counters=counters)
+        self.assertEqual(counters.files, 0)
+        self.assertEqual(Item().load(item['_id'], force=True)['dicom'], expectedDicom)
+
+        # Only a file whose content changed is parsed again
+        file = File().findOne({'itemId': item['_id'], 'name': 'dicomFile2.dcm'})
+        File().update({'_id': file['_id']}, {'$set': {'sha512': 'changed'}})
+        counters = ReadCounters()
+        _makeDicomItem(Item().load(item['_id'], force=True), counters=counters)
+        self.assertEqual(counters.files, 1)
+        self.assertEqual(Item().load(item['_id'], force=True)['dicom'], expectedDicom)
+
+    def testTagFilterSettings(self):
+        admin, user = self.users
+
+        # Invalid rules are rejected
+        for value in [['NotADicomKeyword'], ['0011-0009'], 'PatientName']:
+            resp = self.request(path='/system/setting', method='PUT', user=admin, params={
+                'key': PluginSettings.TAG_DENY_LIST,
+                'value': json.dumps(value)
+            })
+            self.assertStatus(resp, 400)
+
+        Setting().set(PluginSettings.TAG_ALLOW_LIST, ['0008-0010', 'Rows', '(0028, 0011)'])
+        Setting().set(PluginSettings.TAG_DENY_LIST, ['PatientName'])
+        Setting().set(PluginSettings.INCLUDE_PRIVATE_TAGS, False)
+        Setting().set(PluginSettings.MAX_VALUE_LENGTH, 16)
+        try:
+            collection = Collection().createCollection('collection11', admin, public=True)
+            folder = Folder().createFolder(
+                collection, 'folder11', parentType='collection', public=True)
+            item = Item().createItem('item11', admin, folder)
+            self._uploadDicomFiles(item, admin)
+            uploadedItem = Item().load(item['_id'], force=True)
+            resp = self.request(
+                path='/item/%s/parseDicom' % item['_id'], method='POST', user=admin)
+            self.assertStatusOk(resp)
+            dicomItem = Item().load(item['_id'], force=True)
+        finally:
+            for key in [PluginSettings.TAG_ALLOW_LIST, PluginSettings.TAG_DENY_LIST,
+                        PluginSettings.INCLUDE_PRIVATE_TAGS, PluginSettings.MAX_VALUE_LENGTH]:
+                Setting().unset(key)
+
+        dicomMeta = dicomItem['dicom']['meta']
+        self.assertEqual(uploadedItem['dicom'], dicomItem['dicom'])
+        self.assertIn('Rows', dicomMeta)
+        self.assertIn('Columns', dicomMeta)
+        self.assertNotIn('PatientName', dicomMeta)
+        self.assertNotIn('SliceThickness', dicomMeta)
+        for key, value in dicomMeta.items():
+            self.assertFalse(key.startswith('('))
+            self.assertLessEqual(len(_searchString(value)), 16)
+
+        # The elements which index the files are parsed, but not stored
+        self.assertNotIn('SeriesInstanceUID', dicomMeta)
+        self.assertNotIn('ImagePositionPatient', dicomMeta)
+        series, = dicomItem['dicom']['series']
+        self.assertIsNotNone(series['SeriesInstanceUID'])
+        self.assertIsNotNone(series['SeriesNumber'])
+        self.assertEqual(series['fileCount'], 4)
+        self.assertIsNotNone(series['geometry']['sliceSpacing'])
+        self.assertNotIn('SeriesInstanceUID', series['meta'])
+        for fileData in dicomItem['dicom']['files']:
+            self.assertIsNotNone(fileData['dicom']['InstanceNumber'])
+            self.assertIsNotNone(fileData['dicom']['SlicePosition'])
+
+    def testHeaderReader(self):
+        admin, user = self.users
+        collection = Collection().createCollection('collection7', admin, public=True)
+        folder = Folder().createFolder(collection, 'folder7', parentType='collection', public=True)
+        item = Item().createItem('item7', admin, folder)
+        path = os.path.join(self.dataDir, '000000.dcm')
+        with open(path, 'rb') as fp:
+            dcmFile = Upload().uploadFromFile(
+                obj=fp, size=os.path.getsize(path), name='000000.dcm',
+                parentType='item', parent=item, mimeType='application/dicom', user=admin)
+        with open(path, 'rb') as fp:
+            expectedMeta = _parseStream(fp)
+        # Parsing stops where the PixelData element starts
+        with open(path, 'rb') as fp:
+            pydicom.dcmread(fp, stop_before_pixels=True)
+            pixelDataOffset = fp.tell()
+
+        # Only the header should be fetched, even with a tiny initial read
+        for prefetchSize in [16, 1024, 64 * 1024]:
+            with HeaderReader(dcmFile, prefetchSize) as fp:
+                self.assertEqual(_parseStream(fp), expectedMeta)
+            self.assertGreater(fp.bytesRead, 0)
+            self.assertLess(fp.bytesRead, dcmFile['size'])
+            self.assertEqual(fp.bytesRead, sum(end - start for start, end in fp.ranges))
+            # Every range was fetched to read the header: only their read-ahead,
+            # which at most doubles what was read, runs past the pixel data
+            self.assertTrue(all(start < pixelDataOffset for start, end in fp.ranges))
+            self.assertLessEqual(
+                max(end for start, end in fp.ranges) - pixelDataOffset,
+                max(prefetchSize, 2 * pixelDataOffset))
+
+        # A prefix which is too short must be reported, rather than parsed as the whole file
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        with self.assertRaises(HeaderTruncated):
+            _parseStream(PrefixBuffer(content[:256], len(content)))
+        self.assertEqual(_parseStream(PrefixBuffer(content, len(content))), expectedMeta)
+
     def _uploadNonDicomFiles(self, item, user):
         # Upload a fake file to check that the item is not traited
         nonDicomContent = b'hello world\n'
@@ -222,8 +1046,138 @@ class DicomViewerTest(base.TestCase):
         self.assertEqual(len(resp.json['item']), 1)
         self.assertEqual(resp.json['item'][0]['name'], 'item3')
 
-        # TODO: Add test to search for a private DICOM item with an other user
-        # this test should not found anything
+        # Search for DICOM item with a case-insensitive substring of a key
+        resp = self.request(path='/resource/search', params={
+            'q': 'SopClassU',
+            'mode': 'dicom',
+            'types': json.dumps(['item'])
+        })
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['item']), 1)
+        self.assertNotIn('dicomSearch', resp.json['item'][0])
+
+        # Regular expression characters are matched literally
+        resp = self.request(path='/resource/search', params={
+            'q': 'brain.*',
+            'mode': 'dicom',
+            'types': json.dumps(['item'])
+        })
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['item']), 0)
+
+        # Only the first 256 characters of long values are searched
+        dicomMeta = Item().load(item['_id'], force=True)['dicom']['meta']
+        dicomMeta['ImageComments'] = 'a' * 200 + 'early' + 'b' * 100 + 'late'
+        Item().update({'_id': item['_id']}, {'$set': {
+            'dicom.meta': dicomMeta, 'dicomSearch': _searchTokens(dicomMeta)}})
+        for query, found in [('early', 1), ('ybbb', 1), ('late', 0), ('bbblate', 0)]:
+            resp = self.request(path='/resource/search', params={
+                'q': query,
+                'mode': 'dicom',
+                'types': json.dumps(['item'])
+            })
+            self.assertStatusOk(resp)
+            self.assertEqual(len(resp.json['item']), found)
+
+    def testSearchDicomItemsPages(self):
+        admin, user = self.users
+
+        collection = Collection().createCollection('collection19', admin, public=True)
+        public = Folder().createFolder(
+            collection, 'public19', parentType='collection', public=True)
+        private = Folder().createFolder(
+            collection, 'private19', parentType='collection', public=False)
+        items = [Item().createItem('item19-%d' % index, admin, public) for index in range(3)]
+        items.append(Item().createItem('item19-private', admin, private))
+        for item in items:
+            Item().update({'_id': item['_id']}, {'$set': {
+                'dicomSearch': ['patientname', 'search19 patient']}})
+
+        # Pages follow each other by the ID of their last item
+        names = []
+        after = None
+        while True:
+            params = {'q': 'SEARCH19', 'limit': 2}
+            if after:
+                params['after'] = after
+            resp = self.request(path='/item/dicom/search', user=user, params=params)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json['total'], 3)
+            names.extend(item['name'] for item in resp.json['item'])
+            after = resp.json['next']
+            if not after:
+                break
+        self.assertEqual(names, ['item19-0', 'item19-1', 'item19-2'])
+
+        # The private item is only found by users who can read its folder
+        resp = self.request(path='/item/dicom/search', user=admin, params={
+            'q': 'search19', 'count': False})
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['item']), 4)
+        self.assertIsNone(resp.json['total'])
+        resp = self.request(path='/resource/search', params={
+            'q': 'search19',
+            'mode': 'dicom',
+            'types': json.dumps(['item']),
+            'offset': 1
+        }, user=user)
+        self.assertStatusOk(resp)
+        self.assertEqual([item['name'] for item in resp.json['item']], ['item19-1', 'item19-2'])
+
+        # Granting access to the folder invalidates the cached accessible folders
+        Folder().setUserAccess(private, user, AccessType.READ, save=True)
+        resp = self.request(path='/item/dicom/search', user=user, params={'q': 'search19'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['total'], 4)
+
+        resp = self.request(path='/item/dicom/search', user=user, params={
+            'q': 'search19', 'after': 'invalid'})
+        self.assertStatus(resp, 400)
+
+    def testDicomFacets(self):
+        admin, user = self.users
+
+        collection = Collection().createCollection('collection20', admin, public=True)
+        public = Folder().createFolder(
+            collection, 'public20', parentType='collection', public=True)
+        private = Folder().createFolder(
+            collection, 'private20', parentType='collection', public=False)
+        for name, modality, folder in [
+                ('ct1', 'CT', public), ('ct2', 'CT', public), ('mr', 'MR', public),
+                ('us', 'US', private)]:
+            item = Item().createItem(name, admin, folder)
+            Item().update({'_id': item['_id']}, {'$set': {'dicom': {
+                'meta': {'Modality': modality, 'ImageType': ['ORIGINAL', 'PRIMARY']},
+                'files': []}}})
+
+        resp = self.request(path='/item/dicom/facets', user=user, params={
+            'fields': json.dumps(['Modality', 'ImageType', 'Manufacturer'])})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['Modality'], [
+            {'value': 'CT', 'count': 2}, {'value': 'MR', 'count': 1}])
+        # Each value of multi-valued elements is counted
+        self.assertEqual(resp.json['ImageType'], [
+            {'value': 'ORIGINAL', 'count': 3}, {'value': 'PRIMARY', 'count': 3}])
+        self.assertEqual(resp.json['Manufacturer'], [])
+
+        resp = self.request(path='/item/dicom/facets', user=user, params={'limit': 1})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['Modality'], [{'value': 'CT', 'count': 2}])
+
+        # Parsing an item invalidates the cached counts
+        item = Item().createItem('item20', admin, public)
+        self._uploadDicomFiles(item, admin)
+        modality = Item().load(item['_id'], force=True)['dicom']['meta']['Modality']
+        resp = self.request(path='/item/dicom/facets', user=user, params={
+            'fields': json.dumps(['Modality'])})
+        self.assertStatusOk(resp)
+        counts = {facet['value']: facet['count'] for facet in resp.json['Modality']}
+        self.assertEqual(sum(counts.values()), 4)
+        self.assertGreaterEqual(counts[modality], 1)
+
+        resp = self.request(path='/item/dicom/facets', user=user, params={
+            'fields': json.dumps(['NotAKeyword'])})
+        self.assertStatus(resp, 400)
 
     def testDicomWithIOError(self):
         # One of the test files in the pydicom module will throw an IOError
@@ -44,6 +44,10 @@ setup(
     zip_safe=False,
     install_requires=[
         'girder>=3',
+        # Not on PyPI: install ../plugin_utils first, see the README
+        'girder-plugin-utils',
+        'numpy',
+        'Pillow',
         'pydicom>=2',
     ],
     entry_points={
@@ -1,8 +1,15 @@
 import datetime
+import gzip
 import json
 import io
+import re
+import struct
+import threading
+import time
 from pathlib import Path
 
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 import nibabel as nib
 import numpy as np
 
@@ -10,12 +17,91 @@ from girder import events
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
 from girder.api.rest import Resource
-from girder.constants import AccessType, TokenScope
+from girder.constants import AccessType, SortDir, TokenScope
 from girder.exceptions import RestException
 from girder.plugin import GirderPlugin, registerPluginStaticContent
 from girder.models.item import Item
 from girder.models.file import File
+from girder.models.setting import Setting
 from girder.utility import search
+from girder_plugin_utils.item_search import AccessibleFolders, FacetCache, searchItems
+from girder_plugin_utils.parse_queue import ParseQueue
+
+from .settings import PluginSettings
+
+# Compressed .nii.gz files start with the gzip magic number
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Enough bytes for either header: NIfTI-1 headers are 348 bytes long
+NIFTI2_HEADER_SIZE = 540
+
+# Header fields copied into item['niftiSummary'], so that item listings do not
+# include the whole NIfTI metadata
+NIFTI_SUMMARY_KEYS = ('dimensions', 'pixelSpacing', 'dataType', 'orientation', 'file_type')
+
+# Header fields whose values are searched by the 'nifti' search mode
+NIFTI_SEARCH_KEYS = (
+    'orientation', 'dataType', 'datatype', 'units', 'time_units', 'file_type',
+    'dimensions', 'dims', 'pixelSpacing', 'pixdim'
+)
+
+# BIDS sidecar fields whose values are searched, whether they are stored in
+# 'json_metadata' (parseNifti) or merged into the metadata (upload handler)
+NIFTI_SEARCH_BIDS_KEYS = (
+    'ProtocolName', 'SeriesDescription', 'SequenceName', 'PulseSequenceType',
+    'ScanningSequence', 'SequenceVariant', 'Manufacturer', 'ManufacturersModelName',
+    'DeviceSerialNumber', 'StationName', 'SoftwareVersions', 'InstitutionName',
+    'InstitutionAddress', 'InstitutionalDepartmentName', 'MagneticFieldStrength',
+    'ReceiveCoilName', 'TransmitCoilName', 'ImageType', 'ConversionSoftware',
+    'ConversionSoftwareVersion'
+)
+
+# Length of the n-grams of item['niftiSearch'], which narrow substring searches
+# down to the items containing every n-gram of the query
+NIFTI_SEARCH_GRAM_LENGTH = 3
+
+# Longer values are only searched on their first characters
+NIFTI_SEARCH_MAX_VALUE_LENGTH = 256
+
+# The fields which a search can be scoped to, as in 'Manufacturer:siemens',
+# by lowercased name; 'name' is the name of the files
+NIFTI_SEARCH_FIELD_NAMES = {
+    key.lower(): key for key in NIFTI_SEARCH_KEYS + NIFTI_SEARCH_BIDS_KEYS + ('name',)
+}
+
+# Numeric fields of item['niftiFields'] which searches can filter on: the
+# size of each axis (1 for missing axes), the voxel spacing in millimeters,
+# the repetition time in seconds and the magnetic field strength in teslas
+NIFTI_FILTER_FIELDS = (
+    'ndim', 'dimX', 'dimY', 'dimZ', 'dimT', 'spacingX', 'spacingY', 'spacingZ',
+    'maxSpacing', 'repetitionTime', 'fieldStrength'
+)
+
+# Comparison operators of search filters
+NIFTI_FILTER_OPERATORS = {'eq': '$eq', 'lt': '$lt', 'lte': '$lte', 'gt': '$gt', 'gte': '$gte'}
+
+# Compound indexes of item['niftiFields'] for common cohort selections, with
+# the fields usually compared for equality first
+NIFTI_FILTER_INDEXES = (
+    ('fieldStrength', 'maxSpacing'),
+    ('fieldStrength', 'dimT'),
+    ('dimT', 'repetitionTime'),
+    ('maxSpacing',),
+)
+
+# Millimeters, seconds, per unit of the NIfTI header; unknown spatial units
+# are taken as millimeters, like nibabel does
+NIFTI_SPACE_UNIT_SCALES = {'meter': 1000.0, 'mm': 1.0, 'micron': 0.001, 'unknown': 1.0}
+NIFTI_TIME_UNIT_SCALES = {'sec': 1.0, 'msec': 0.001, 'usec': 0.000001}
+
+# Fields counted by GET /item/nifti/facets by default; any of the searched
+# header and BIDS fields may be counted
+NIFTI_FACET_FIELDS = ('orientation', 'dataType', 'Manufacturer')
+
+# The version of item['niftiSummary'], item['niftiSearch'] and
+# item['niftiFields']; items are summarized again once when the plugin loads
+# with a newer version
+NIFTI_SUMMARY_VERSION = 1
 
 
 class NiftiViewerPlugin(GirderPlugin):
@@ -23,17 +109,38 @@ class NiftiViewerPlugin(GirderPlugin):
     CLIENT_SOURCE_PATH = 'web_client'
 
     def load(self, info):
-        # Expose the 'nifti' field on items
-        Item().exposeFields(level=AccessType.READ, fields={'nifti'})
+        # Expose only a summary on items; the whole 'nifti' field is fetched
+        # from GET /item/:id/nifti
+        Item().exposeFields(level=AccessType.READ, fields={'niftiSummary', 'niftiProcessing'})
+        for index in ('niftiSearch.grams', 'niftiSearch.values', 'niftiSearch.fields'):
+            Item().ensureIndex(index)
+        for fields in NIFTI_FILTER_INDEXES:
+            Item().ensureIndex((
+                [(f'niftiFields.{field}', SortDir.ASCENDING) for field in fields],
+                {'sparse': True}))
+        _migrateSummaries()
+        _resumeQueuedItems()
         
         # Bind event handler for automatic parsing on upload
         events.bind('data.process', 'nifti_viewer', _uploadHandler)
+        # Folder access lists and group memberships determine search results
+        for event in ('model.folder.save', 'model.folder.remove', 'model.user.save'):
+            events.bind(event, 'nifti_viewer', _clearSearchCaches)
+        events.bind('model.item.remove', 'nifti_viewer', _facetCache.clear)
 
         # Add NIfTI search mode
         search.addSearchMode('nifti', niftiSubstringSearchHandler)
 
         # Register REST endpoints
         niftiItem = NiftiItem()
+        info['apiRoot'].item.route(
+            'GET', ('nifti', 'queue'), niftiItem.getParseQueueMetrics)
+        info['apiRoot'].item.route(
+            'GET', ('nifti', 'search'), niftiItem.searchNiftiItems)
+        info['apiRoot'].item.route(
+            'GET', ('nifti', 'facets'), niftiItem.getNiftiFacets)
+        info['apiRoot'].item.route(
+            'GET', (':id', 'nifti'), niftiItem.getNiftiItem)
         info['apiRoot'].item.route(
             'POST', (':id', 'parseNifti'), niftiItem.makeNiftiItem)
 
@@ -49,6 +156,104 @@ class NiftiViewerPlugin(GirderPlugin):
 
 class NiftiItem(Resource):
 
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Get the NIfTI metadata and files of an item.')
+        .modelParam('id', 'The item ID',
+                    model='item', level=AccessType.READ, paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('The item is not a NIfTI item.')
+        .errorResponse('Read permission denied on the item.', 403)
+    )
+    def getNiftiItem(self, item):
+        if 'nifti' not in item:
+            raise RestException('The item is not a NIfTI item.')
+        return item['nifti']
+
+    @access.admin(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Get the metrics of the queue which parses uploaded NIfTI files.')
+        .notes('Uploads are queued when the "nifti_viewer.upload_processing" setting '
+               'is "async"; the status of each queued item is in its "niftiProcessing" field.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def getParseQueueMetrics(self):
+        return _getParseQueue().metrics()
+
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Search the NIfTI items, with the syntax of the "nifti" search mode '
+                    'and numeric filters.')
+        .notes('Items are returned in the order of their IDs; pass the "next" value '
+               'of a page as "after" to get the following page. Filters map fields '
+               f'({", ".join(NIFTI_FILTER_FIELDS)}) to a number or to comparisons '
+               f'({", ".join(NIFTI_FILTER_OPERATORS)}), e.g. {{"maxSpacing": {{"lt": 1}}, '
+               '"dimT": {"gt": 200}, "fieldStrength": 3}. Spacings are in millimeters '
+               'and the repetition time in seconds.')
+        .param('q', 'The search query, e.g. "mprage", "Manufacturer:siemens" or "siem*".',
+               required=False)
+        .jsonParam('filters', 'The numeric filters, as a JSON object.',
+                   required=False, requireObject=True)
+        .param('limit', 'The maximum number of items to return.',
+               required=False, dataType='integer', default=50)
+        .param('after', 'The ID of the last item of the previous page.', required=False)
+        .param('count', 'Whether to count all the matching items.',
+               required=False, dataType='boolean', default=True)
+        .errorResponse('The limit, the filters or the ID of the previous item was invalid.')
+    )
+    def searchNiftiItems(self, q, filters, limit, after, count):
+        if limit < 1:
+            raise RestException('The limit must be positive.')
+        if after is not None:
+            try:
+                after = ObjectId(after)
+            except InvalidId:
+                raise RestException(f'Invalid ObjectId: {after}')
+        query = {'nifti': {'$exists': True}}
+        if q is not None:
+            query.update(_buildSearchQuery(q))
+        if filters:
+            query.update(_buildFilterQuery(filters))
+        user = self.getCurrentUser()
+        items, total = searchItems(
+            query, _accessibleFolders, user, AccessType.READ,
+            limit=limit, after=after, count=count)
+        return {
+            'item': [Item().filter(item, user) for item in items],
+            'total': total,
+            'next': str(items[-1]['_id']) if len(items) == limit else None
+        }
+
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Count the NIfTI items having each value of header or BIDS fields.')
+        .notes('Only the items which the user can read are counted. Counts are cached '
+               'until NIfTI metadata is written, so they may lag behind for a few '
+               'minutes after other changes, e.g. moved items. Fields: '
+               f'{", ".join(NIFTI_SEARCH_KEYS + NIFTI_SEARCH_BIDS_KEYS)}.')
+        .jsonParam('fields', 'The fields to count, as a JSON list.',
+                   required=False, requireArray=True, default=list(NIFTI_FACET_FIELDS))
+        .param('limit', 'The maximum number of values of each field, by decreasing count.',
+               required=False, dataType='integer', default=50)
+        .errorResponse('A field or the limit was invalid.')
+    )
+    def getNiftiFacets(self, fields, limit):
+        if limit < 1:
+            raise RestException('The limit must be positive.')
+        facets = {}
+        for field in fields:
+            if field in NIFTI_SEARCH_KEYS:
+                facets[field] = f'$nifti.meta.{field}'
+            elif field in NIFTI_SEARCH_BIDS_KEYS:
+                # Stored by parseNifti in 'json_metadata', merged on upload
+                facets[field] = {'$ifNull': [
+                    f'$nifti.meta.json_metadata.{field}', f'$nifti.meta.{field}']}
+            else:
+                raise RestException(f'Invalid facet field: {field}')
+        return _facetCache.counts(
+            {'nifti': {'$exists': True}}, facets, _accessibleFolders, self.getCurrentUser(),
+            AccessType.READ, limit=limit)
+
     @access.user(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
         Description('Parse NIfTI files and extract metadata from NIfTI header and optional JSON sidecar')
@@ -62,188 +267,235 @@ class NiftiItem(Resource):
         Convert an existing item into a "NIfTI item", which contains
         extracted metadata from NIfTI header and optional JSON sidecar files.
         """
-        niftiFile = None
-        jsonFile = None
-        
-        # Find NIfTI and JSON files in the item
-        for file in Item().childFiles(item):
-            name = file['name'].lower()
-            if name.endswith('.nii') or name.endswith('.nii.gz'):
-                niftiFile = file
-            elif name.endswith('.json'):
-                jsonFile = file
-        
-        if not niftiFile:
-            # No NIfTI file found, just return the item unchanged
-            return item
-        
-        # Parse NIfTI header metadata
+        return _makeNiftiItem(item)
+
+
+def _makeNiftiItem(item):
+    """
+    Parse the NIfTI file and the optional JSON sidecar of an item, and store
+    their metadata in the item.
+
+    :param item: Girder item document
+    :returns: The item, saved if it has a NIfTI file
+    """
+    niftiFile = None
+    jsonFile = None
+    
+    # Find NIfTI and JSON files in the item
+    for file in Item().childFiles(item):
+        name = file['name'].lower()
+        if name.endswith('.nii') or name.endswith('.nii.gz'):
+            niftiFile = file
+        elif name.endswith('.json'):
+            jsonFile = file
+    
+    if not niftiFile:
+        # No NIfTI file found, just return the item unchanged
+        return item
+    
+    # Parse NIfTI header metadata
+    try:
+        niftiMeta = _parseNiftiFile(niftiFile)
+    except Exception as e:
+        raise RestException(f'Failed to parse NIfTI file: {str(e)}')
+    
+    # Parse JSON metadata if present (optional)
+    jsonMeta = {}
+    if jsonFile:
         try:
-            niftiMeta = _parseNiftiFile(niftiFile)
+            jsonMeta = _parseJsonFile(jsonFile)
         except Exception as e:
-            raise RestException(f'Failed to parse NIfTI file: {str(e)}')
-        
-        # Parse JSON metadata if present (optional)
-        jsonMeta = {}
-        if jsonFile:
-            try:
-                jsonMeta = _parseJsonFile(jsonFile)
-            except Exception as e:
-                # JSON parsing is optional, log warning but continue
-                print(f'Warning: Failed to parse JSON file: {str(e)}')
-        
-        # Combine metadata
-        combinedMeta = {**niftiMeta}
-        if jsonMeta:
-            combinedMeta['json_metadata'] = jsonMeta
-        
-        # Build files array (JavaScript expects an array, not an object)
-        files = [_extractFileData(niftiFile)]
-        if jsonFile:
-            files.append(_extractFileData(jsonFile))
-        
-        # Store in the item
-        item['nifti'] = {
-            'meta': combinedMeta,
-            'files': files
-        }
-        
-        # Save the item
-        return Item().save(item)
+            # JSON parsing is optional, log warning but continue
+            print(f'Warning: Failed to parse JSON file: {str(e)}')
+    
+    # Combine metadata
+    combinedMeta = {**niftiMeta}
+    if jsonMeta:
+        combinedMeta['json_metadata'] = jsonMeta
+    
+    # Build files array (JavaScript expects an array, not an object)
+    files = [_extractFileData(niftiFile)]
+    if jsonFile:
+        files.append(_extractFileData(jsonFile))
+    
+    # Store in the item
+    item['nifti'] = {
+        'meta': combinedMeta,
+        'files': files
+    }
+    item['niftiSummary'] = _niftiSummary(item['nifti'])
+    item['niftiSearch'] = _niftiSearch(item['nifti'])
+    item['niftiFields'] = _niftiFields(item['nifti'])
+    
+    # Save the item
+    item = Item().save(item)
+    _facetCache.clear()
+    return item
+
+
+def _headerFromBytes(data):
+    """
+    Build the NIfTI-1 or NIfTI-2 header at the start of some bytes, telling
+    them apart by their sizeof_hdr field, in either byte order.
+    """
+    if len(data) < 4:
+        raise ValueError('The file is too short to be a NIfTI file')
+    for headerClass in (nib.Nifti1Header, nib.Nifti2Header):
+        size = headerClass.sizeof_hdr
+        if size in (struct.unpack('<i', data[:4])[0], struct.unpack('>i', data[:4])[0]):
+            if len(data) < size:
+                raise ValueError('The NIfTI header is truncated')
+            return headerClass.from_fileobj(io.BytesIO(data[:size]))
+    raise ValueError('The file does not start with a NIfTI-1 or NIfTI-2 header')
+
+
+def _readNiftiHeader(file, maxBytes):
+    """
+    Read the header of a NIfTI file and its extensions from the start of its
+    stream, stopping at vox_offset so that voxel data is never read.
+    Compressed files are recognized by their gzip magic number rather than
+    their name, and only the bytes before vox_offset are inflated.
+
+    :param file: Girder file document
+    :param maxBytes: The most bytes to read, so that a malformed vox_offset
+        cannot cause a huge read; extensions beyond it are not read
+    :returns: The Nifti1Header or Nifti2Header, and the bytes which follow
+        it, up to vox_offset or maxBytes
+    :raises ValueError: If the file does not start with a NIfTI header
+    """
+    with File().open(file) as f:
+        compressed = f.read(2) == GZIP_MAGIC
+        f.seek(0)
+        stream = gzip.GzipFile(fileobj=f, mode='rb') if compressed else f
+        data = stream.read(NIFTI2_HEADER_SIZE)
+        header = _headerFromBytes(data)
+        end = min(max(int(header['vox_offset']), header.sizeof_hdr), maxBytes)
+        if end > len(data):
+            data += stream.read(end - len(data))
+    return header, data[header.sizeof_hdr:end]
+
+
+def _parseNiftiExtensions(header, data):
+    """
+    List the extensions which follow a NIfTI header.
+
+    :param header: The Nifti1Header or Nifti2Header
+    :param data: The bytes which follow the header, up to vox_offset
+    :returns: The code, name and size of each extension, and whether some
+        extensions were not read in full
+    """
+    extensions = []
+    # The first byte of the extender flags whether extensions follow
+    if len(data) < 4 or data[0] == 0:
+        return extensions, False
+    offset = 4
+    while offset + 8 <= len(data):
+        size, code = struct.unpack(header.endianness + 'ii', data[offset:offset + 8])
+        if size < 16 or size % 16:
+            # Malformed extension: the next ones cannot be located
+            break
+        if offset + size > len(data):
+            return extensions, True
+        try:
+            name = nib.nifti1.extension_codes.label[code]
+        except KeyError:
+            name = 'unknown'
+        extensions.append({'code': code, 'name': name, 'size': size})
+        offset += size
+    # The extensions end before vox_offset, unless the read budget cut them
+    return extensions, len(data) < int(header['vox_offset']) - header.sizeof_hdr
 
 
 def _parseNiftiFile(file):
     """
     Extract metadata from NIfTI file header using nibabel.
     Supports both compressed (.nii.gz) and uncompressed (.nii) files.
-    
+
     :param file: Girder file document
     :returns: Dictionary with NIfTI metadata
     """
-    import tempfile
-    import shutil
-    import os
+    maxBytes = Setting().get(PluginSettings.MAX_READ_BYTES)
+    header, extensionData = _readNiftiHeader(file, maxBytes)
+    extensions, extensionsTruncated = _parseNiftiExtensions(header, extensionData)
+    # The affine nibabel gives to images loaded with this header
+    affine = header.get_best_affine()
     
-    # Determine the correct file extension based on the original file name
-    filename = file['name'].lower()
-    if filename.endswith('.nii.gz'):
-        suffix = '.nii.gz'
-    elif filename.endswith('.nii'):
-        suffix = '.nii'
-    else:
-        # Fallback - try both extensions
-        suffix = '.nii.gz'
-    
-    # Save to temporary file (nibabel needs a file path)
-    # Use streaming to avoid loading entire file in memory
-    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
-        tmp_path = tmp.name
-        with File().open(file) as f:
-            # Stream the file in chunks to avoid memory issues
-            shutil.copyfileobj(f, tmp, length=1024*1024)  # 1MB chunks
-        # Ensure all data is written to disk before reading
-        tmp.flush()
+    # Extract key metadata
+    # Use field names that match frontend expectations
+    dims = list(header.get_data_shape())
+    pixdim = [float(x) for x in header.get_zooms()]
+
+    meta = {
+        # Frontend-compatible field names
+        'dimensions': dims,  # Frontend expects 'dimensions'
+        'pixelSpacing': pixdim,  # Frontend expects 'pixelSpacing'
+        'dataType': str(header.get_data_dtype()),  # Frontend expects 'dataType'
+        'units': _get_space_units(header),  # Frontend expects just the string
+
+        # Keep legacy field names for backward compatibility
+        'dims': dims,
+        'pixdim': pixdim,
+        'datatype': str(header.get_data_dtype()),
+
+        # Additional metadata
+        'qform_code': int(header['qform_code']),
+        'sform_code': int(header['sform_code']),
+        'time_units': _get_time_units(header),
+        'file_type': 'NIfTI-1' if header['sizeof_hdr'] == 348 else 'NIfTI-2',
+
+        # Header extensions (embedded DICOM, AFNI, JSON...), without their content
+        'extensions': extensions,
+        'extensionsTruncated': extensionsTruncated,
+    }
     
+    # Add orientation if available
     try:
-        # Load with nibabel
-        img = nib.load(tmp_path)
-        header = img.header
-        
-        # Extract key metadata
-        # Use field names that match frontend expectations
-        dims = list(header.get_data_shape())
-        pixdim = [float(x) for x in header.get_zooms()]
-
-        meta = {
-            # Frontend-compatible field names
-            'dimensions': dims,  # Frontend expects 'dimensions'
-            'pixelSpacing': pixdim,  # Frontend expects 'pixelSpacing'
-            'dataType': str(header.get_data_dtype()),  # Frontend expects 'dataType'
-            'units': _get_space_units(header),  # Frontend expects just the string
-
-            # Keep legacy field names for backward compatibility
-            'dims': dims,
-            'pixdim': pixdim,
-            'datatype': str(header.get_data_dtype()),
-
-            # Additional metadata
-            'qform_code': int(header['qform_code']),
-            'sform_code': int(header['sform_code']),
-            'time_units': _get_time_units(header),
-            'file_type': 'NIfTI-1' if header['sizeof_hdr'] == 348 else 'NIfTI-2',
-        }
-        
-        # Add orientation if available
-        try:
-            orientation = nib.aff2axcodes(img.affine)
-            meta['orientation'] = ''.join(orientation)
-        except Exception:
-            meta['orientation'] = 'Unknown'
+        orientation = nib.aff2axcodes(affine)
+        meta['orientation'] = ''.join(orientation)
+    except Exception:
+        meta['orientation'] = 'Unknown'
 
-        # Add affine matrix
-        try:
-            meta['affine'] = img.affine.tolist()
-        except Exception:
-            meta['affine'] = None
+    # Add affine matrix
+    try:
+        meta['affine'] = affine.tolist()
+    except Exception:
+        meta['affine'] = None
 
-        # Add voxel volume (frontend expects 'voxelSize')
-        try:
-            voxel_volume = np.prod(header.get_zooms()[:3])
-            meta['voxelSize'] = float(voxel_volume)  # Frontend field name
-            meta['voxel_volume'] = float(voxel_volume)  # Legacy field name
-        except Exception:
-            meta['voxelSize'] = None
-            meta['voxel_volume'] = None
-
-        # Add image size in bytes (frontend expects 'imageSize')
-        try:
-            # Calculate total image size (dimensions × bytes per voxel)
-            bytes_per_voxel = header.get_data_dtype().itemsize
-            total_voxels = np.prod(dims)
-            image_size_bytes = total_voxels * bytes_per_voxel
-            # Frontend expects [width, height, depth] format
-            meta['imageSize'] = dims  # Same as dimensions for 3D images
-        except Exception:
-            meta['imageSize'] = dims
-
-        return meta
-    finally:
-        # Clean up temporary file
-        try:
-            os.unlink(tmp_path)
-        except Exception:
-            pass
+    # Add voxel volume (frontend expects 'voxelSize')
+    try:
+        voxel_volume = np.prod(header.get_zooms()[:3])
+        meta['voxelSize'] = float(voxel_volume)  # Frontend field name
+        meta['voxel_volume'] = float(voxel_volume)  # Legacy field name
+    except Exception:
+        meta['voxelSize'] = None
+        meta['voxel_volume'] = None
+
+    # Add image size in bytes (frontend expects 'imageSize')
+    try:
+        # Calculate total image size (dimensions × bytes per voxel)
+        bytes_per_voxel = header.get_data_dtype().itemsize
+        total_voxels = np.prod(dims)
+        image_size_bytes = total_voxels * bytes_per_voxel
+        # Frontend expects [width, height, depth] format
+        meta['imageSize'] = dims  # Same as dimensions for 3D images
+    except Exception:
+        meta['imageSize'] = dims
+
+    return meta
 
 
 def _get_space_units(header):
-    """Get spatial units from NIfTI header."""
-    units_dict = {
-        0: 'unknown',
-        1: 'meter',
-        2: 'mm',
-        3: 'micron'
-    }
+    """Get spatial units from NIfTI header, as nibabel names them (e.g. 'mm')."""
     try:
-        unit_code = header.get_xyzt_units()[0]
-        return units_dict.get(unit_code, 'unknown')
+        return header.get_xyzt_units()[0]
     except Exception:
         return 'unknown'
 
 
 def _get_time_units(header):
-    """Get temporal units from NIfTI header."""
-    units_dict = {
-        0: 'unknown',
-        8: 'sec',
-        16: 'msec',
-        24: 'usec',
-        32: 'Hz',
-        40: 'ppm',
-        48: 'rads'
-    }
+    """Get temporal units from NIfTI header, as nibabel names them (e.g. 'msec')."""
     try:
-        unit_code = header.get_xyzt_units()[1]
-        return units_dict.get(unit_code, 'unknown')
+        return header.get_xyzt_units()[1]
     except Exception:
         return 'unknown'
 
@@ -254,7 +506,11 @@ def _parseJsonFile(file):
     
     :param file: Girder file document
     :returns: Dictionary with JSON content
+    :raises ValueError: If the file is larger than the read budget, or is not JSON
     """
+    maxBytes = Setting().get(PluginSettings.MAX_READ_BYTES)
+    if file['size'] > maxBytes:
+        raise ValueError(f'The JSON file is larger than {maxBytes} bytes')
     with File().open(file) as f:
         content = f.read()
         if isinstance(content, bytes):
@@ -277,6 +533,230 @@ def _extractFileData(file):
     }
 
 
+def _niftiSummary(nifti):
+    """
+    Build the compact description of a NIfTI item which is included in item
+    listings.
+
+    :param nifti: The 'nifti' field of an item
+    :returns: Dictionary with the main header fields and the number of files
+    """
+    meta = nifti.get('meta') or {}
+    summary = {key: meta[key] for key in NIFTI_SUMMARY_KEYS if key in meta}
+    summary['files'] = len(nifti.get('files') or [])
+    return summary
+
+
+def _searchValues(value):
+    """
+    Flatten a metadata value into the lowercased strings which are searched.
+    Integral numbers are written without a fraction, so that '64' matches 64.0.
+    """
+    if isinstance(value, (list, tuple)):
+        return [text for entry in value for text in _searchValues(entry)]
+    if isinstance(value, bool) or value is None or isinstance(value, dict):
+        return []
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return [str(value).lower()[:NIFTI_SEARCH_MAX_VALUE_LENGTH]]
+
+
+def _searchGrams(text):
+    """
+    :returns: The set of the n-grams of a lowercased string, or the string
+        itself if it is shorter than an n-gram.
+    """
+    length = NIFTI_SEARCH_GRAM_LENGTH
+    if len(text) < length:
+        return {text} if text else set()
+    return {text[index:index + length] for index in range(len(text) - length + 1)}
+
+
+def _niftiSearch(nifti):
+    """
+    Build the normalized search tokens of a NIfTI item, which the 'nifti'
+    search mode queries instead of the metadata itself.
+
+    :param nifti: The 'nifti' field of an item
+    :returns: Dictionary with the sorted lowercased ``values`` of the searched
+        fields and file names, the same values prefixed by their lowercased
+        field name as ``fields`` (e.g. 'manufacturer:siemens'), and the
+        sorted n-grams of the values
+    """
+    meta = nifti.get('meta') or {}
+    jsonMeta = meta.get('json_metadata') or {}
+    fields = set()
+    for key in NIFTI_SEARCH_KEYS:
+        fields.update((key, value) for value in _searchValues(meta.get(key)))
+    for key in NIFTI_SEARCH_BIDS_KEYS:
+        fields.update((key, value) for value in _searchValues(jsonMeta.get(key, meta.get(key))))
+    for niftiFile in nifti.get('files') or []:
+        fields.update(('name', value) for value in _searchValues(niftiFile.get('name')))
+    fields = {(key, value) for key, value in fields if value}
+    values = {value for key, value in fields}
+    grams = set()
+    for value in values:
+        grams.update(_searchGrams(value))
+    return {
+        'values': sorted(values),
+        'fields': sorted(f'{key.lower()}:{value}' for key, value in fields),
+        'grams': sorted(grams)
+    }
+
+
+def _number(value):
+    """:returns: The value as a float, or None if it is not a finite number."""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def _niftiFields(nifti):
+    """
+    Normalize the numeric header and BIDS fields of a NIfTI item which
+    searches filter on, so that they are compared in the same units.
+
+    :param nifti: The 'nifti' field of an item
+    :returns: Dictionary of the ``NIFTI_FILTER_FIELDS`` which are known
+    """
+    meta = nifti.get('meta') or {}
+    jsonMeta = meta.get('json_metadata') or {}
+    dims = [_number(dim) for dim in meta.get('dimensions') or meta.get('dims') or []]
+    pixdim = [_number(size) for size in meta.get('pixelSpacing') or meta.get('pixdim') or []]
+
+    fields = {}
+    if dims and None not in dims:
+        fields['ndim'] = len(dims)
+        for index, axis in enumerate('XYZT'):
+            fields[f'dim{axis}'] = int(dims[index]) if index < len(dims) else 1
+    spaceScale = NIFTI_SPACE_UNIT_SCALES.get(meta.get('units'))
+    if spaceScale is not None:
+        spacing = [size * spaceScale if size is not None else None for size in pixdim[:3]]
+        for axis, size in zip('XYZ', spacing):
+            if size is not None:
+                fields[f'spacing{axis}'] = size
+        if spacing and None not in spacing:
+            fields['maxSpacing'] = max(spacing)
+
+    repetitionTime = _number(jsonMeta.get('RepetitionTime', meta.get('RepetitionTime')))
+    timeScale = NIFTI_TIME_UNIT_SCALES.get(meta.get('time_units'))
+    if repetitionTime is None and len(pixdim) > 3 and pixdim[3] and timeScale:
+        # The spacing of the time axis
+        repetitionTime = pixdim[3] * timeScale
+    if repetitionTime is not None:
+        fields['repetitionTime'] = repetitionTime
+    fieldStrength = _number(
+        jsonMeta.get('MagneticFieldStrength', meta.get('MagneticFieldStrength')))
+    if fieldStrength is not None:
+        fields['fieldStrength'] = fieldStrength
+    return fields
+
+
+def _addMissingSummaries():
+    """
+    Summarize the NIfTI items again, e.g. those which were parsed before their
+    summary, search tokens and filter fields were stored. This scans every
+    NIfTI item, so it only runs when ``NIFTI_SUMMARY_VERSION`` changes.
+    """
+    for item in Item().find({'nifti': {'$exists': True}}, fields=['nifti']):
+        Item().update({'_id': item['_id']}, {'$set': {
+            'niftiSummary': _niftiSummary(item['nifti']),
+            'niftiSearch': _niftiSearch(item['nifti']),
+            'niftiFields': _niftiFields(item['nifti'])
+        }})
+
+
+def _migrateSummaries():
+    """
+    Summarize the NIfTI items again if they were summarized by an older
+    version of the plugin, once.
+    """
+    if Setting().get(PluginSettings.SUMMARY_VERSION) < NIFTI_SUMMARY_VERSION:
+        _addMissingSummaries()
+        Setting().set(PluginSettings.SUMMARY_VERSION, NIFTI_SUMMARY_VERSION)
+
+
+_parseQueue = None
+_parseQueueLock = threading.Lock()
+
+
+def _getParseQueue():
+    """
+    Get the queue of NIfTI items to parse in the background, with as many
+    workers as set by the plugin settings.
+    """
+    global _parseQueue
+    workers = Setting().get(PluginSettings.UPLOAD_WORKERS)
+    with _parseQueueLock:
+        if _parseQueue is None:
+            _parseQueue = ParseQueue(_parseQueuedItem, workers)
+        else:
+            _parseQueue.setWorkers(workers)
+        return _parseQueue
+
+
+def _queueItem(itemId):
+    """
+    Mark an item as queued, and queue it to be parsed unless it already is.
+    """
+    Item().update({'_id': itemId}, {'$set': {'niftiProcessing': {
+        'state': 'queued',
+        'queued': datetime.datetime.utcnow()
+    }}})
+    _getParseQueue().put(itemId)
+
+
+def _parseQueuedItem(itemId):
+    """
+    Parse a queued item, recording the progress and the outcome of the parse
+    in item['niftiProcessing'], unless the item was queued again meanwhile.
+    """
+    item = Item().load(itemId, force=True)
+    if item is None:
+        # The item was removed while it was queued
+        return
+    processing = {
+        **(item.get('niftiProcessing') or {}),
+        'state': 'running',
+        'started': datetime.datetime.utcnow()
+    }
+    processing.pop('error', None)
+    # _makeNiftiItem saves the whole item, so it must carry the status too
+    item['niftiProcessing'] = processing
+    Item().update({'_id': itemId}, {'$set': {'niftiProcessing': processing}})
+
+    startTime = time.time()
+    try:
+        _makeNiftiItem(item)
+        processing['state'] = 'success'
+    except Exception as e:
+        processing['state'] = 'error'
+        processing['error'] = str(e)
+        raise
+    finally:
+        processing['finished'] = datetime.datetime.utcnow()
+        processing['seconds'] = time.time() - startTime
+        if _getParseQueue().isQueued(itemId):
+            # Saving the item may have overwritten the queued state
+            processing['state'] = 'queued'
+        # Otherwise, a queued state written since the item was saved is kept
+        Item().update({
+            '_id': itemId,
+            'niftiProcessing.state': 'running',
+            'niftiProcessing.started': processing['started']
+        }, {'$set': {'niftiProcessing': processing}})
+
+
+def _resumeQueuedItems():
+    """
+    Queue the items whose parse was queued or running when the server stopped.
+    """
+    for item in Item().find(
+            {'niftiProcessing.state': {'$in': ['queued', 'running']}}, fields=['_id']):
+        _getParseQueue().put(item['_id'])
+
+
 def _uploadHandler(event):
     """
     Event handler to automatically parse NIfTI files on upload.
@@ -297,6 +777,12 @@ def _uploadHandler(event):
     
     # Check if it's a NIfTI file
     if name.endswith('.nii') or name.endswith('.nii.gz'):
+        if Setting().get(PluginSettings.UPLOAD_PROCESSING) == 'async':
+            # Parse in the background, so that the upload request returns now
+            logger.info(f'Queuing item of NIfTI file: {name}')
+            _queueItem(file['itemId'])
+            return
+
         logger.info(f'Processing NIfTI file: {name}')
         try:
             # Parse the NIfTI file
@@ -322,7 +808,11 @@ def _uploadHandler(event):
             for itemFile in itemFiles:
                 if itemFile['name'].endswith('.json'):
                     logger.info(f'Found JSON sidecar: {itemFile["name"]}')
-                    jsonMetadata = _parseJsonFile(itemFile)
+                    try:
+                        jsonMetadata = _parseJsonFile(itemFile)
+                    except ValueError as e:
+                        # The sidecar is optional, as in parseNifti
+                        logger.warning(f'Failed to parse JSON sidecar: {str(e)}')
                     break
             
             # Update or create nifti metadata in item
@@ -345,9 +835,13 @@ def _uploadHandler(event):
             # Add file info
             fileInfo = _extractFileData(file)
             item['nifti']['files'].append(fileInfo)
+            item['niftiSummary'] = _niftiSummary(item['nifti'])
+            item['niftiSearch'] = _niftiSearch(item['nifti'])
+            item['niftiFields'] = _niftiFields(item['nifti'])
             
             logger.info('Saving item with nifti metadata')
             Item().save(item)
+            _facetCache.clear()
             logger.info('=== NIfTI Upload Handler Completed Successfully ===')
         except Exception as e:
             logger.error(f'Error auto-parsing NIfTI file: {str(e)}', exc_info=True)
@@ -355,86 +849,125 @@ def _uploadHandler(event):
         logger.info(f'Not a NIfTI file, skipping: {name}')
 
 
-def _buildSearchConditions(query):
+# The folders which each user can access, for searches
+_accessibleFolders = AccessibleFolders()
+
+# The counts of GET /item/nifti/facets, cleared whenever NIfTI metadata is written
+_facetCache = FacetCache()
+
+
+def _clearSearchCaches(event=None):
+    """Forget which folders users can access, and what they can count."""
+    _accessibleFolders.clear()
+    _facetCache.clear()
+
+
+def _planSearch(query):
     """
-    Costruisce condizioni di ricerca MongoDB per tutti i campi metadati NIfTI.
+    Parse a search query into the field it is scoped to, its text and whether
+    it is a prefix search.
 
-    Cerca in:
-    - Campi stringa header NIfTI (orientation, datatype, units, ecc.)
-    - Campi metadati BIDS JSON (ProtocolName, Manufacturer, ecc.)
-    - Nomi file
-    - Campi array numerici quando la query è un numero
+    'Manufacturer:siemens' only matches the values of this field; a query
+    whose part before the colon is not a searchable field is searched as a
+    whole. A trailing '*', as in 'siem*', matches the values starting with the
+    text instead of containing it.
 
-    :param query: Stringa di ricerca dall'utente
-    :returns: Lista di condizioni query MongoDB
+    :param query: The search string of the user
+    :returns: A tuple of the lowercased field name or None, the lowercased
+        text, and whether to match the start of the values
     """
-    conditions = []
+    text = query.strip().lower()
+    field = None
+    name, colon, rest = text.partition(':')
+    if colon and name.strip() in NIFTI_SEARCH_FIELD_NAMES:
+        field, text = name.strip(), rest.strip()
+    prefix = text.endswith('*')
+    if prefix:
+        text = text.rstrip('*')
+    return field, text, prefix
 
-    # Campi stringa header NIfTI
-    string_fields = [
-        'nifti.meta.orientation',
-        'nifti.meta.dataType',
-        'nifti.meta.datatype',  # Campo legacy
-        'nifti.meta.units',
-        'nifti.meta.time_units',
-        'nifti.meta.file_type',
-    ]
 
-    for field in string_fields:
-        conditions.append({field: {'$regex': query, '$options': 'i'}})
+def _buildSearchQuery(query):
+    """
+    Build the MongoDB query matching the NIfTI items which have a search value
+    containing the query, case-insensitively.
+
+    The query is escaped and compiled into a single pattern, matched against
+    ``niftiSearch.values``, or ``niftiSearch.fields`` for a field-scoped
+    query. Prefix searches are anchored, so that MongoDB scans a range of the
+    index of these tokens. For other searches of three characters or more,
+    the n-grams of the query are looked up in the index of
+    ``niftiSearch.grams``, so that only the items having all of them are
+    matched against the pattern. A query which is a number also matches the
+    values equal to it, as '2.0' matches a spacing of 2, which is indexed as
+    '2'.
 
-    # Gestione query numeriche per campi array (dimensioni, spacing)
+    :param query: The search string of the user
+    :returns: The MongoDB query
+    """
+    field, text, prefix = _planSearch(query)
+    if field is not None:
+        key = 'niftiSearch.fields'
+        # Field names do not contain a colon, so the value starts after it
+        pattern = re.escape(f'{field}:') + ('' if prefix else '.*') + re.escape(text)
+    else:
+        key = 'niftiSearch.values'
+        pattern = re.escape(text)
+    if prefix or field is not None:
+        pattern = '^' + pattern
+    search_query = {key: re.compile(pattern)}
+    if not prefix and len(text) >= NIFTI_SEARCH_GRAM_LENGTH:
+        search_query['niftiSearch.grams'] = {'$all': sorted(_searchGrams(text))}
+    number = None if prefix else _queryNumber(text)
+    if number is not None:
+        # Integral numbers are indexed without a fraction, which the pattern
+        # of a query like '64.0' does not match
+        value, = _searchValues(number)
+        if field is not None:
+            value = f'{field}:{value}'
+        search_query = {'$or': [search_query, {key: value}]}
+    return search_query
+
+
+def _queryNumber(text):
+    """:returns: The search text as a float, or None if it is not a finite number."""
     try:
-        numeric_query = float(query)
-        # Cerca negli array dimensioni/spacing
-        conditions.append({'nifti.meta.dimensions': numeric_query})
-        conditions.append({'nifti.meta.dims': numeric_query})
-        conditions.append({'nifti.meta.pixelSpacing': numeric_query})
-        conditions.append({'nifti.meta.pixdim': numeric_query})
+        return _number(float(text))
     except ValueError:
-        # Non è un numero, salta ricerca array numerici
-        pass
-
-    # Campi metadati BIDS JSON (alto valore per utenti)
-    bids_fields = [
-        # Protocollo/Sequenza (più cercati)
-        'nifti.meta.json_metadata.ProtocolName',
-        'nifti.meta.json_metadata.SeriesDescription',
-        'nifti.meta.json_metadata.SequenceName',
-        'nifti.meta.json_metadata.PulseSequenceType',
-        'nifti.meta.json_metadata.ScanningSequence',
-        'nifti.meta.json_metadata.SequenceVariant',
-
-        # Hardware scanner
-        'nifti.meta.json_metadata.Manufacturer',
-        'nifti.meta.json_metadata.ManufacturersModelName',
-        'nifti.meta.json_metadata.DeviceSerialNumber',
-        'nifti.meta.json_metadata.StationName',
-        'nifti.meta.json_metadata.SoftwareVersions',
-
-        # Istituzione
-        'nifti.meta.json_metadata.InstitutionName',
-        'nifti.meta.json_metadata.InstitutionAddress',
-        'nifti.meta.json_metadata.InstitutionalDepartmentName',
-
-        # Acquisizione
-        'nifti.meta.json_metadata.MagneticFieldStrength',
-        'nifti.meta.json_metadata.ReceiveCoilName',
-        'nifti.meta.json_metadata.TransmitCoilName',
-        'nifti.meta.json_metadata.ImageType',
-
-        # Processing
-        'nifti.meta.json_metadata.ConversionSoftware',
-        'nifti.meta.json_metadata.ConversionSoftwareVersion',
-    ]
-
-    for field in bids_fields:
-        conditions.append({field: {'$regex': query, '$options': 'i'}})
-
-    # Nomi file (files è un array di oggetti con campo 'name')
-    conditions.append({'nifti.files.name': {'$regex': query, '$options': 'i'}})
-
-    return conditions
+        return None
+
+
+def _buildFilterQuery(filters):
+    """
+    Build the MongoDB query of numeric search filters over the normalized
+    fields of item['niftiFields'].
+
+    :param filters: Dictionary mapping field names to a number, which they
+        must equal, or to a dictionary mapping comparison operators to
+        numbers, e.g. ``{'dimT': {'gt': 200}, 'fieldStrength': 3}``
+    :returns: The MongoDB query
+    :raises RestException: If a field, an operator or a value is invalid
+    """
+    query = {}
+    for field, predicate in filters.items():
+        if field not in NIFTI_FILTER_FIELDS:
+            raise RestException(
+                f'Invalid filter field: {field}. Valid fields: {", ".join(NIFTI_FILTER_FIELDS)}.')
+        if not isinstance(predicate, dict):
+            predicate = {'eq': predicate}
+        if not predicate:
+            raise RestException(f'The "{field}" filter has no comparison.')
+        condition = {}
+        for operator, value in predicate.items():
+            if operator not in NIFTI_FILTER_OPERATORS:
+                raise RestException(
+                    f'Invalid filter operator: {operator}. '
+                    f'Valid operators: {", ".join(NIFTI_FILTER_OPERATORS)}.')
+            if _number(value) is None:
+                raise RestException(f'The "{field}" filter must compare to numbers.')
+            condition[NIFTI_FILTER_OPERATORS[operator]] = value
+        query[f'niftiFields.{field}'] = condition
+    return query
 
 
 def niftiSubstringSearchHandler(query, types, user=None, level=None, limit=0, offset=0):
@@ -471,26 +1004,14 @@ def niftiSubstringSearchHandler(query, types, user=None, level=None, limit=0, of
         logger.info(f'Skipping: query is not string: {type(query)}')
         raise RestException('The search query must be a string.')
 
-    # Costruisci condizioni di ricerca complete
-    conditions = _buildSearchConditions(query)
-    logger.info(f'Built {len(conditions)} search conditions')
-
-    # Costruisci query MongoDB
-    search_query = {
-        'nifti': {'$exists': True},
-        '$or': conditions
-    }
+    # Costruisci query MongoDB sui token di ricerca normalizzati
+    search_query = _buildSearchQuery(query)
 
     logger.info(f'MongoDB query: {search_query}')
 
-    # Esegui ricerca
-    items = Item().findWithPermissions(
-        search_query,
-        user=user,
-        level=level,
-        limit=limit,
-        offset=offset
-    )
+    # Esegui ricerca, filtrando le cartelle accessibili in MongoDB
+    items, _ = searchItems(
+        search_query, _accessibleFolders, user, level, limit=limit, offset=offset)
 
     # Filtra risultati con permessi e filtra campi
     filtered_items = []
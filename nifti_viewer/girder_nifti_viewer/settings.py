@@ -0,0 +1,66 @@
+from girder.exceptions import ValidationException
+from girder.utility import setting_utilities
+
+
+class PluginSettings:
+    UPLOAD_PROCESSING = 'nifti_viewer.upload_processing'
+    UPLOAD_WORKERS = 'nifti_viewer.upload_workers'
+    MAX_READ_BYTES = 'nifti_viewer.max_read_bytes'
+    SUMMARY_VERSION = 'nifti_viewer.summary_version'
+
+
+# 'sync' parses uploaded NIfTI files in the upload request, 'async' queues
+# their items to be parsed by background workers
+UPLOAD_PROCESSING_MODES = ('sync', 'async')
+
+# The size of a NIfTI-2 header, which is the least that must be read
+MIN_READ_BYTES = 540
+
+
+@setting_utilities.default(PluginSettings.UPLOAD_PROCESSING)
+def _defaultUploadProcessing():
+    return 'sync'
+
+
+@setting_utilities.default(PluginSettings.UPLOAD_WORKERS)
+def _defaultUploadWorkers():
+    return 2
+
+
+@setting_utilities.default(PluginSettings.MAX_READ_BYTES)
+def _defaultMaxReadBytes():
+    return 16 * 1024 ** 2
+
+
+@setting_utilities.default(PluginSettings.SUMMARY_VERSION)
+def _defaultSummaryVersion():
+    return 0
+
+
+@setting_utilities.validator(PluginSettings.UPLOAD_PROCESSING)
+def _validateUploadProcessing(doc):
+    if doc['value'] not in UPLOAD_PROCESSING_MODES:
+        raise ValidationException(
+            f'Upload processing must be one of {", ".join(UPLOAD_PROCESSING_MODES)}.', 'value')
+
+
+@setting_utilities.validator(PluginSettings.UPLOAD_WORKERS)
+def _validateUploadWorkers(doc):
+    value = doc['value']
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ValidationException('Upload workers must be a positive integer.', 'value')
+
+
+@setting_utilities.validator(PluginSettings.MAX_READ_BYTES)
+def _validateMaxReadBytes(doc):
+    value = doc['value']
+    if not isinstance(value, int) or isinstance(value, bool) or value < MIN_READ_BYTES:
+        raise ValidationException(
+            f'Maximum read bytes must be an integer of at least {MIN_READ_BYTES}.', 'value')
+
+
+@setting_utilities.validator(PluginSettings.SUMMARY_VERSION)
+def _validateSummaryVersion(doc):
+    value = doc['value']
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ValidationException('Summary version must be a non-negative integer.', 'value')
@@ -21,13 +21,19 @@ wrap(ItemView, 'render', function (render) {
         }
 
         // If the item has NIfTI data, render the viewer
-        if (this.model.has('nifti')) {
-            new NiftiView({
-                parentView: this,
-                item: this.model
-            })
-                .render()
-                .$el.insertAfter(this.$('.g-item-info'));
+        // Item listings only include a summary, so fetch the whole metadata
+        if (this.model.has('niftiSummary')) {
+            restRequest({
+                url: `item/${this.model.id}/nifti`
+            }).done((nifti) => {
+                new NiftiView({
+                    parentView: this,
+                    item: this.model,
+                    nifti: nifti
+                })
+                    .render()
+                    .$el.insertAfter(this.$('.g-item-info'));
+            });
         }
     });
     return render.call(this);
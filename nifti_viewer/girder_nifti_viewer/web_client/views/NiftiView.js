@@ -136,7 +136,8 @@ const NiftiView = View.extend({
     initialize: function (settings) {
         this.item = settings.item;
         this.parentView = settings.parentView;
-        this.niftiInfo = this.item.get('nifti');
+        // The NIfTI metadata, as returned by GET /item/:id/nifti
+        this.niftiInfo = settings.nifti;
 
         // NiftiFileModel for cached volume loading
         this._niftiFileModel = null;
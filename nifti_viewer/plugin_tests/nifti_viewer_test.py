@@ -1,5 +1,7 @@
+import gzip
 import io
 import json
+import re
 import pytest
 import numpy as np
 import nibabel as nib
@@ -52,13 +54,14 @@ def test_nifti_plugin_load(server):
 
 
 def test_nifti_item_field_exposed(server, user):
-    """Test that the 'nifti' field is exposed on items."""
+    """Test that only the 'niftiSummary' field is exposed on items."""
     from girder.models.item import Item
     from girder.constants import AccessType
     
-    # Check that 'nifti' is in exposed fields
+    # The whole 'nifti' field is fetched from its own endpoint
     exposed_fields = Item().exposeFields(level=AccessType.READ, fields=set())
-    assert 'nifti' in exposed_fields
+    assert 'niftiSummary' in exposed_fields
+    assert 'nifti' not in exposed_fields
 
 
 def test_parse_nifti_endpoint(server, user, admin, folder, sample_nifti_file):
@@ -101,6 +104,44 @@ def test_parse_nifti_endpoint(server, user, admin, folder, sample_nifti_file):
     assert meta['dims'] == [64, 64, 32]
 
 
+def test_get_nifti_endpoint(server, admin, folder, sample_nifti_file):
+    """Test that listings only include a summary, and the full metadata has its own endpoint."""
+    item = Item().createItem('test_nifti_get', admin, folder)
+    Upload().uploadFromFile(
+        sample_nifti_file,
+        size=len(sample_nifti_file.getvalue()),
+        name='test.nii.gz',
+        parentType='item',
+        parent=item,
+        user=admin
+    )
+    resp = server.request(
+        path=f'/item/{item["_id"]}/parseNifti',
+        method='POST',
+        user=admin
+    )
+    assertStatusOk(resp)
+
+    # The item listing contains the summary only
+    resp = server.request(path='/item', params={'folderId': folder['_id']}, user=admin)
+    assertStatusOk(resp)
+    listed = [i for i in resp.json if i['_id'] == str(item['_id'])][0]
+    assert 'nifti' not in listed
+    assert listed['niftiSummary']['dimensions'] == [64, 64, 32]
+    assert listed['niftiSummary']['files'] == 1
+
+    # The full metadata is fetched on demand
+    resp = server.request(path=f'/item/{item["_id"]}/nifti', user=admin)
+    assertStatusOk(resp)
+    assert resp.json['meta']['dims'] == [64, 64, 32]
+    assert len(resp.json['files']) == 1
+
+    # Items without NIfTI metadata are rejected
+    other = Item().createItem('test_not_nifti', admin, folder)
+    resp = server.request(path=f'/item/{other["_id"]}/nifti', user=admin)
+    assert resp.status_int == 400
+
+
 def test_parse_nifti_with_json(server, user, admin, folder, sample_nifti_file, sample_json_metadata):
     """Test parsing NIfTI with JSON sidecar."""
     # Create an item
@@ -222,6 +263,251 @@ def test_nifti_search_handler(server, admin, folder, sample_nifti_file, sample_j
     assert any(r['document']['_id'] == item['_id'] for r in results)
 
 
+def test_nifti_search_tokens(server, admin, folder, sample_nifti_file, sample_json_metadata):
+    """Test the normalized search tokens which the search handler queries."""
+    from girder_nifti_viewer import (
+        NIFTI_SUMMARY_VERSION, _migrateSummaries, niftiSubstringSearchHandler)
+    from girder.models.setting import Setting
+    from girder_nifti_viewer.settings import PluginSettings
+
+    item = Item().createItem('tokens_nifti', admin, folder)
+    for name, data in [('Sub-01_T1w.nii.gz', sample_nifti_file.getvalue()),
+                       ('Sub-01_T1w.json', sample_json_metadata)]:
+        Upload().uploadFromFile(
+            io.BytesIO(data), size=len(data), name=name,
+            parentType='item', parent=item, user=admin)
+    resp = server.request(
+        path=f'/item/{item["_id"]}/parseNifti', method='POST', user=admin)
+    assertStatusOk(resp)
+
+    item = Item().load(item['_id'], force=True)
+    values = item['niftiSearch']['values']
+    assert 'sub-01_t1w.nii.gz' in values
+    assert 't1_mprage' in values
+    assert '64' in values
+    assert 'sub' in item['niftiSearch']['grams']
+
+    def found(query):
+        results = niftiSubstringSearchHandler(
+            query=query, types=['item'], user=admin, level=None)
+        return [result['_id'] for result in results['item']]
+
+    assert item['_id'] in found('SUB-01_t1')
+    assert item['_id'] in found('t1')
+    assert item['_id'] not in found('sub-02')
+    # Queries are matched literally, not as regular expressions
+    assert item['_id'] not in found('sub.01')
+    # Numbers match the values equal to them, however they are written
+    assert item['_id'] in found('64.0')
+    assert item['_id'] in found('32.0')
+    assert item['_id'] in found('pixdim:1.0')
+    assert item['_id'] not in found('dims:1.0')
+    assert item['_id'] not in found('33.0')
+
+    # Items parsed before the tokens were stored are backfilled, once per
+    # summary version
+    Item().update({'_id': item['_id']}, {'$unset': {'niftiSearch': True}})
+    assert item['_id'] not in found('sub-01')
+    Setting().set(PluginSettings.SUMMARY_VERSION, NIFTI_SUMMARY_VERSION)
+    _migrateSummaries()
+    assert item['_id'] not in found('sub-01')
+    Setting().set(PluginSettings.SUMMARY_VERSION, 0)
+    _migrateSummaries()
+    assert item['_id'] in found('sub-01')
+    assert Setting().get(PluginSettings.SUMMARY_VERSION) == NIFTI_SUMMARY_VERSION
+
+
+def test_nifti_search_query_syntax(server, admin, folder, sample_nifti_file, sample_json_metadata):
+    """Test field-scoped and prefix searches, and regex characters in queries."""
+    from girder_nifti_viewer import _buildSearchQuery, niftiSubstringSearchHandler
+
+    item = Item().createItem('syntax_nifti', admin, folder)
+    for name, data in [('scan.nii.gz', sample_nifti_file.getvalue()),
+                       ('scan.json', sample_json_metadata)]:
+        Upload().uploadFromFile(
+            io.BytesIO(data), size=len(data), name=name,
+            parentType='item', parent=item, user=admin)
+    resp = server.request(
+        path=f'/item/{item["_id"]}/parseNifti', method='POST', user=admin)
+    assertStatusOk(resp)
+
+    def found(query):
+        results = niftiSubstringSearchHandler(
+            query=query, types=['item'], user=admin, level=None)
+        return [result['_id'] for result in results['item']]
+
+    # Field-scoped searches only match the values of this field
+    assert item['_id'] in found('Manufacturer:scanner')
+    assert item['_id'] in found('manufacturer: TESTSCANNER')
+    assert item['_id'] not in found('ProtocolName:scanner')
+    # Prefix searches are anchored to the start of the values
+    assert item['_id'] in found('testsc*')
+    assert item['_id'] in found('Manufacturer:test*')
+    assert item['_id'] not in found('scanner*')
+    assert _buildSearchQuery('Manufacturer:test*') == {
+        'niftiSearch.fields': re.compile('^manufacturer:test')}
+    # An unknown field is searched as part of the text
+    assert item['_id'] not in found('Unknown:testscanner')
+    # Regular expression characters are matched literally
+    assert found('.*.*.*a') == []
+    assert item['_id'] not in found('scan.nii(')
+
+
+def test_search_nifti_items_pages(server, admin, user):
+    """Test the paginated search, filtered on the folders the user can read."""
+    from girder.constants import AccessType
+    from girder_nifti_viewer import _niftiSearch
+
+    public = Folder().createFolder(admin, 'pages_public', parentType='user', public=True)
+    private = Folder().createFolder(admin, 'pages_private', parentType='user', public=False)
+    nifti = {'meta': {'orientation': 'RAS'}, 'files': [{'name': 'pages.nii.gz'}]}
+    for name, parent in [('a', public), ('b', public), ('c', public), ('d', private)]:
+        item = Item().createItem(name, admin, parent)
+        Item().update({'_id': item['_id']}, {'$set': {
+            'nifti': nifti, 'niftiSearch': _niftiSearch(nifti)}})
+
+    # Pages follow each other by the ID of their last item
+    names = []
+    params = {'q': 'PAGES.nii', 'limit': 2}
+    while True:
+        resp = server.request(path='/item/nifti/search', user=user, params=params)
+        assertStatusOk(resp)
+        assert resp.json['total'] == 3
+        names.extend(item['name'] for item in resp.json['item'])
+        if not resp.json['next']:
+            break
+        params['after'] = resp.json['next']
+    assert names == ['a', 'b', 'c']
+
+    resp = server.request(path='/item/nifti/search', user=admin, params={
+        'q': 'name:pages*', 'count': False})
+    assertStatusOk(resp)
+    assert [item['name'] for item in resp.json['item']] == ['a', 'b', 'c', 'd']
+    assert resp.json['total'] is None
+
+    # Granting access to the folder invalidates the cached accessible folders
+    Folder().setUserAccess(private, user, AccessType.READ, save=True)
+    resp = server.request(path='/item/nifti/search', user=user, params={'q': 'pages'})
+    assertStatusOk(resp)
+    assert resp.json['total'] == 4
+
+    resp = server.request(path='/item/nifti/search', user=user, params={
+        'q': 'pages', 'after': 'invalid'})
+    assert resp.status_int == 400
+
+
+def test_search_nifti_items_filters(server, admin):
+    """Test the numeric filters over the normalized NIfTI fields."""
+    from girder_nifti_viewer import _niftiFields, _niftiSearch, _parseNiftiFile
+
+    parent = Folder().createFolder(admin, 'filters', parentType='user', public=True)
+    # A scan whose header gives its spacing in microns and its time axis in
+    # milliseconds
+    img = nib.Nifti1Image(
+        np.zeros((8, 8, 4, 10), dtype=np.int16), np.diag([500.0, 500.0, 800.0, 1.0]))
+    img.header.set_zooms((500.0, 500.0, 800.0, 2000.0))
+    img.header.set_xyzt_units('micron', 'msec')
+    raw = io.BytesIO()
+    img.to_file_map(img.make_file_map({'image': raw, 'header': raw}))
+    content = raw.getvalue()
+    microItem = Item().createItem('micro', admin, parent)
+    microFile = Upload().uploadFromFile(
+        io.BytesIO(content), size=len(content), name='micro.nii', parentType='item',
+        parent=microItem, user=admin)
+    microMeta = _parseNiftiFile(microFile)
+    assert microMeta['units'] == 'micron'
+    assert microMeta['time_units'] == 'msec'
+
+    scans = {
+        'fmri': {'meta': {
+            'dimensions': [64, 64, 36, 300], 'pixelSpacing': [3.0, 3.0, 3.0, 0.8],
+            'units': 'mm', 'json_metadata': {'MagneticFieldStrength': 3, 'RepetitionTime': 0.8}}},
+        'anat': {'meta': {
+            'dimensions': [256, 256, 192], 'pixelSpacing': [0.9, 0.9, 0.9],
+            'units': 'mm', 'json_metadata': {'MagneticFieldStrength': 3, 'ProtocolName': 'MPRAGE'}}},
+        'anat15': {'meta': {
+            'dimensions': [256, 256, 160], 'pixelSpacing': [1.0, 1.0, 1.2],
+            'units': 'mm', 'MagneticFieldStrength': 1.5, 'ProtocolName': 'MPRAGE'}},
+        'micro': {'meta': microMeta}
+    }
+    for name, nifti in scans.items():
+        item = microItem if name == 'micro' else Item().createItem(name, admin, parent)
+        Item().update({'_id': item['_id']}, {'$set': {
+            'nifti': nifti, 'niftiSearch': _niftiSearch(nifti), 'niftiFields': _niftiFields(nifti)}})
+
+    assert _niftiFields(scans['fmri']) == {
+        'ndim': 4, 'dimX': 64, 'dimY': 64, 'dimZ': 36, 'dimT': 300,
+        'spacingX': 3.0, 'spacingY': 3.0, 'spacingZ': 3.0, 'maxSpacing': 3.0,
+        'repetitionTime': 0.8, 'fieldStrength': 3.0}
+    assert _niftiFields(scans['micro']) == {
+        'ndim': 4, 'dimX': 8, 'dimY': 8, 'dimZ': 4, 'dimT': 10,
+        'spacingX': pytest.approx(0.5), 'spacingY': pytest.approx(0.5),
+        'spacingZ': pytest.approx(0.8), 'maxSpacing': pytest.approx(0.8),
+        'repetitionTime': pytest.approx(2.0)}
+
+    def found(filters, q=None):
+        params = {'filters': json.dumps(filters)}
+        if q is not None:
+            params['q'] = q
+        resp = server.request(path='/item/nifti/search', user=admin, params=params)
+        assertStatusOk(resp)
+        return sorted(item['name'] for item in resp.json['item'])
+
+    assert found({'maxSpacing': {'lt': 1.0}}) == ['anat', 'micro']
+    assert found({'dimT': {'gt': 200}}) == ['fmri']
+    assert found({'ndim': 3, 'fieldStrength': 3}) == ['anat']
+    assert found({'fieldStrength': {'gte': 1.5, 'lt': 3}}, q='mprage') == ['anat15']
+    assert found({'repetitionTime': {'lte': 1}}) == ['fmri']
+    assert found({'repetitionTime': {'gt': 1}}) == ['micro']
+
+    for filters in [{'unknown': 1}, {'dimT': {'between': 1}}, {'dimT': 'many'},
+                    {'dimT': {}}, [1, 2]]:
+        resp = server.request(path='/item/nifti/search', user=admin, params={
+            'filters': json.dumps(filters)})
+        assert resp.status_int == 400
+
+
+def test_nifti_facets(server, admin, user, sample_nifti_file):
+    """Test the counts of the values of NIfTI fields."""
+    public = Folder().createFolder(admin, 'facets_public', parentType='user', public=True)
+    private = Folder().createFolder(admin, 'facets_private', parentType='user', public=False)
+    for name, parent, meta in [
+            ('a', public, {'orientation': 'RAS', 'json_metadata': {'Manufacturer': 'Siemens'}}),
+            ('b', public, {'orientation': 'RAS', 'Manufacturer': 'Siemens'}),
+            ('c', public, {'orientation': 'LAS', 'Manufacturer': 'GE'}),
+            ('d', private, {'orientation': 'LPS', 'Manufacturer': 'Philips'})]:
+        item = Item().createItem(name, admin, parent)
+        Item().update({'_id': item['_id']}, {'$set': {'nifti': {'meta': meta, 'files': []}}})
+
+    resp = server.request(path='/item/nifti/facets', user=user, params={
+        'fields': json.dumps(['orientation', 'Manufacturer'])})
+    assertStatusOk(resp)
+    assert resp.json == {
+        'orientation': [{'value': 'RAS', 'count': 2}, {'value': 'LAS', 'count': 1}],
+        'Manufacturer': [{'value': 'Siemens', 'count': 2}, {'value': 'GE', 'count': 1}]
+    }
+
+    # Parsing an item invalidates the cached counts
+    item = Item().createItem('e', admin, public)
+    Upload().uploadFromFile(
+        sample_nifti_file, size=len(sample_nifti_file.getvalue()), name='e.nii.gz',
+        parentType='item', parent=item, user=admin)
+    resp = server.request(
+        path=f'/item/{item["_id"]}/parseNifti', method='POST', user=admin)
+    assertStatusOk(resp)
+    orientation = Item().load(item['_id'], force=True)['nifti']['meta']['orientation']
+    resp = server.request(path='/item/nifti/facets', user=user, params={
+        'fields': json.dumps(['orientation']), 'limit': 5})
+    assertStatusOk(resp)
+    counts = {facet['value']: facet['count'] for facet in resp.json['orientation']}
+    assert sum(counts.values()) == 4
+    assert counts[orientation] >= 1
+
+    resp = server.request(path='/item/nifti/facets', user=user, params={
+        'fields': json.dumps(['affine'])})
+    assert resp.status_int == 400
+
+
 def test_auto_parse_on_upload(server, admin, folder, sample_nifti_file):
     """Test automatic parsing on NIfTI file upload."""
     # Create an item
@@ -245,3 +531,128 @@ def test_auto_parse_on_upload(server, admin, folder, sample_nifti_file):
     from girder import events
     handlers = events._mapping.get('data.process', {})
     assert 'nifti_viewer' in handlers
+
+
+def test_async_upload_processing(server, admin, user, folder, sample_nifti_file):
+    """Test that uploads are parsed by the background queue in async mode."""
+    from girder import events
+    from girder.models.setting import Setting
+    from girder_nifti_viewer import _getParseQueue, _parseQueuedItem
+    from girder_nifti_viewer.settings import PluginSettings
+
+    resp = server.request(path='/system/setting', method='PUT', user=admin, params={
+        'key': PluginSettings.UPLOAD_PROCESSING, 'value': 'later'})
+    assert resp.status_int == 400
+
+    item = Item().createItem('async_parse_test', admin, folder)
+    Setting().set(PluginSettings.UPLOAD_PROCESSING, 'async')
+    try:
+        Upload().uploadFromFile(
+            sample_nifti_file,
+            size=len(sample_nifti_file.getvalue()),
+            name='async.nii.gz',
+            parentType='item',
+            parent=item,
+            user=admin
+        )
+        assert _getParseQueue().join(10)
+    finally:
+        Setting().unset(PluginSettings.UPLOAD_PROCESSING)
+
+    item = Item().load(item['_id'], force=True)
+    assert item['nifti']['meta']['dims'] == [64, 64, 32]
+    assert item['niftiProcessing']['state'] == 'success'
+
+    # An item queued again while it is parsed stays queued
+    def requeue(event):
+        Item().update({'_id': item['_id']}, {'$set': {'niftiProcessing': {'state': 'queued'}}})
+
+    with events.bound('model.item.save.after', 'requeue', requeue):
+        _parseQueuedItem(item['_id'])
+    assert Item().load(item['_id'], force=True)['niftiProcessing']['state'] == 'queued'
+
+    # Queue metrics are only available to admins
+    resp = server.request(path='/item/nifti/queue', user=user)
+    assert resp.status_int == 403
+    resp = server.request(path='/item/nifti/queue', user=admin)
+    assertStatusOk(resp)
+    assert resp.json['queued'] == 0
+    assert resp.json['processed'] >= 1
+    assert resp.json['processSeconds']['max'] is not None
+
+
+@pytest.mark.parametrize('image_class,name,file_type', [
+    (nib.Nifti1Image, 'plain.nii', 'NIfTI-1'),
+    (nib.Nifti2Image, 'plain2.nii', 'NIfTI-2'),
+    (nib.Nifti2Image, 'compressed2.nii.gz', 'NIfTI-2'),
+])
+def test_parse_nifti_header_only(server, admin, folder, image_class, name, file_type):
+    """Test that headers are parsed from the start of the file stream."""
+    from girder_nifti_viewer import _parseNiftiFile
+
+    affine = np.diag([2.0, 3.0, 4.0, 1.0])
+    img = image_class(np.zeros((16, 8, 4), dtype=np.int16), affine)
+    raw = io.BytesIO()
+    img.to_file_map(img.make_file_map({'image': raw, 'header': raw}))
+    content = raw.getvalue()
+    if name.endswith('.gz'):
+        content = gzip.compress(content)
+
+    item = Item().createItem(f'header_only_{name}', admin, folder)
+    file = Upload().uploadFromFile(
+        io.BytesIO(content), size=len(content), name=name, parentType='item', parent=item,
+        user=admin)
+
+    meta = _parseNiftiFile(file)
+    assert meta['dims'] == [16, 8, 4]
+    assert meta['pixdim'] == [2.0, 3.0, 4.0]
+    assert meta['dataType'] == 'int16'
+    assert meta['file_type'] == file_type
+    assert meta['affine'] == affine.tolist()
+    assert meta['orientation'] == 'RAS'
+
+
+def test_parse_nifti_extensions(server, admin, folder):
+    """Test that header extensions are listed, within the read budget."""
+    from girder.models.setting import Setting
+    from girder_nifti_viewer import _parseNiftiFile
+    from girder_nifti_viewer.settings import PluginSettings
+
+    img = nib.Nifti1Image(np.zeros((8, 8, 4), dtype=np.int16), np.eye(4))
+    img.header.extensions.append(nib.nifti1.Nifti1Extension('comment', b'acquired on site A'))
+    img.header.extensions.append(nib.nifti1.Nifti1Extension('afni', b'<AFNI_attributes/>' * 500))
+    raw = io.BytesIO()
+    img.to_file_map(img.make_file_map({'image': raw, 'header': raw}))
+    content = gzip.compress(raw.getvalue())
+
+    item = Item().createItem('nifti_extensions', admin, folder)
+    file = Upload().uploadFromFile(
+        io.BytesIO(content), size=len(content), name='extensions.nii.gz',
+        parentType='item', parent=item, user=admin)
+
+    meta = _parseNiftiFile(file)
+    assert [(e['code'], e['name']) for e in meta['extensions']] == [(6, 'comment'), (4, 'afni')]
+    assert all(e['size'] % 16 == 0 for e in meta['extensions'])
+    assert meta['extensionsTruncated'] is False
+
+    # Extensions beyond the budget are not read, but the header still is
+    Setting().set(PluginSettings.MAX_READ_BYTES, 1024)
+    try:
+        meta = _parseNiftiFile(file)
+        sidecar = json.dumps({'Manufacturer': 'TestScanner' * 100}).encode('utf-8')
+        Upload().uploadFromFile(
+            io.BytesIO(sidecar), size=len(sidecar), name='extensions.json',
+            parentType='item', parent=item, user=admin)
+        resp = server.request(path=f'/item/{item["_id"]}/parseNifti', method='POST', user=admin)
+        assertStatusOk(resp)
+    finally:
+        Setting().unset(PluginSettings.MAX_READ_BYTES)
+    assert meta['dims'] == [8, 8, 4]
+    assert [e['name'] for e in meta['extensions']] == ['comment']
+    assert meta['extensionsTruncated'] is True
+    # The sidecar is larger than the budget, so it is skipped
+    assert 'json_metadata' not in Item().load(item['_id'], force=True)['nifti']['meta']
+
+    resp = server.request(path='/system/setting', method='PUT', user=admin, params={
+        'key': PluginSettings.MAX_READ_BYTES, 'value': 100})
+    assert resp.status_int == 400
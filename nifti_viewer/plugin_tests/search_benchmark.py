@@ -0,0 +1,159 @@
+"""
+Compare the time taken by the "nifti" search mode to find items with the
+original ``$or`` of case-insensitive regexes over the NIfTI metadata and with
+the indexed ``niftiSearch`` tokens, on synthetic NIfTI items.
+
+Usage:
+    python search_benchmark.py [--uri URI] [--database NAME] [--count N]
+        [--repeat N] [query ...]
+
+The items are inserted into a scratch collection, which is dropped afterwards.
+Both queries must find the same items. The original query is escaped, since
+the tokens match queries literally rather than as regular expressions.
+"""
+import argparse
+import random
+import re
+import time
+
+import pymongo
+
+from girder_nifti_viewer import _buildSearchQuery, _niftiSearch
+
+SAMPLE_QUERIES = [
+    'siemens', 'mprage', 'sub-04213', 'prisma', 'las', 'zzz', '2.0', '64.0', '0.9375'
+]
+
+MANUFACTURERS = [
+    ('Siemens', ['Prisma', 'Skyra', 'TrioTim']),
+    ('GE', ['DISCOVERY MR750', 'SIGNA Premier']),
+    ('Philips', ['Achieva', 'Ingenia'])
+]
+PROTOCOLS = ['T1_MPRAGE', 'T2_SPACE', 'FLAIR', 'DWI_64dir', 'rsfMRI_BOLD', 'fieldmap']
+ORIENTATIONS = ['RAS', 'LAS', 'LPS', 'RPI']
+
+LEGACY_STRING_FIELDS = [
+    'orientation', 'dataType', 'datatype', 'units', 'time_units', 'file_type'
+]
+LEGACY_BIDS_FIELDS = [
+    'ProtocolName', 'SeriesDescription', 'SequenceName', 'PulseSequenceType',
+    'ScanningSequence', 'SequenceVariant', 'Manufacturer', 'ManufacturersModelName',
+    'DeviceSerialNumber', 'StationName', 'SoftwareVersions', 'InstitutionName',
+    'InstitutionAddress', 'InstitutionalDepartmentName', 'MagneticFieldStrength',
+    'ReceiveCoilName', 'TransmitCoilName', 'ImageType', 'ConversionSoftware',
+    'ConversionSoftwareVersion'
+]
+
+
+def legacySearchQuery(query):
+    """The query of the "nifti" search mode before the search tokens."""
+    pattern = re.escape(query)
+    conditions = [{'nifti.meta.%s' % field: {'$regex': pattern, '$options': 'i'}}
+                  for field in LEGACY_STRING_FIELDS]
+    try:
+        number = float(query)
+        for field in ('dimensions', 'dims', 'pixelSpacing', 'pixdim'):
+            conditions.append({'nifti.meta.%s' % field: number})
+    except ValueError:
+        pass
+    conditions.extend({'nifti.meta.json_metadata.%s' % field: {'$regex': pattern, '$options': 'i'}}
+                      for field in LEGACY_BIDS_FIELDS)
+    conditions.append({'nifti.files.name': {'$regex': pattern, '$options': 'i'}})
+    return {'nifti': {'$exists': True}, '$or': conditions}
+
+
+def syntheticItem(index, rng):
+    manufacturer, models = rng.choice(MANUFACTURERS)
+    protocol = rng.choice(PROTOCOLS)
+    dims = [rng.choice([64, 128, 256]), rng.choice([64, 128, 256]), rng.randint(20, 200)]
+    pixdim = [rng.choice([0.9375, 1.0, 2.0]), rng.choice([0.9375, 1.0, 2.0]),
+              rng.choice([1.0, 2.5, 3.0])]
+    subject = 'sub-%05d' % (index // 6)
+    nifti = {
+        'meta': {
+            'dimensions': dims, 'dims': dims,
+            'pixelSpacing': pixdim, 'pixdim': pixdim,
+            'dataType': 'int16', 'datatype': 'int16',
+            'units': 'mm', 'time_units': 'sec',
+            'file_type': 'NIfTI-1',
+            'orientation': rng.choice(ORIENTATIONS),
+            'json_metadata': {
+                'ProtocolName': protocol,
+                'SeriesDescription': protocol,
+                'Manufacturer': manufacturer,
+                'ManufacturersModelName': rng.choice(models),
+                'MagneticFieldStrength': rng.choice([1.5, 3]),
+                'InstitutionName': 'Hospital %d' % rng.randint(1, 50),
+                'ImageType': ['ORIGINAL', 'PRIMARY', 'M'],
+                'ConversionSoftware': 'dcm2niix'
+            }
+        },
+        'files': [{'name': '%s_%s.nii.gz' % (subject, protocol)}]
+    }
+    return {
+        'name': '%s_%s.nii.gz' % (subject, protocol),
+        'nifti': nifti,
+        'niftiSearch': _niftiSearch(nifti)
+    }
+
+
+def populate(collection, count):
+    rng = random.Random(0)
+    batch = []
+    for index in range(count):
+        batch.append(syntheticItem(index, rng))
+        if len(batch) == 1000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+    collection.create_index('niftiSearch.grams')
+
+
+def benchmark(collection, query, repeat):
+    legacy = legacySearchQuery(query)
+    indexed = _buildSearchQuery(query)
+    expected = sorted(doc['_id'] for doc in collection.find(legacy, ['_id']))
+    found = sorted(doc['_id'] for doc in collection.find(indexed, ['_id']))
+    if found != expected:
+        raise AssertionError('Different items for %r: %d legacy, %d indexed' % (
+            query, len(expected), len(found)))
+
+    timings = []
+    examined = []
+    for mongoQuery in (legacy, indexed):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            list(collection.find(mongoQuery, ['_id']))
+        timings.append((time.perf_counter() - start) / repeat)
+        stats = collection.find(mongoQuery).explain()['executionStats']
+        examined.append(stats['totalDocsExamined'])
+    print('%-12s %7d items  legacy %9.2f ms %8d docs  indexed %9.2f ms %8d docs  '
+          'speedup %.1fx' % (
+              query, len(found), timings[0] * 1000, examined[0],
+              timings[1] * 1000, examined[1], timings[0] / timings[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('queries', nargs='*')
+    parser.add_argument('--uri', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='nifti_search_benchmark')
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    collection = pymongo.MongoClient(args.uri)[args.database]['item']
+    collection.drop()
+    try:
+        start = time.perf_counter()
+        populate(collection, args.count)
+        print('Inserted %d items in %.1f s' % (args.count, time.perf_counter() - start))
+        for query in args.queries or SAMPLE_QUERIES:
+            benchmark(collection, query, args.repeat)
+    finally:
+        collection.drop()
+
+
+if __name__ == '__main__':
+    main()
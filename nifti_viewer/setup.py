@@ -91,6 +91,8 @@ setup(
     python_requires='>=3.8',
     install_requires=[
         'girder>=4.0.0',
+        # Not on PyPI: install ../plugin_utils first, see the README
+        'girder-plugin-utils',
         'nibabel>=4.0.0',
         'numpy>=1.20.0',
     ],
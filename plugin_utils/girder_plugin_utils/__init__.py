@@ -0,0 +1,4 @@
+"""
+Helpers shared by the Girder plugins of this repository. This package is not
+a plugin itself; the plugins which use it depend on it.
+"""
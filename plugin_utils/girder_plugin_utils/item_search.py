@@ -0,0 +1,192 @@
+import collections
+import threading
+import time
+
+from girder.constants import AccessType
+from girder.models.folder import Folder
+from girder.models.item import Item
+
+
+class AccessibleFolders:
+    """
+    A cache of the IDs of the folders which each user can access, so that
+    searches filter items on their folder in MongoDB, instead of loading the
+    folder of each result to check its access list.
+
+    Entries expire after ``ttl`` seconds, and are all dropped by ``clear``,
+    which is called whenever a folder, or the groups of a user, change.
+    """
+
+    def __init__(self, ttl=60, maxUsers=1000):
+        self.ttl = ttl
+        self.maxUsers = maxUsers
+        self._lock = threading.Lock()
+        # The expiry time and folder IDs of each (user ID, level)
+        self._entries = {}
+
+    def get(self, user, level=AccessType.READ):
+        """
+        :returns: The list of the IDs of the folders which the user can access
+            at the given level, or None if the user is an admin, who can
+            access every folder.
+        """
+        if user is not None and user.get('admin'):
+            return None
+        key = (user['_id'] if user is not None else None, level)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        folderIds = [folder['_id'] for folder in Folder().find(
+            Folder().permissionClauses(user, level), fields=['_id'])]
+        with self._lock:
+            if len(self._entries) >= self.maxUsers:
+                self._entries = {
+                    key: entry for key, entry in self._entries.items() if entry[0] > now}
+                if len(self._entries) >= self.maxUsers:
+                    self._entries.clear()
+            self._entries[key] = (now + self.ttl, folderIds)
+        return folderIds
+
+    def clear(self, event=None):
+        """Drop every entry; usable as an event handler."""
+        with self._lock:
+            self._entries.clear()
+
+
+def searchItems(query, folders, user=None, level=AccessType.READ, limit=0, offset=0,
+                after=None, count=False):
+    """
+    Find the items matching a query which a user can access, in the order of
+    their IDs, with an aggregation restricted to their accessible folders.
+
+    :param query: The MongoDB query of the items.
+    :param folders: The ``AccessibleFolders`` cache.
+    :param level: The access level on the items; None is read access.
+    :param limit: The maximum number of items, or 0 for all of them.
+    :param offset: The number of items to skip.
+    :param after: The ID of the last item of the previous page, to return
+        the next page without skipping the items of the previous ones.
+    :param count: Whether to count all the accessible matching items.
+    :returns: The list of items, and their total count, or None if it was
+        not requested.
+    """
+    folderIds = folders.get(user, AccessType.READ if level is None else level)
+    if folderIds is not None:
+        query = {'$and': [query, {'folderId': {'$in': folderIds}}]}
+    page = query
+    if after is not None:
+        page = {'$and': [query, {'_id': {'$gt': after}}]}
+
+    pipeline = [{'$match': page}, {'$sort': {'_id': 1}}]
+    if offset:
+        pipeline.append({'$skip': offset})
+    if limit:
+        pipeline.append({'$limit': limit})
+    items = list(Item().collection.aggregate(pipeline))
+    total = Item().collection.count_documents(query) if count else None
+    return items, total
+
+
+class FacetCache:
+    """
+    A cache of facet counts, which are aggregated over every matching item.
+
+    The least recently used entries are evicted beyond ``maxEntries``, and
+    entries expire after ``ttl`` seconds. ``clear`` drops every entry, and is
+    called whenever metadata is written, or access to folders changes.
+    """
+
+    def __init__(self, ttl=300, maxEntries=256):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self._lock = threading.Lock()
+        # The expiry time and counts of each key, from the least recently used
+        self._entries = collections.OrderedDict()
+        # Counts computed while the cache is cleared are not stored
+        self._generation = 0
+
+    def get(self, key, compute):
+        """
+        :param key: A hashable key of the counts.
+        :param compute: A function computing the counts if they are not cached.
+        :returns: The counts.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+            generation = self._generation
+        counts = compute()
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (now + self.ttl, counts)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxEntries:
+                    self._entries.popitem(last=False)
+        return counts
+
+    def counts(self, query, facets, folders, user=None, level=AccessType.READ, limit=0):
+        """
+        Count the facets of the items matching a query which a user can
+        access, like ``facetCounts``, unless the counts are cached.
+
+        Admins, who can access every item, share their counts; other users
+        each have their own. A cache is meant for the counts of a single
+        query, which is therefore not part of the key.
+
+        :returns: The counts, as returned by ``facetCounts``.
+        """
+        if user is not None and user.get('admin'):
+            userKey = 'admin'
+        else:
+            userKey = user['_id'] if user is not None else None
+        return self.get((userKey, level, tuple(facets), limit), lambda: facetCounts(
+            query, facets, folders, user, level, limit=limit))
+
+    def clear(self, event=None):
+        """Drop every entry; usable as an event handler."""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+
+def facetCounts(query, facets, folders, user=None, level=AccessType.READ, limit=0):
+    """
+    Count the items having each value of some fields, among the items
+    matching a query which a user can access, with a single aggregation.
+
+    :param query: The MongoDB query of the items.
+    :param facets: A dict mapping the name of each facet to the aggregation
+        expression of its value. The items whose value is an array are
+        counted once for each of its elements.
+    :param folders: The ``AccessibleFolders`` cache.
+    :param level: The access level on the items; None is read access.
+    :param limit: The maximum number of values of each facet, or 0 for all.
+    :returns: A dict mapping the name of each facet to a list of ``value``
+        and ``count`` dicts, by decreasing count.
+    """
+    folderIds = folders.get(user, AccessType.READ if level is None else level)
+    if folderIds is not None:
+        query = {'$and': [query, {'folderId': {'$in': folderIds}}]}
+    stages = {}
+    for index, (name, expression) in enumerate(facets.items()):
+        # Facet names are user input, which may not be valid field names
+        field = 'facet%d' % index
+        stages[field] = [
+            {'$project': {'value': expression}},
+            {'$unwind': '$value'},
+            {'$group': {'_id': '$value', 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1, '_id': 1}}
+        ] + ([{'$limit': limit}] if limit else [])
+    if not stages:
+        return {}
+    result = next(Item().collection.aggregate([{'$match': query}, {'$facet': stages}]))
+    return {
+        name: [{'value': entry['_id'], 'count': entry['count']}
+               for entry in result['facet%d' % index]]
+        for index, name in enumerate(facets)
+    }
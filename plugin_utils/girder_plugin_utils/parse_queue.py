@@ -0,0 +1,152 @@
+import collections
+import threading
+import time
+
+from girder import logger
+
+
+class ParseQueue:
+    """
+    A queue of items whose files are parsed by background worker threads,
+    so that uploads return without waiting for their files to be parsed.
+
+    Items are deduplicated: queuing an item which is already queued does
+    nothing, and an item is never processed by two workers at once. An item
+    which is queued again while it is processed is processed once more
+    afterwards, so that the files uploaded meanwhile are not missed.
+
+    The ``metrics`` method reports the depth of the queue and how long items
+    wait in it and take to process.
+    """
+
+    def __init__(self, process, workers=1):
+        """
+        :param process: A function called with the ID of each queued item.
+        :param workers: The number of worker threads.
+        """
+        self._process = process
+        self._workers = 0
+        self._threads = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # The time at which each pending item was queued, in queuing order
+        self._pending = collections.OrderedDict()
+        self._running = set()
+        self._processed = 0
+        self._failed = 0
+        self._waitSeconds = []
+        self._processSeconds = []
+        self.setWorkers(workers)
+
+    def setWorkers(self, workers):
+        """Change the number of worker threads; extra threads stop once idle."""
+        with self._lock:
+            self._workers = workers
+            while self._threads < self._workers:
+                self._threads += 1
+                threading.Thread(target=self._work, daemon=True).start()
+            self._changed.notify_all()
+
+    def isQueued(self, itemId):
+        """
+        Whether an item is waiting in the queue. This includes an item which
+        was queued again while it is processed.
+        """
+        with self._lock:
+            return itemId in self._pending
+
+    def put(self, itemId):
+        """
+        Queue an item.
+
+        :returns: Whether the item was queued, i.e. was not already pending.
+        """
+        with self._lock:
+            if itemId in self._pending:
+                return False
+            self._pending[itemId] = time.time()
+            self._changed.notify_all()
+            return True
+
+    def _next(self):
+        for itemId in self._pending:
+            if itemId not in self._running:
+                return itemId
+        return None
+
+    def _work(self):
+        while True:
+            with self._lock:
+                itemId = self._next()
+                while itemId is None and self._threads <= self._workers:
+                    self._changed.wait()
+                    itemId = self._next()
+                if itemId is None:
+                    self._threads -= 1
+                    return
+                queued = self._pending.pop(itemId)
+                self._running.add(itemId)
+
+            started = time.time()
+            failed = False
+            try:
+                self._process(itemId)
+            except Exception:
+                logger.exception('Failed to process queued item %s', itemId)
+                failed = True
+            finished = time.time()
+
+            with self._lock:
+                self._running.discard(itemId)
+                self._processed += 1
+                self._failed += failed
+                self._waitSeconds.append(started - queued)
+                self._processSeconds.append(finished - started)
+                # Keep a recent window, for percentiles
+                del self._waitSeconds[:-1000], self._processSeconds[:-1000]
+                # The item may have been queued again while it was processed
+                self._changed.notify_all()
+
+    @staticmethod
+    def _summary(values):
+        if not values:
+            return {'mean': None, 'p95': None, 'max': None}
+        ordered = sorted(values)
+        return {
+            'mean': sum(ordered) / len(ordered),
+            'p95': ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)],
+            'max': ordered[-1]
+        }
+
+    def metrics(self):
+        """
+        :returns: The number of ``queued`` and ``running`` items, the number
+            of items ``processed`` (including those which ``failed``), and
+            statistics of the ``waitSeconds`` of items in the queue and of
+            their ``processSeconds``, over the last 1000 items.
+        """
+        with self._lock:
+            return {
+                'workers': self._workers,
+                'queued': len(self._pending),
+                'running': len(self._running),
+                'processed': self._processed,
+                'failed': self._failed,
+                'waitSeconds': self._summary(self._waitSeconds),
+                'processSeconds': self._summary(self._processSeconds)
+            }
+
+    def join(self, timeout=None):
+        """
+        Wait until no item is queued or being processed.
+
+        :returns: Whether the queue is idle.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._pending or self._running:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+            return True
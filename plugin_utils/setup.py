@@ -0,0 +1,23 @@
+from setuptools import find_packages, setup
+
+
+# perform the install
+setup(
+    name='girder-plugin-utils',
+    version='1.0.0',
+    description='Helpers shared by the DICOM and NIfTI viewer plugins of Girder',
+    license='Apache 2.0',
+    classifiers=[
+        'Development Status :: 4 - Beta',
+        'Environment :: Web Environment',
+        'Operating System :: OS Independent',
+        'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
+    ],
+    python_requires='>=3.8',
+    packages=find_packages(),
+    zip_safe=False,
+    install_requires=[
+        'girder>=3',
+    ]
+)